@@ -6,25 +6,48 @@ import os
 import time
 import json
 import re
-import requests
+import signal
 import subprocess
 import socket
+import threading
+import sys
 
 from dotenv import load_dotenv
-from azure.iot.device import IoTHubDeviceClient
-
-import relay_ops
-from relay_ops import MachineNotConfiguredException  # Import the custom exception
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging with timestamp and log level
+# Configure logging with timestamp and log level. Before any import that logs: the first
+# logging call of a module would otherwise install a default handler and this would be ignored
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# Claim the relay outputs (all de-energized) before the slower imports below, so a
+# relay left energized by a killed process is released within milliseconds of start
+import relay_ops
+
+import requests
+from azure.iot.device import IoTHubDeviceClient, Message
+
+import sd_notify
+import memory_stats
+import machine_state
+import heartbeat
+import callback_outbox
+import sampling_profiler
+import latency_trace
+import integrity
+import log_bundle
+import bandwidth
+from handler_watchdog import HandlerRunner
+from paths import DIAGNOSTICS_DIR
+from relay_ops import MachineNotConfiguredException  # Import the custom exception
+from pulse_scheduler import TrainAborted
+from activation_ledger import ActivationLedger
+from usage_store import UsageStore
+
 # Read version from external file
 def get_version():
     """Read version information from the external version.json file"""
@@ -48,27 +71,264 @@ logging.info("Running with version: %s", VERSION)
 
 RECEIVED_MESSAGES = 0
 
-# Retrieve the IoT Hub connection string from environment variables
-IOT_CONNECTION_STRING = os.getenv("IOT_CONNECTION_STRING")
-if not IOT_CONNECTION_STRING:
-    logging.error("IOT_CONNECTION_STRING not found in environment variables.")
-    exit(1)
-print("Connection String: %s...%s" % (IOT_CONNECTION_STRING[:5], IOT_CONNECTION_STRING[-5:]))  # Partially display for security
+# One HTTP session for all callbacks: keeps the connection pool (and TLS sessions)
+# alive instead of building a new session and handshake for every request
+HTTP_SESSION = requests.Session()
+
+# Bytes sent and received per category, and the budget mode of metered uplinks (see bandwidth.py)
+BANDWIDTH = bandwidth.BandwidthMeter()
+BANDWIDTH.attach(HTTP_SESSION, "callbacks")
+
+# Activation callbacks are queued and retried by a background sender (see callback_outbox.py)
+CALLBACK_OUTBOX = callback_outbox.CallbackOutbox(HTTP_SESSION)
+# In budget mode callbacks are held briefly and sent together over one connection
+BANDWIDTH.add_listener(lambda budget: CALLBACK_OUTBOX.set_coalesce(bandwidth.BUDGET_COALESCE_S if budget else 0))
+
+STARTED_AT = time.monotonic()
+
+# RSS/GC sampling and tracemalloc snapshots on demand (see memory_stats.py)
+MEMORY_MONITOR = memory_stats.MemoryMonitor()
+
+# Per-stage latency of recent activations, hub enqueue to callback (see latency_trace.py)
+ACTIVATION_LATENCY = latency_trace.StageMetrics()
+
+# Progress limits used to decide whether systemd's watchdog may be fed
+MAX_HANDLER_SECONDS = 600
+MAX_STUCK_HANDLERS = 4
+
+# Deadline (s) of each message handler and whether it may be cancelled when it overruns.
+# Cancelling raises an exception at an arbitrary point of the handler, so only handlers
+# that hold nothing shared are cancellable. The others (shared HTTP session and its
+# connection pool, callback outbox, ledger, config file, profile lock) are never
+# interrupted: their HTTP calls have HTTP_TIMEOUT_S, and an overrunning one is
+# abandoned and reported as stuck until it finishes. Activations are never cancelled
+# either: the pulse train is bounded by the scheduler, and interrupting the handler
+# would lose the ledger entry and the callback.
+DEFAULT_HANDLER_DEADLINE_SECONDS = 60
+HANDLER_DEADLINES = {
+    'configure': (15, False),
+    'wake_up': (5, True),
+    'activate': (MAX_HANDLER_SECONDS, False),
+    'reboot': (15, True),
+    'upgrade': (300, True),
+    'request_upgrade': (300, True),
+    'get_version': (30, False),
+    'diagnostic': (30, False),
+    'query_activation': (30, False),
+    'get_logs': (10, False),
+    'verify_integrity': (60, False),
+    'usage_report': (30, False),
+    'memory_snapshot': (60, False),
+    'profile': (10, False),
+}
+# Connect and read timeouts of the handlers' own HTTP calls, well inside their deadlines
+HTTP_TIMEOUT_S = (5, 15)
+HANDLER_RUNNER = HandlerRunner()
+MAX_SCHEDULER_STALL_SECONDS = 10
+MAX_DISCONNECTED_SECONDS = 600
+MAX_BACKOFF_SECONDS = 300  # 5 minutes
 
-# Extract device ID from connection string
-def get_device_id():
+# On SIGTERM, running pulse trains get this long to finish before they are aborted
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("PULSE_DRAIN_TIMEOUT_S", "20"))
+# Time left to the callback outbox to deliver the last callbacks when stopping
+STOP_FLUSH_SECONDS = 5
+# Set once the service is stopping, new activations are refused
+SHUTTING_DOWN = False
+
+# Append-only record of every activation attempt (see activation_ledger.py)
+try:
+    ACTIVATION_LEDGER = ActivationLedger()
+except Exception as e:
+    logging.error("Activation ledger unavailable: %s", e)
+    ACTIVATION_LEDGER = None
+
+# Per-machine usage columns for usage_report (see usage_store.py)
+USAGE_STORE = UsageStore()
+
+# get_logs bundles, uploaded in the background and held back while relays pulse (see log_bundle.py).
+# They go to storage rather than to the backend, with their own session so they are accounted apart.
+LOG_SESSION = requests.Session()
+BANDWIDTH.attach(LOG_SESSION, "logs")
+LOG_UPLOADER = log_bundle.LogUploader(LOG_SESSION, is_busy=lambda: bool(relay_ops.scheduler.busy_relays()))
+
+def load_client_options():
+    """
+    Optional IoT Hub client settings: IOT_SERVER_CERT (PEM file of a CA to trust, e.g. the
+    local stand-in of iothub_standin.py) and IOT_KEEP_ALIVE_S (MQTT keep-alive, SDK default 60 s).
+    """
+    options = {}
+    cert_file = os.getenv("IOT_SERVER_CERT")
+    if cert_file:
+        with open(cert_file, 'r') as file:
+            options["server_verification_cert"] = file.read()
+    if os.getenv("IOT_KEEP_ALIVE_S"):
+        options["keep_alive"] = int(os.getenv("IOT_KEEP_ALIVE_S"))
+    return options
+
+CLIENT_OPTIONS = load_client_options()
+SDK_KEEP_ALIVE_SECONDS = 60
+
+def client_keep_alive() -> int:
+    """MQTT keep-alive for a new hub connection: the configured one, longer in bandwidth budget mode."""
+    return BANDWIDTH.keep_alive(CLIENT_OPTIONS.get("keep_alive", SDK_KEEP_ALIVE_SECONDS))
+
+# Maximum number of device identities served by one process (IOT_CONNECTION_STRING_2 ... _N)
+MAX_DEVICES = 8
+
+def get_device_id(connection_string: str):
     """Extract the device ID from the IoT Hub connection string."""
-    match = re.search(r'DeviceId=([^;]+)', IOT_CONNECTION_STRING)
+    match = re.search(r'DeviceId=([^;]+)', connection_string)
     if match:
         return match.group(1)
     return "unknown_device"
 
-DEVICE_ID = get_device_id()
+def parse_relay_list(text: str):
+    """Parse a relay list such as "1-8,13" into a set of relay numbers, None if empty."""
+    if not text or not text.strip():
+        return None
+    relays = set()
+    for part in text.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-')
+            relays.update(range(int(first), int(last) + 1))
+        elif part:
+            relays.add(int(part))
+    return relays
+
+class DeviceContext:
+    """
+    One IoT Hub device identity served by this process, with its own
+    configuration file and relay subset. The relay outputs, the pulse scheduler,
+    the HTTP session and the ledger are shared by every device.
+    """
+
+    def __init__(self, connection_string: str, config_file: str = 'config.json', relays: set = None):
+        self.connection_string = connection_string
+        self.device_id = get_device_id(connection_string)
+        self.config_file = config_file
+        self.relays = relays
+        self.client = None
+        # Start time (monotonic) of the message handler currently running, None when idle
+        self.handler_started_at = None
+        self.disconnected_since = None
+        self.retry_at = 0.0
+        self.backoff_time = 60
+        self.received_messages = 0
+        self.connections = 0
+        # MQTT keep-alive of the current client
+        self.keep_alive = None
+        # Idle/pulsing state of every machine, published as reported properties
+        self.machine_state = machine_state.MachineStatePublisher(
+            self.device_id, self.read_machine_states, self.publish_reported_properties,
+            defer=lambda: BANDWIDTH.budget)
+        relay_ops.scheduler.add_listener(self.machine_state.notify)
+        # Periodic health telemetry over the hub connection
+        self.heartbeat = heartbeat.Heartbeat(self.device_id, self.collect_heartbeat, self.send_telemetry,
+                                             defer=lambda: BANDWIDTH.budget)
+
+    def read_machine_states(self):
+        return relay_ops.get_machine_states(self.config_file, self.relays)
+
+    def collect_heartbeat(self) -> dict:
+        return {
+            "up": int(time.monotonic() - STARTED_AT),
+            "v": VERSION,
+            "rx": self.received_messages,
+            "rc": self.connections,
+            "rss": memory_stats.read_rss_kb(),
+            "t": heartbeat.read_cpu_temperature(),
+            "ld": heartbeat.read_load_average(),
+            "df": heartbeat.read_disk_free_mb(),
+            "ob": CALLBACK_OUTBOX.depth(),
+        }
+
+    def send_telemetry(self, payload: str, message_type: str = "heartbeat") -> bool:
+        """Send a device-to-cloud message. Returns False while not connected."""
+        client = self.client
+        if client is None or not client.connected:
+            return False
+        message = Message(payload, content_encoding="utf-8", content_type="application/json")
+        message.custom_properties["type"] = message_type
+        client.send_message(message)
+        BANDWIDTH.hub_publish("telemetry", len(payload.encode('utf-8')),
+                              bandwidth.D2C_TOPIC + bandwidth.properties_bytes(message.custom_properties))
+        return True
+
+    def publish_reported_properties(self, patch: dict) -> bool:
+        """Patch the device twin reported properties. Returns False while not connected."""
+        client = self.client
+        if client is None or not client.connected:
+            return False
+        client.patch_twin_reported_properties(patch)
+        BANDWIDTH.hub_publish("twin", len(json.dumps(patch)), bandwidth.TWIN_TOPIC)
+        return True
+
+    def receive_message(self, message):
+        """SDK callback: runs the message handler for this device and keeps track of how long it takes."""
+        _CURRENT.device = self
+        _CURRENT.received_at = time.time()
+        self.received_messages += 1
+        self.handler_started_at = time.monotonic()
+        try:
+            message_handler(message)
+        finally:
+            self.handler_started_at = None
+
+def load_devices():
+    """
+    Device identities from the environment:
+        IOT_CONNECTION_STRING, IOT_CONFIG_FILE (config.json), IOT_RELAYS (all)
+        IOT_CONNECTION_STRING_2, IOT_CONFIG_FILE_2 (config_2.json), IOT_RELAYS_2 (all)
+        ...
+    A relay may only belong to one device.
+    """
+    devices = []
+    for index in range(1, MAX_DEVICES + 1):
+        suffix = "" if index == 1 else f"_{index}"
+        connection_string = os.getenv(f"IOT_CONNECTION_STRING{suffix}")
+        if not connection_string:
+            continue
+        default_config = "config.json" if index == 1 else f"config{suffix}.json"
+        devices.append(DeviceContext(
+            connection_string,
+            config_file=os.getenv(f"IOT_CONFIG_FILE{suffix}", default_config),
+            relays=parse_relay_list(os.getenv(f"IOT_RELAYS{suffix}", ""))
+        ))
+
+    assigned = {}
+    for device in devices:
+        for relay_number in device.relays or ():
+            if relay_number in assigned:
+                raise ValueError(f"Relay {relay_number} assigned to both {assigned[relay_number]} and {device.device_id}")
+            assigned[relay_number] = device.device_id
+    if len(devices) > 1 and any(device.relays is None for device in devices):
+        raise ValueError("IOT_RELAYS must be set for every device when serving more than one device")
+    return devices
+
+# Retrieve the IoT Hub connection strings from environment variables
+try:
+    DEVICES = load_devices()
+except ValueError as e:
+    logging.error("Invalid device configuration: %s", e)
+    exit(1)
+if not DEVICES:
+    logging.error("IOT_CONNECTION_STRING not found in environment variables.")
+    exit(1)
+for _device in DEVICES:
+    print("Connection String: %s...%s" % (_device.connection_string[:5], _device.connection_string[-5:]))  # Partially display for security
+
+# Device whose message is being handled on the current thread
+_CURRENT = threading.local()
+
+def current_device() -> DeviceContext:
+    """The device the running handler belongs to, the first device outside of a handler."""
+    return getattr(_CURRENT, 'device', None) or DEVICES[0]
 
 def determine_environment():
     """Determine if this is a dev or prod environment from the connection string."""
     # Extract the hostname from the connection string
-    match = re.search(r'HostName=([^;]+)', IOT_CONNECTION_STRING)
+    match = re.search(r'HostName=([^;]+)', current_device().connection_string)
     if match:
         hostname = match.group(1)
         # Check specifically for "IoTHub-dev" in the hostname
@@ -91,9 +351,10 @@ def message_configure(config_data: dict):
 
     # Save the configuration file
     try:
-        with open('config.json', 'w') as f:
+        with open(current_device().config_file, 'w') as f:
             json.dump(config_data, f, indent=4)
         logging.info("%s: Configuration saved successfully.", func_name)
+        current_device().machine_state.notify()
     except Exception as e:
         logging.error("%s: Failed to save configuration - %s", func_name, e)
 
@@ -101,8 +362,20 @@ def message_wake_up():
     func_name = "message_wake_up"
     logging.info("%s: Wake up signal received.", func_name)
 
+def record_activation_latency(trace: dict) -> dict:
+    """Add an activation's stage durations to the local metrics and log them."""
+    durations = latency_trace.durations_ms(trace)
+    ACTIVATION_LATENCY.record(durations)
+    logging.info("Activation latency (ms): %s", durations)
+    return durations
+
 def message_activate(json_data: dict):
     func_name = "message_activate"
+    trace = {
+        "hub_enqueued": getattr(_CURRENT, 'enqueued_at', None),
+        "received": getattr(_CURRENT, 'received_at', None),
+        "dispatched": time.time(),
+    }
 
     intent_id = json_data.get('payment_intent_id') or json_data.get('intent_id')
     machine_id_raw = json_data.get('machine_id')
@@ -113,14 +386,32 @@ def message_activate(json_data: dict):
 
     activation_status = "CONFIRMED"
     activation_error_code = None
+    machine_id = None
+    device = current_device()
+    # Filled by relay_ops with impulses requested/delivered and edge timestamps;
+    # the details below are kept in the in-flight journal while the relay pulses
+    progress = {
+        "intent_id": intent_id,
+        "activation_key": activation_key,
+        "callback_url": callback_url,
+        "callback_token": callback_token,
+        "device_id": device.device_id,
+    }
 
     try:
         if machine_id_raw is None:
             raise KeyError('machine_id')
         if number_of_impulses is None:
             raise KeyError('number_of_impulses')
+        # Checked before any relay work: a string would be repeated by the multiplication in relay_ops
+        if isinstance(number_of_impulses, bool) or not isinstance(number_of_impulses, int) or number_of_impulses < 1:
+            raise ValueError(f"number_of_impulses must be a positive integer, got {number_of_impulses!r}")
 
         machine_id = int(machine_id_raw) if isinstance(machine_id_raw, str) else machine_id_raw
+        progress["machine_id"] = machine_id
+
+        if SHUTTING_DOWN:
+            raise TrainAborted("service stopping, activation refused")
 
         logging.info(
             "%s: Activating intent_id=%s machine_id=%s, impulses=%s",
@@ -132,31 +423,46 @@ def message_activate(json_data: dict):
             logging.info("%s: Using v1.0 activation method", func_name)
             relay_ops.activate_machine_v1_0(
                 machine_id=machine_id,
-                number_of_impulses=number_of_impulses
+                number_of_impulses=number_of_impulses,
+                progress=progress,
+                config_file=device.config_file,
+                relays=device.relays
             )
         elif VERSION.startswith("1.1"):
             logging.info("%s: Using v1.1 activation method", func_name)
             relay_ops.activate_machine_v1_1(
                 machine_id=machine_id,
-                number_of_impulses=number_of_impulses
+                number_of_impulses=number_of_impulses,
+                progress=progress,
+                config_file=device.config_file,
+                relays=device.relays
             )
         elif VERSION.startswith("1.2"):
             logging.info("%s: Using v1.2 activation method", func_name)
             relay_ops.activate_machine_v1_2(
                 machine_id=machine_id,
-                number_of_impulses=number_of_impulses
+                number_of_impulses=number_of_impulses,
+                progress=progress,
+                config_file=device.config_file,
+                relays=device.relays
             )
         elif VERSION.startswith("1.5"):
             logging.info("%s: Using v1.5 activation method (v1.2 relay + callback)", func_name)
             relay_ops.activate_machine_v1_2(
                 machine_id=machine_id,
-                number_of_impulses=number_of_impulses
+                number_of_impulses=number_of_impulses,
+                progress=progress,
+                config_file=device.config_file,
+                relays=device.relays
             )
         else:
             logging.warning("%s: Unknown version %s, defaulting to v1.2 activation", func_name, VERSION)
             relay_ops.activate_machine_v1_2(
                 machine_id=machine_id,
-                number_of_impulses=number_of_impulses
+                number_of_impulses=number_of_impulses,
+                progress=progress,
+                config_file=device.config_file,
+                relays=device.relays
             )
 
         logging.info("%s: Activation successful for machine_id=%s", func_name, machine_id)
@@ -165,6 +471,10 @@ def message_activate(json_data: dict):
         logging.error("%s: %s", func_name, e)
         activation_status = "FAILED"
         activation_error_code = "MACHINE_NOT_CONFIGURED"
+    except TrainAborted as e:
+        logging.error("%s: Activation interrupted - %s", func_name, e)
+        activation_status = "FAILED"
+        activation_error_code = "INTERRUPTED"
     except KeyError as e:
         logging.error("%s: Missing key in JSON data - %s", func_name, e)
         activation_status = "FAILED"
@@ -178,6 +488,39 @@ def message_activate(json_data: dict):
         activation_status = "FAILED"
         activation_error_code = "RELAY_ERROR"
 
+    if ACTIVATION_LEDGER is not None:
+        try:
+            ACTIVATION_LEDGER.record(
+                intent_id=intent_id,
+                activation_key=activation_key,
+                machine_id=machine_id if isinstance(machine_id, int) else None,
+                impulses_requested=progress.get('impulses_requested', 0),
+                impulses_delivered=progress.get('impulses_delivered', 0),
+                first_edge=progress.get('first_edge'),
+                last_edge=progress.get('last_edge'),
+                status=activation_status,
+                error_code=activation_error_code,
+                device_id=device.device_id
+            )
+        except Exception as e:
+            logging.error("%s: Failed to record activation in ledger - %s", func_name, e)
+
+    if isinstance(machine_id, int):
+        try:
+            first_edge, last_edge = progress.get('first_edge'), progress.get('last_edge')
+            USAGE_STORE.record(
+                device.device_id, machine_id,
+                timestamp=first_edge or trace['dispatched'],
+                impulses=progress.get('impulses_delivered', 0),
+                duration_s=(last_edge - first_edge) if first_edge and last_edge else 0.0,
+                failed=activation_status != "CONFIRMED"
+            )
+        except Exception as e:
+            logging.error("%s: Failed to record activation usage - %s", func_name, e)
+
+    for point in ('config_loaded', 'first_edge', 'last_edge'):
+        trace[point] = progress.get(point)
+
     # Send execution confirmation if callback_url provided (v1.5+)
     if callback_url and callback_token and activation_key:
         try:
@@ -185,16 +528,79 @@ def message_activate(json_data: dict):
             payload = {
                 "activation_key": activation_key,
                 "callback_token": callback_token,
-                "device_id": DEVICE_ID,
+                "device_id": device.device_id,
                 "status": activation_status,
                 "executed_at": datetime.utcnow().isoformat() + "Z",
             }
             if activation_error_code:
                 payload["error_code"] = activation_error_code
-            requests.post(callback_url, json=payload, timeout=10)
-            logging.info("Activation callback sent to %s", callback_url)
+                if progress.get('impulses_delivered'):
+                    # Partially delivered, e.g. interrupted by a service stop
+                    payload["impulses_requested"] = progress.get('impulses_requested')
+                    payload["impulses_delivered"] = progress['impulses_delivered']
+
+            def stamp_callback_sent(payload):
+                # Runs on every attempt, so a retried callback reports when it was really sent
+                first_attempt = trace.get('callback_sent') is None
+                trace['callback_sent'] = time.time()
+                if BANDWIDTH.budget:
+                    # Metered uplink short on data: the latency stays in the local metrics only
+                    payload.pop("trace", None)
+                    payload.pop("latency_ms", None)
+                else:
+                    payload["trace"] = latency_trace.compact(trace)
+                    payload["latency_ms"] = latency_trace.durations_ms(trace)
+                if first_attempt:
+                    record_activation_latency(trace)
+
+            CALLBACK_OUTBOX.post(callback_url, payload, label=f"activation {activation_key}",
+                                 before_send=stamp_callback_sent)
+            logging.info("Activation callback queued for %s", callback_url)
         except Exception as e:
             logging.warning("Activation callback failed (non-critical): %s", e)
+    else:
+        record_activation_latency(trace)
+
+def report_interrupted_activations():
+    """
+    Take the in-flight journal and report the activations a previous run left in flight
+    (killed mid-pulse): recorded in the ledger and sent as FAILED/INTERRUPTED callbacks
+    with the impulses actually delivered. The relays were already released by relay_ops.
+    """
+    from datetime import datetime, timezone
+    for entry in relay_ops.open_journal():
+        logging.warning("Interrupted activation found: machine_id=%s relay=%s intent_id=%s, %s/%s impulses delivered",
+                        entry.get('machine_id'), entry['relay_number'], entry.get('intent_id'),
+                        entry['impulses_delivered'], entry['impulses_requested'])
+        if ACTIVATION_LEDGER is not None:
+            try:
+                ACTIVATION_LEDGER.record(
+                    intent_id=entry.get('intent_id'),
+                    activation_key=entry.get('activation_key'),
+                    machine_id=entry.get('machine_id'),
+                    impulses_requested=entry['impulses_requested'],
+                    impulses_delivered=entry['impulses_delivered'],
+                    first_edge=entry['started_at'],
+                    last_edge=None,
+                    status="FAILED",
+                    error_code="INTERRUPTED",
+                    device_id=entry.get('device_id') or DEVICES[0].device_id
+                )
+            except Exception as e:
+                logging.error("Failed to record interrupted activation in ledger - %s", e)
+
+        if entry.get('callback_url') and entry.get('callback_token') and entry.get('activation_key'):
+            CALLBACK_OUTBOX.post(entry['callback_url'], {
+                "activation_key": entry['activation_key'],
+                "callback_token": entry['callback_token'],
+                "device_id": entry.get('device_id') or DEVICES[0].device_id,
+                "status": "FAILED",
+                "error_code": "INTERRUPTED",
+                "impulses_requested": entry['impulses_requested'],
+                "impulses_delivered": entry['impulses_delivered'],
+                "executed_at": datetime.fromtimestamp(entry['started_at'], tz=timezone.utc)
+                    .strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            }, label=f"interrupted activation {entry['activation_key']}")
 
 def message_reboot():
     func_name = "message_reboot"
@@ -249,12 +655,14 @@ def message_upgrade():
             return False
         
         # Run the update script with absolute path to bash
-        result = subprocess.run(
-            ["/bin/bash", update_script_path], 
-            capture_output=True, 
-            text=True, 
-            check=True
-        )
+        with BANDWIDTH.measure("upgrade"):
+            result = subprocess.run(
+                ["/bin/bash", update_script_path], 
+                capture_output=True, 
+                text=True, 
+                check=True,
+                timeout=240
+            )
         
         # Log the results
         logging.info("%s: Upgrade completed successfully", func_name)
@@ -297,10 +705,30 @@ def message_version(json_data: dict):
     
     # Prepare response with device version and echoed token
     response = {
-        "device_id": DEVICE_ID,
+        "device_id": current_device().device_id,
         "device_version": VERSION,
         "token": token
     }
+
+    # Relay wear counters let the backend schedule relay replacements
+    try:
+        response["relay_counters"] = relay_ops.get_relay_counters()
+    except Exception as e:
+        logging.warning("%s: Could not read relay counters - %s", func_name, e)
+
+    response["memory"] = MEMORY_MONITOR.summary()
+    response["callback_outbox"] = CALLBACK_OUTBOX.stats()
+    response["activation_latency"] = ACTIVATION_LATENCY.snapshot()
+    response["handlers"] = HANDLER_RUNNER.stats()
+    response["bandwidth"] = BANDWIDTH.report()
+    if INTEGRITY_RESULT is not None:
+        response["integrity"] = INTEGRITY_RESULT["status"]
+
+    # Worst-case relay edge timing error, per relay
+    try:
+        response["pulse_jitter"] = relay_ops.get_pulse_jitter()
+    except Exception as e:
+        logging.warning("%s: Could not read pulse jitter - %s", func_name, e)
     
     # Log the response being sent
     logging.info("%s: Sending version info response: %s", func_name, response)
@@ -319,7 +747,7 @@ def message_version(json_data: dict):
     
     try:
         logging.info("%s: Initiating POST request...", func_name)
-        response_obj = requests.post(url, json=response, headers=headers)
+        response_obj = HTTP_SESSION.post(url, json=response, headers=headers, timeout=HTTP_TIMEOUT_S)
         logging.info("%s: Request completed with status code: %s", func_name, response_obj.status_code)
         
         if response_obj.status_code == 200:
@@ -342,6 +770,378 @@ def message_version(json_data: dict):
         logging.error("%s: Error sending version info: %s", func_name, e)
         return False
 
+MAX_QUERY_RESULTS = 5000
+MAX_QUERY_INTENTS = 500
+
+def _parse_query_time(value):
+    """Accept epoch seconds or an ISO 8601 string (with optional trailing Z)."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    from datetime import datetime, timezone
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def _parse_intent_ids(json_data: dict) -> list:
+    """The intents of a query: "intent_ids" (list, or a single string) and "intent_id"."""
+    intent_ids = json_data.get("intent_ids") or []
+    if isinstance(intent_ids, str):
+        intent_ids = [intent_ids]
+    if not isinstance(intent_ids, list):
+        raise ValueError(f"intent_ids must be a list, not {type(intent_ids).__name__}")
+    intent_ids = list(intent_ids)
+    if json_data.get("intent_id"):
+        intent_ids.append(json_data["intent_id"])
+    # bool is an int subclass, str(True) would query an intent called "True"
+    if any(isinstance(intent_id, bool) or not isinstance(intent_id, (str, int)) for intent_id in intent_ids):
+        raise ValueError("intent IDs must be strings or integers")
+    if len(intent_ids) > MAX_QUERY_INTENTS:
+        raise ValueError(f"{len(intent_ids)} intents in one query, at most {MAX_QUERY_INTENTS}")
+    return [str(intent_id) for intent_id in intent_ids]
+
+def message_query_activation(json_data: dict):
+    """
+    Handle the query_activation message: answer whether given intents were executed.
+    Accepts "intent_ids" (list of at most MAX_QUERY_INTENTS), "intent_id" (single) and/or a "from"/"to" time range,
+    and answers every intent in a single callback using the activation ledger index.
+
+    :param json_data: The JSON data from the message
+    """
+    func_name = "message_query_activation"
+    logging.info("%s: Activation query received", func_name)
+
+    if ACTIVATION_LEDGER is None:
+        logging.error("%s: Activation ledger unavailable, cannot answer query", func_name)
+        return False
+
+    device_id = current_device().device_id
+    response = {
+        "device_id": device_id,
+        "token": json_data.get("token", "")
+    }
+    # Only this laundry's activations; records from before the device was stored in the
+    # ledger are only trusted when the Pi serves a single laundry
+    scope = {"device_id": device_id, "include_untagged": len(DEVICES) == 1}
+
+    try:
+        intent_ids = _parse_intent_ids(json_data)
+        if intent_ids:
+            found = ACTIVATION_LEDGER.lookup_many(intent_ids, **scope)
+            response["intents"] = {
+                intent_id: {"found": bool(records), "attempts": records}
+                for intent_id, records in found.items()
+            }
+
+        if json_data.get("from") is not None or json_data.get("to") is not None:
+            start = _parse_query_time(json_data.get("from"))
+            end = _parse_query_time(json_data.get("to"))
+            total = ACTIVATION_LEDGER.count_range(start, end, **scope)
+            response["range"] = {
+                "from": start,
+                "to": end,
+                "total": total,
+                "truncated": total > MAX_QUERY_RESULTS,
+                "activations": ACTIVATION_LEDGER.query_range(start, end, limit=MAX_QUERY_RESULTS, **scope)
+            }
+    except ValueError as e:
+        logging.error("%s: Invalid query - %s", func_name, e)
+        response["error_code"] = "INVALID_DATA"
+
+    if "intents" not in response and "range" not in response and "error_code" not in response:
+        logging.error("%s: Query without intent_ids or time range", func_name)
+        response["error_code"] = "MISSING_KEY"
+
+    env_info = determine_environment()
+    url = json_data.get("callback_url") or f"https://{env_info['url']}/api/laundries/iot/activation_query_callback"
+    logging.info("%s: Sending query reply to %s", func_name, url)
+
+    try:
+        response_obj = HTTP_SESSION.post(url, json=response, headers={"Content-Type": "application/json"}, timeout=HTTP_TIMEOUT_S)
+        if response_obj.status_code == 200:
+            logging.info("%s: Query reply sent successfully", func_name)
+            return True
+        logging.error("%s: Failed to send query reply. Status code: %s, Response: %s",
+                     func_name, response_obj.status_code, response_obj.text)
+        return False
+    except requests.exceptions.RequestException as e:
+        logging.error("%s: Error sending query reply: %s", func_name, e)
+        return False
+
+def message_usage_report(json_data: dict):
+    """
+    Handle the usage_report message: per-machine usage aggregates (activations and impulses
+    per hour of the day, failure rates, peak concurrency) over a "from"/"to" time range,
+    computed from the local usage store and posted in a single callback.
+
+    :param json_data: The JSON data from the message
+    """
+    func_name = "message_usage_report"
+    logging.info("%s: Usage report request received", func_name)
+
+    device = current_device()
+    response = {
+        "device_id": device.device_id,
+        "token": json_data.get("token", "")
+    }
+    try:
+        report = USAGE_STORE.report(device.device_id, _parse_query_time(json_data.get("from")),
+                                    _parse_query_time(json_data.get("to")))
+        response.update(report)
+        logging.info("%s: %s activations aggregated in %s ms", func_name, report["activations"], report["elapsed_ms"])
+    except ValueError as e:
+        logging.error("%s: Invalid time range - %s", func_name, e)
+        response["error_code"] = "INVALID_DATA"
+    except OSError as e:
+        logging.error("%s: Could not read the usage store - %s", func_name, e)
+        response["error_code"] = "STORE_ERROR"
+
+    env_info = determine_environment()
+    url = json_data.get("callback_url") or f"https://{env_info['url']}/api/laundries/iot/usage_report_callback"
+    logging.info("%s: Sending usage report to %s", func_name, url)
+
+    try:
+        response_obj = HTTP_SESSION.post(url, json=response, headers={"Content-Type": "application/json"}, timeout=HTTP_TIMEOUT_S)
+        if response_obj.status_code == 200:
+            logging.info("%s: Usage report sent successfully", func_name)
+            return True
+        logging.error("%s: Failed to send usage report. Status code: %s, Response: %s",
+                      func_name, response_obj.status_code, response_obj.text)
+        return False
+    except requests.exceptions.RequestException as e:
+        logging.error("%s: Error sending usage report: %s", func_name, e)
+        return False
+
+# Last result of the release manifest verification (see integrity.py)
+INTEGRITY_RESULT = None
+
+def check_integrity(full: bool = False) -> dict:
+    """Verify the installed files against manifest.json and log what differs."""
+    global INTEGRITY_RESULT
+    try:
+        result = integrity.verify(full=full)
+    except Exception as e:
+        logging.error("Integrity verification failed: %s", e)
+        result = {"status": "error", "error": str(e)}
+    if result["status"] == "mismatch":
+        logging.error("Installed files differ from the release manifest (%s): missing %s, modified %s",
+                      result.get("version"), result.get("missing"), result.get("modified"))
+    elif result["status"] == "no_manifest":
+        logging.warning("No release manifest, installed files not verified")
+    elif result["status"] == "ok":
+        logging.info("Installed files match the release manifest %s (%d files, %d read, %s ms)",
+                     result["version"], result["checked"], result["hashed"], result["elapsed_ms"])
+    INTEGRITY_RESULT = result
+    return result
+
+def message_verify_integrity(json_data: dict):
+    """
+    Handle the verify_integrity message: verify the installed files against the release
+    manifest and post the result, so the fleet can be checked after an upgrade.
+    "full": true reads every file instead of trusting the digest cache.
+
+    :param json_data: The JSON data from the message
+    """
+    func_name = "message_verify_integrity"
+    logging.info("%s: Integrity verification requested", func_name)
+
+    response = {
+        "device_id": current_device().device_id,
+        "device_version": VERSION,
+        "token": json_data.get("token", "")
+    }
+    response.update(check_integrity(full=bool(json_data.get("full"))))
+
+    env_info = determine_environment()
+    url = json_data.get("callback_url") or f"https://{env_info['url']}/api/laundries/iot/integrity_callback"
+    logging.info("%s: Sending integrity result to %s", func_name, url)
+
+    try:
+        response_obj = HTTP_SESSION.post(url, json=response, headers={"Content-Type": "application/json"}, timeout=HTTP_TIMEOUT_S)
+        if response_obj.status_code == 200:
+            logging.info("%s: Integrity result sent successfully", func_name)
+            return True
+        logging.error("%s: Failed to send integrity result. Status code: %s, Response: %s",
+                      func_name, response_obj.status_code, response_obj.text)
+        return False
+    except requests.exceptions.RequestException as e:
+        logging.error("%s: Error sending integrity result: %s", func_name, e)
+        return False
+
+def message_get_logs(json_data: dict):
+    """
+    Handle the get_logs message: upload a gzip bundle of the service journal in chunks to
+    "upload_url", for a "since"/"until" window (default: the last 24 h) or after a journal
+    "after_cursor", optionally with the diagnostics output ("include_diagnostics") and the
+    configuration ("include_config"). The upload runs in the background; "upload_id" resumes
+    an interrupted upload. The final status is posted to callback_url when provided.
+    In bandwidth budget mode the upload is refused unless "allow_metered" is set.
+
+    :param json_data: The JSON data from the message
+    """
+    func_name = "message_get_logs"
+    device = current_device()
+
+    upload_url = json_data.get("upload_url")
+    if not upload_url:
+        logging.error("%s: get_logs without upload_url", func_name)
+        return False
+
+    try:
+        request = {
+            "upload_url": upload_url,
+            "upload_token": json_data.get("upload_token"),
+            "upload_id": json_data.get("upload_id"),
+            "since": _parse_query_time(json_data.get("since")),
+            "until": _parse_query_time(json_data.get("until")),
+            "after_cursor": json_data.get("after_cursor"),
+        }
+    except ValueError as e:
+        logging.error("%s: Invalid time window - %s", func_name, e)
+        return False
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    sections = []
+    if json_data.get("include_diagnostics"):
+        sections.append(("diagnostics", [sys.executable, os.path.join(script_dir, "diagnosticos_pagalava.py")]))
+    if json_data.get("include_config"):
+        sections.append((os.path.basename(device.config_file), device.config_file))
+        sections.append(("version.json", os.path.join(script_dir, "version.json")))
+
+    callback_url = json_data.get("callback_url")
+
+    if BANDWIDTH.budget and not json_data.get("allow_metered"):
+        # A bundle can take megabytes: only sent in budget mode when explicitly requested
+        logging.warning("%s: Refused in bandwidth budget mode (allow_metered not set)", func_name)
+        if callback_url:
+            CALLBACK_OUTBOX.post(callback_url, {
+                "device_id": device.device_id,
+                "token": json_data.get("token", ""),
+                "upload_id": request["upload_id"],
+                "status": "REFUSED",
+                "error": "bandwidth budget mode, resend with allow_metered to upload anyway",
+            }, label="get_logs refused")
+        return False
+
+    def report_upload(status):
+        if callback_url:
+            status.update({"device_id": device.device_id, "token": json_data.get("token", "")})
+            CALLBACK_OUTBOX.post(callback_url, status, label=f"get_logs {status['upload_id']}")
+
+    try:
+        upload_id = LOG_UPLOADER.start(request, sections, on_done=report_upload)
+    except ValueError as e:
+        logging.error("%s: %s", func_name, e)
+        return False
+    if upload_id is None:
+        logging.warning("%s: Upload %s already running, request ignored", func_name, LOG_UPLOADER.running())
+        return False
+    logging.info("%s: Log upload %s started to %s", func_name, upload_id, upload_url)
+    return True
+
+def message_memory_snapshot(json_data: dict):
+    """
+    Handle the memory_snapshot message: capture a tracemalloc snapshot and diff it
+    against the previous one. The first request only starts tracing.
+    The report is posted to callback_url when the message provides one.
+
+    :param json_data: The JSON data from the message
+    """
+    func_name = "message_memory_snapshot"
+    logging.info("%s: Memory snapshot requested", func_name)
+
+    report = MEMORY_MONITOR.snapshot("c2d")
+
+    callback_url = json_data.get("callback_url")
+    if not callback_url:
+        return True
+
+    payload = {
+        "device_id": current_device().device_id,
+        "token": json_data.get("token", ""),
+        "memory": MEMORY_MONITOR.summary(),
+        "report": report
+    }
+    try:
+        response = HTTP_SESSION.post(callback_url, json=payload, timeout=HTTP_TIMEOUT_S)
+        logging.info("%s: Report sent, status code: %s", func_name, response.status_code)
+        return response.status_code == 200
+    except requests.exceptions.RequestException as e:
+        logging.error("%s: Error sending memory report: %s", func_name, e)
+        return False
+
+# Only one profile runs at a time
+PROFILE_LOCK = threading.Lock()
+DEFAULT_PROFILE_SECONDS = 30
+# Profile uploads give up sooner than activation callbacks (see callback_outbox.py)
+PROFILE_UPLOAD_MAX_AGE_S = 15 * 60
+PROFILE_UPLOAD_MAX_ATTEMPTS = 4
+
+def message_profile(json_data: dict):
+    """
+    Handle the profile message: sample the stacks of every thread (SDK threads
+    included) for "duration_s" seconds (default 30, at most 300) every
+    "interval_ms" milliseconds (default 20), in the background. The collapsed
+    stacks are saved in diagnostics/ and, when the message provides a
+    callback_url, posted there gzip-compressed and base64-encoded.
+
+    :param json_data: The JSON data from the message
+    """
+    func_name = "message_profile"
+
+    try:
+        duration_s = float(json_data.get("duration_s", DEFAULT_PROFILE_SECONDS))
+        interval_s = float(json_data.get("interval_ms", sampling_profiler.DEFAULT_INTERVAL_S * 1000)) / 1000.0
+    except (TypeError, ValueError) as e:
+        logging.error("%s: Invalid profile parameters - %s", func_name, e)
+        return False
+    interval_s = max(0.005, interval_s)
+
+    if not PROFILE_LOCK.acquire(blocking=False):
+        logging.warning("%s: A profile is already running", func_name)
+        return False
+
+    logging.info("%s: Profiling for %.0f seconds every %.0f ms", func_name, duration_s, interval_s * 1000)
+    threading.Thread(
+        target=run_profile,
+        args=(duration_s, interval_s, json_data.get("callback_url"), json_data.get("token", ""),
+              current_device().device_id),
+        name="profiler",
+        daemon=True
+    ).start()
+    return True
+
+def run_profile(duration_s, interval_s, callback_url, token, device_id):
+    """Run the sampling profiler, save the result and queue it for upload. Releases PROFILE_LOCK."""
+    func_name = "run_profile"
+    try:
+        profiler = sampling_profiler.SamplingProfiler(interval_s)
+        profiler.run(duration_s)
+        summary = profiler.summary()
+        path = profiler.save()
+        logging.info("%s: Profile saved to %s - %s", func_name, path, summary)
+
+        if callback_url:
+            import base64
+            compressed, omitted = profiler.compressed()
+            if omitted:
+                logging.warning("%s: Profile too large to upload, %d least frequent stacks left out", func_name, omitted)
+            # A profile is only useful while someone is waiting for it, never hold the outbox for hours
+            CALLBACK_OUTBOX.post(callback_url, {
+                "device_id": device_id,
+                "token": token,
+                "profile": dict(summary, omitted_stacks=omitted),
+                "file": os.path.basename(path),
+                "format": "collapsed+gzip+base64",
+                "data": base64.b64encode(compressed).decode('ascii'),
+            }, label="profile", max_age_s=PROFILE_UPLOAD_MAX_AGE_S, max_attempts=PROFILE_UPLOAD_MAX_ATTEMPTS)
+    except Exception as e:
+        logging.error("%s: Profiling failed - %s", func_name, e)
+    finally:
+        PROFILE_LOCK.release()
+
 def get_local_ip():
     """Get the device's local IP address."""
     try:
@@ -354,6 +1154,29 @@ def get_local_ip():
         return None
 
 
+def notify_verification_probe(diagnostic_dir, verification_code, received_at=None, enqueued_at=None):
+    """
+    Envia o código de verificação, a hora de receção e a hora a que o IoT Hub pôs a
+    mensagem em fila para o socket local da ferramenta de diagnóstico
+    (diagnostics/probe.sock), se existir, para que a latência C2D seja medida sem
+    esperar pelo ficheiro e sem contar o pedido à API do backend.
+    """
+    probe_socket = os.path.join(diagnostic_dir, "probe.sock")
+    if not os.path.exists(probe_socket):
+        return False
+    payload = json.dumps({
+        "verification_code": verification_code,
+        "received_at": received_at or time.time(),
+        "enqueued_at": enqueued_at
+    }).encode('utf-8')
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(payload, probe_socket)
+        return True
+    except OSError as e:
+        logging.warning("notify_verification_probe: Falha ao notificar a ferramenta de diagnóstico - %s", e)
+        return False
+
 def message_diagnostic(json_data: dict):
     """
     Manipula mensagens de diagnóstico, gravando o código de verificação num ficheiro
@@ -370,8 +1193,7 @@ def message_diagnostic(json_data: dict):
         return False
 
     # Pasta para ficheiros temporários
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    diagnostic_dir = os.path.join(script_dir, "diagnostics")
+    diagnostic_dir = DIAGNOSTICS_DIR
 
     # Criar pasta se não existir
     if not os.path.exists(diagnostic_dir):
@@ -393,13 +1215,17 @@ def message_diagnostic(json_data: dict):
         logging.error("%s: Falha ao gravar código de verificação - %s", func_name, e)
         return False
 
+    # Avisar a ferramenta de diagnóstico, se estiver à espera, com as horas de entrada na fila e de receção
+    notify_verification_probe(diagnostic_dir, verification_code, getattr(_CURRENT, 'received_at', None),
+                              getattr(_CURRENT, 'enqueued_at', None))
+
     # Enviar callback de conectividade para o backend
     ip_address = get_local_ip()
     env_info = determine_environment()
     url = f"https://{env_info['url']}/api/laundries/iot/connectivity_callback"
 
     payload = {
-        "device_id": DEVICE_ID,
+        "device_id": current_device().device_id,
         "verification_code": verification_code,
         "ip_address": ip_address
     }
@@ -407,7 +1233,7 @@ def message_diagnostic(json_data: dict):
     logging.info("%s: Enviando callback de conectividade para %s (IP: %s)", func_name, url, ip_address)
 
     try:
-        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"}, timeout=15)
+        response = HTTP_SESSION.post(url, json=payload, headers={"Content-Type": "application/json"}, timeout=HTTP_TIMEOUT_S)
         if response.status_code == 200:
             logging.info("%s: Callback de conectividade enviado com sucesso", func_name)
             return True
@@ -419,15 +1245,54 @@ def message_diagnostic(json_data: dict):
         logging.error("%s: Erro ao enviar callback de conectividade: %s", func_name, e)
         return False
 
+def dispatch_message(msg_type: str, json_data: dict):
+    """Route a message to the appropriate handler."""
+    if msg_type == 'configure':
+        message_configure(json_data.get('data', {}))
+    elif msg_type == 'wake_up':
+        message_wake_up()
+    elif msg_type == 'activate':
+        message_activate(json_data)
+    elif msg_type == 'reboot':
+        message_reboot()
+    elif msg_type == 'upgrade' or msg_type == 'request_upgrade':
+        message_upgrade()
+    elif msg_type == 'get_version':
+        message_version(json_data)
+    elif msg_type == 'diagnostic':
+        message_diagnostic(json_data)
+    elif msg_type == 'query_activation':
+        message_query_activation(json_data)
+    elif msg_type == 'get_logs':
+        message_get_logs(json_data)
+    elif msg_type == 'verify_integrity':
+        message_verify_integrity(json_data)
+    elif msg_type == 'usage_report':
+        message_usage_report(json_data)
+    elif msg_type == 'memory_snapshot':
+        message_memory_snapshot(json_data)
+    elif msg_type == 'profile':
+        message_profile(json_data)
+    else:
+        logging.warning("dispatch_message: Unknown message type '%s'", msg_type)
+
 def message_handler(message):
     global RECEIVED_MESSAGES
     RECEIVED_MESSAGES += 1
     start_time = time.time()
     logging.info("Message received:")
 
-    # Log data from both system and application (custom) properties
-    for key, value in vars(message).items():
-        logging.info("    %s: %s", key, value)
+    # The payload stays at INFO (trace_replay.py extracts it from the journal); the other
+    # system and application properties only at DEBUG
+    logging.info("    data: %s", getattr(message, 'data', None))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for key, value in vars(message).items():
+            if key != 'data':
+                logging.debug("    %s: %s", key, value)
+    _CURRENT.enqueued_at = latency_trace.parse_enqueued_time(message)
+    BANDWIDTH.hub_publish("c2d", len(getattr(message, 'data', None) or b""),
+                          bandwidth.C2D_TOPIC + bandwidth.properties_bytes(getattr(message, 'custom_properties', None)),
+                          outgoing=False)
     
     try:
         # Convert byte string to regular string
@@ -448,112 +1313,263 @@ def message_handler(message):
         logging.error("message_handler: 'msg_type' not found in the message.")
         return
 
-    # Route the message to the appropriate handler
-    if msg_type == 'configure':
-        message_configure(json_data.get('data', {}))
-    elif msg_type == 'wake_up':
-        message_wake_up()
-    elif msg_type == 'activate':
-        message_activate(json_data)
-    elif msg_type == 'reboot':
-        message_reboot()
-    elif msg_type == 'upgrade' or msg_type == 'request_upgrade':
-        message_upgrade()
-    elif msg_type == 'get_version':
-        message_version(json_data)
-    elif msg_type == 'diagnostic':
-        message_diagnostic(json_data)
-    else:
-        logging.warning("message_handler: Unknown message type '%s'", msg_type)
+    # Run the handler in a worker thread under its deadline (see handler_watchdog.py)
+    deadline_s, cancellable = HANDLER_DEADLINES.get(msg_type, (DEFAULT_HANDLER_DEADLINE_SECONDS, False))
+    context = {name: getattr(_CURRENT, name, None) for name in ('device', 'received_at', 'enqueued_at')}
+
+    def copy_context():
+        for name, value in context.items():
+            setattr(_CURRENT, name, value)
+
+    HANDLER_RUNNER.run(msg_type, lambda: dispatch_message(msg_type, json_data), deadline_s,
+                       cancellable=cancellable, setup=copy_context)
     
     logging.info("Total messages received: %s", RECEIVED_MESSAGES)
     logging.info("Processing time: %.2f seconds", time.time() - start_time)
 
+def check_progress():
+    """
+    Check that the receive path and the pulse scheduler are making progress.
+
+    :return: Tuple (healthy, reason).
+    """
+    stall = time.monotonic() - relay_ops.scheduler.heartbeat
+    if stall > MAX_SCHEDULER_STALL_SECONDS:
+        return False, "pulse scheduler stalled for %.0f seconds" % stall
+
+    stuck = HANDLER_RUNNER.stuck()
+    if len(stuck) >= MAX_STUCK_HANDLERS:
+        return False, "%d message handlers stuck past their deadline: %s" % (
+            len(stuck), ", ".join(name for name, _ in stuck))
+
+    for device in DEVICES:
+        started_at = device.handler_started_at
+        if device.client is not None and started_at is not None:
+            running = time.monotonic() - started_at
+            if running > MAX_HANDLER_SECONDS:
+                return False, "message handler of %s running for %.0f seconds" % (device.device_id, running)
+
+    return True, None
+
+def sleep_with_watchdog(seconds):
+    """Sleep while keeping systemd's watchdog fed, as long as there is progress."""
+    watchdog = sd_notify.watchdog_interval()
+    step = min(30, watchdog / 3) if watchdog else 30
+    deadline = time.monotonic() + seconds
+    while True:
+        healthy, reason = check_progress()
+        if healthy:
+            sd_notify.notify("WATCHDOG=1")
+        else:
+            logging.error("Watchdog: %s, not notifying systemd", reason)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(step, remaining))
+
 def check_internet_connection():
-    """Check if there is internet connectivity by trying to resolve DNS"""
+    """Check if there is internet connectivity by trying to resolve the IoT Hub host name"""
+    match = re.search(r'HostName=([^;]+)', DEVICES[0].connection_string)
     try:
-        # Try to resolve a common domain name
-        socket.gethostbyname("azure.microsoft.com")
+        # The hub the devices connect to (a local stand-in in the bench, see iothub_standin.py)
+        socket.gethostbyname(match.group(1) if match else "azure.microsoft.com")
         return True
     except socket.gaierror:
         return False
 
+def shutdown_device(device):
+    """Shut down the client of a device, if it has one."""
+    if device.client:
+        try:
+            device.client.shutdown()
+            logging.info("%s: IoT Hub client shut down.", device.device_id)
+        except Exception as e:
+            logging.error("%s: Error during client shutdown: %s", device.device_id, e)
+        device.client = None
+    BANDWIDTH.hub_disconnected(device.device_id)
+
+def connect_device(device):
+    """
+    Create the client of a device if needed and connect it. On failure the
+    device is retried after its own backoff, without affecting the others.
+
+    :return: True if the device is connected.
+    """
+    try:
+        if device.client is None:
+            logging.info("%s: Instantiating IoT Hub client...", device.device_id)
+            device.keep_alive = client_keep_alive()
+            device.client = IoTHubDeviceClient.create_from_connection_string(
+                device.connection_string, **dict(CLIENT_OPTIONS, keep_alive=device.keep_alive))
+            device.client.on_message_received = device.receive_message
+            logging.info("%s: IoT Hub client instantiated successfully.", device.device_id)
+
+        logging.info("%s: Connecting to IoT Hub...", device.device_id)
+        device.client.connect()
+    except Exception as e:
+        logging.error("%s: Connection error: %s", device.device_id, e)
+        # Set client to None so we create a fresh instance on retry
+        shutdown_device(device)
+        logging.info("%s: Will attempt to reconnect in %d seconds...", device.device_id, device.backoff_time)
+        device.retry_at = time.monotonic() + device.backoff_time
+        # Increase backoff using exponential backoff with max limit
+        device.backoff_time = min(device.backoff_time * 1.5, MAX_BACKOFF_SECONDS)
+        return False
+
+    logging.info("%s: Connected successfully. Waiting for C2D messages.", device.device_id)
+    device.connections += 1
+    device.backoff_time = 60
+    device.disconnected_since = None
+    BANDWIDTH.hub_connected(device.device_id, device.keep_alive)
+    MEMORY_MONITOR.mark_reconnect()
+    # The twin may still hold the state from before the disconnect
+    device.machine_state.reset()
+    return True
+
+def supervise_device(device):
+    """Connect a device that has no client and recreate the client if the SDK never reconnects."""
+    if device.client is None:
+        if time.monotonic() >= device.retry_at:
+            connect_device(device)
+        return
+
+    # The SDK reconnects by itself; recreate the client if it never comes back
+    if device.client.connected:
+        if device.disconnected_since is not None:
+            # Reconnected by the SDK, the twin may hold an outdated state
+            device.machine_state.reset()
+            BANDWIDTH.hub_connected(device.device_id, device.keep_alive)
+        device.disconnected_since = None
+        if device.keep_alive != client_keep_alive() and device.handler_started_at is None:
+            # Budget mode started or ended: the keep-alive only changes with a new client
+            logging.info("%s: Reconnecting with a keep-alive of %d seconds", device.device_id, client_keep_alive())
+            shutdown_device(device)
+            connect_device(device)
+        return
+    if device.disconnected_since is None:
+        BANDWIDTH.hub_disconnected(device.device_id)
+    device.disconnected_since = device.disconnected_since or time.monotonic()
+    if time.monotonic() - device.disconnected_since > MAX_DISCONNECTED_SECONDS:
+        logging.error("%s: IoT Hub client disconnected for more than %d seconds",
+                      device.device_id, MAX_DISCONNECTED_SECONDS)
+        shutdown_device(device)
+        device.disconnected_since = None
+        connect_device(device)
+
+class ShutdownRequested(BaseException):
+    """Raised in the main thread by the SIGTERM handler (not an Exception, so no retry loop catches it)."""
+
+def request_shutdown(signum, frame):
+    raise ShutdownRequested()
+
+def drain(timeout_s=DRAIN_TIMEOUT_SECONDS):
+    """
+    Stop accepting activations, give running pulse trains up to timeout_s to
+    finish, abort the rest (relays released, activations reported as
+    INTERRUPTED) and let the callback outbox deliver the last callbacks.
+    """
+    global SHUTTING_DOWN
+    SHUTTING_DOWN = True
+    sd_notify.notify("STOPPING=1")
+
+    deadline = time.monotonic() + timeout_s
+    busy = relay_ops.scheduler.busy_relays()
+    if busy:
+        logging.info("Stopping: waiting up to %.0f seconds for relays %s", timeout_s, sorted(busy))
+        sd_notify.notify("STATUS=Stopping, waiting for running activations")
+    while busy and time.monotonic() < deadline:
+        time.sleep(0.1)
+        busy = relay_ops.scheduler.busy_relays()
+    if busy:
+        logging.warning("Stopping: aborting pulse trains on relays %s", sorted(busy))
+        relay_ops.scheduler.abort_all("service stopping")
+
+    # Let the handlers of aborted activations record them and queue their callbacks
+    deadline = time.monotonic() + 2
+    while any(device.handler_started_at is not None for device in DEVICES) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if not CALLBACK_OUTBOX.flush(STOP_FLUSH_SECONDS):
+        logging.warning("Stopping with %d callback(s) not delivered", CALLBACK_OUTBOX.depth())
+
 def main():
     """Main function with reconnection logic following Azure best practices"""
     logging.info("Starting the Python IoT Hub C2D Messaging device sample...")
-    
-    # Initialize client at a broader scope so we can access it in finally block
-    client = None
+    logging.info("Serving %d device(s): %s", len(DEVICES), ", ".join(
+        "%s (%s, relays %s)" % (device.device_id, device.config_file,
+                                sorted(device.relays) if device.relays else "all")
+        for device in DEVICES))
+
+    # kill -USR2 <pid> captures a tracemalloc snapshot
+    MEMORY_MONITOR.install_signal_handler()
+    # systemctl stop/restart: finish or abort running activations before exiting
+    signal.signal(signal.SIGTERM, request_shutdown)
+
+    relay_ops.open_counters()
+    report_interrupted_activations()
+    check_integrity()
     
     # Initial backoff time in seconds
     backoff_time = 60
-    max_backoff_time = 300  # 5 minutes
+    ready = False
     
     while True:
         try:
             # Check for internet connection before attempting to connect
             if not check_internet_connection():
                 logging.warning("No internet connectivity detected. Waiting before retry...")
-                time.sleep(backoff_time)
+                sd_notify.notify("STATUS=No internet connectivity, waiting before retry")
+                sleep_with_watchdog(backoff_time)
                 
                 # Increase backoff using exponential backoff with max limit
-                backoff_time = min(backoff_time * 1.5, max_backoff_time)
+                backoff_time = min(backoff_time * 1.5, MAX_BACKOFF_SECONDS)
                 continue
                 
             # Reset backoff time when we have connectivity
             backoff_time = 60
-            
-            # Create a new client instance if needed
-            if client is None:
-                logging.info("Instantiating IoT Hub client...")
-                client = IoTHubDeviceClient.create_from_connection_string(IOT_CONNECTION_STRING)
-                client.on_message_received = message_handler
-                logging.info("IoT Hub client instantiated successfully.")
-            
-            logging.info("Connecting to IoT Hub...")
-            # The connect() call is implicit in the SDK, but we can add explicit connection handling
-            
-            logging.info("Connected successfully. Waiting for C2D messages. Press Ctrl-C to exit.")
-            
-            # Keep the script running to listen for messages
-            while True:
-                # Using shorter sleep intervals allows for quicker response to KeyboardInterrupt
-                time.sleep(30)
-                
-                # Periodically check connection status (SDK doesn't provide direct way,
-                # but we can implement a ping mechanism or heartbeat if needed)
+
+            # Every device connects and reconnects on its own
+            for device in DEVICES:
+                supervise_device(device)
+            BANDWIDTH.update()
+
+            connected = sum(1 for device in DEVICES if device.client is not None and device.client.connected)
+            if connected and not ready:
+                # Readiness is only reported once a hub connection is established
+                sd_notify.notify("READY=1")
+                ready = True
+            if connected == len(DEVICES):
+                status = "Connected to IoT Hub (%d/%d devices), waiting for C2D messages"
+            elif connected:
+                status = "Partially connected to IoT Hub (%d/%d devices), reconnecting the others"
+            else:
+                status = "Disconnected from IoT Hub (%d/%d devices), reconnecting"
+            sd_notify.notify("STATUS=" + status % (connected, len(DEVICES)))
+
+            # The watchdog is only fed while messages and pulses make progress
+            sleep_with_watchdog(30)
                 
         except KeyboardInterrupt:
             logging.info("IoT Hub C2D Messaging device sample stopped by user.")
             break
+
+        except ShutdownRequested:
+            logging.info("SIGTERM received, stopping.")
+            break
             
         except Exception as e:
-            logging.error("Connection error: %s", e)
-            
-            # Properly clean up the client if it exists
-            if client:
-                try:
-                    client.shutdown()
-                    logging.info("IoT Hub client shut down due to error.")
-                except:
-                    pass
-                
-                # Set client to None so we create a fresh instance on retry
-                client = None
-            
-            logging.info("Will attempt to reconnect in %d seconds...", backoff_time)
-            time.sleep(backoff_time)
-            
-            # Increase backoff using exponential backoff with max limit
-            backoff_time = min(backoff_time * 1.5, max_backoff_time)
+            logging.error("Unexpected error: %s", e)
+            sd_notify.notify("STATUS=Unexpected error, retrying")
+            try:
+                sleep_with_watchdog(backoff_time)
+            except ShutdownRequested:
+                logging.info("SIGTERM received, stopping.")
+                break
     
     # Final cleanup
-    if client:
-        try:
-            client.shutdown()
-            logging.info("IoT Hub client shut down successfully.")
-        except Exception as e:
-            logging.error("Error during client shutdown: %s", e)
+    drain()
+    for device in DEVICES:
+        shutdown_device(device)
+    BANDWIDTH.save()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,380 @@
+"""
+Filename: activation_ledger.py
+
+Append-only ledger of every activation attempt, with a small on-disk index
+keyed by intent ID / activation key so a single activation can be looked up
+without scanning the segments.
+
+Layout (inside data/ledger):
+    segment_00000001.log ...  length-prefixed binary records, rotated by size
+    index.bin                 fixed-size entries: key digest, segment, offset, time
+
+Writes go through buffered files and are fsynced by a background thread at a
+bounded cadence, so recording an activation never waits on the SD card.
+
+Every record carries the device (laundry) it was made for, and queries take a
+device_id so one laundry never sees another's activations. Records written
+before the device was stored have none ("untagged").
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from paths import DATA_DIR
+LEDGER_DIR = os.path.join(DATA_DIR, "ledger")
+
+SEGMENT_MAX_BYTES = 1024 * 1024
+MAX_SEGMENTS = 32
+FSYNC_INTERVAL_S = 5.0
+FSYNC_MAX_PENDING = 32
+# Records read per batch by the device-filtered range queries
+SCAN_BATCH = 256
+
+# record length (excluding this prefix) and CRC32 of the body
+_RECORD_PREFIX = struct.Struct("<HI")
+# recorded_at, first_edge, last_edge, machine_id, impulses requested, impulses delivered
+_RECORD_FIXED = struct.Struct("<dddiII")
+# key digest, segment number, offset in segment, recorded_at
+_INDEX_ENTRY = struct.Struct("<8sIId")
+
+_SEGMENT_PREFIX = "segment_"
+_SEGMENT_SUFFIX = ".log"
+_INDEX_NAME = "index.bin"
+# Index entry of a record without intent ID or activation key, kept for time queries only
+_NO_KEY = bytes(8)
+
+
+def key_digest(key: str) -> bytes:
+    """Short, stable digest used as index key for an intent ID or activation key."""
+    return hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+
+
+def _pack_str(value) -> bytes:
+    data = ("" if value is None else str(value)).encode('utf-8')[:255]
+    return struct.pack("<B", len(data)) + data
+
+
+def _unpack_str(buffer: bytes, offset: int):
+    length = buffer[offset]
+    value = buffer[offset + 1:offset + 1 + length].decode('utf-8')
+    return (value or None), offset + 1 + length
+
+
+def encode_record(record: dict) -> bytes:
+    body = _RECORD_FIXED.pack(
+        record['recorded_at'],
+        record.get('first_edge') or 0.0,
+        record.get('last_edge') or 0.0,
+        record['machine_id'] if record.get('machine_id') is not None else -1,
+        record.get('impulses_requested') or 0,
+        record.get('impulses_delivered') or 0,
+    )
+    body += b"".join(_pack_str(record.get(field)) for field in
+                     ('intent_id', 'activation_key', 'status', 'error_code', 'device_id'))
+    return _RECORD_PREFIX.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_record(body: bytes) -> dict:
+    (recorded_at, first_edge, last_edge, machine_id,
+     impulses_requested, impulses_delivered) = _RECORD_FIXED.unpack_from(body, 0)
+    offset = _RECORD_FIXED.size
+    intent_id, offset = _unpack_str(body, offset)
+    activation_key, offset = _unpack_str(body, offset)
+    status, offset = _unpack_str(body, offset)
+    error_code, offset = _unpack_str(body, offset)
+    # Appended later: older records end after error_code
+    device_id = _unpack_str(body, offset)[0] if offset < len(body) else None
+    return {
+        "intent_id": intent_id,
+        "activation_key": activation_key,
+        "machine_id": machine_id if machine_id >= 0 else None,
+        "impulses_requested": impulses_requested,
+        "impulses_delivered": impulses_delivered,
+        "first_edge": first_edge or None,
+        "last_edge": last_edge or None,
+        "status": status,
+        "error_code": error_code,
+        "device_id": device_id,
+        "recorded_at": recorded_at,
+    }
+
+
+def _belongs(record: dict, device_id, include_untagged: bool) -> bool:
+    if device_id is None:
+        return True
+    if record['device_id'] is None:
+        return include_untagged
+    return record['device_id'] == device_id
+
+
+class ActivationLedger:
+    """Append-only activation ledger with segment rotation and a key index."""
+
+    def __init__(self, ledger_dir: str = LEDGER_DIR,
+                 segment_max_bytes: int = SEGMENT_MAX_BYTES,
+                 max_segments: int = MAX_SEGMENTS):
+        self.ledger_dir = ledger_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.max_segments = max_segments
+
+        self._lock = threading.RLock()
+        self._by_key = {}       # digest -> [(segment, offset), ...]
+        # [(recorded_at, segment, offset), ...] sorted by time: the clock of a Pi without an RTC
+        # can step back (NTP correction, fake-hwclock), so append order is not time order
+        self._by_time = []
+        self._pending = 0
+
+        os.makedirs(ledger_dir, exist_ok=True)
+        self._segments = self._list_segments()
+        if not self._segments:
+            self._segments = [1]
+        self._segment_number = self._segments[-1]
+        self._segment_file = open(self._segment_path(self._segment_number), 'ab')
+        self._load_index()
+        self._index_file = open(os.path.join(ledger_dir, _INDEX_NAME), 'ab')
+
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="ledger-flush", daemon=True)
+        self._flusher.start()
+
+    def _segment_path(self, segment_number: int) -> str:
+        return os.path.join(self.ledger_dir, f"{_SEGMENT_PREFIX}{segment_number:08d}{_SEGMENT_SUFFIX}")
+
+    def _list_segments(self) -> list:
+        segments = []
+        for filename in os.listdir(self.ledger_dir):
+            if filename.startswith(_SEGMENT_PREFIX) and filename.endswith(_SEGMENT_SUFFIX):
+                try:
+                    segments.append(int(filename[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def _load_index(self):
+        """Load the on-disk index, dropping entries of segments that no longer exist."""
+        index_path = os.path.join(self.ledger_dir, _INDEX_NAME)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, 'rb') as file:
+            data = file.read()
+        live_segments = set(self._segments)
+        stale = False
+        usable = len(data) - len(data) % _INDEX_ENTRY.size
+        for digest, segment, offset, recorded_at in _INDEX_ENTRY.iter_unpack(data[:usable]):
+            if segment not in live_segments:
+                stale = True
+                continue
+            if digest != _NO_KEY:
+                self._by_key.setdefault(digest, []).append((segment, offset))
+            # The entries of one record (one per key) are adjacent in the file
+            if not self._by_time or self._by_time[-1][1:] != (segment, offset):
+                self._by_time.append((recorded_at, segment, offset))
+        self._by_time.sort()
+        if stale or usable != len(data):
+            self._rewrite_index()
+
+    def _rewrite_index(self):
+        """Rewrite the index from memory, used after segments were removed."""
+        index_path = os.path.join(self.ledger_dir, _INDEX_NAME)
+        tmp_path = index_path + ".tmp"
+        digests = {}
+        for digest, locations in self._by_key.items():
+            for location in locations:
+                digests.setdefault(location, []).append(digest)
+        with open(tmp_path, 'wb') as file:
+            for recorded_at, segment, offset in self._by_time:
+                for digest in digests.get((segment, offset), [_NO_KEY]):
+                    file.write(_INDEX_ENTRY.pack(digest, segment, offset, recorded_at))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, index_path)
+
+    def _rotate(self):
+        """Start a new segment and drop the oldest ones beyond the retention limit."""
+        self._sync()
+        self._segment_file.close()
+        self._segment_number += 1
+        self._segments.append(self._segment_number)
+        self._segment_file = open(self._segment_path(self._segment_number), 'ab')
+
+        dropped = self._segments[:-self.max_segments]
+        if not dropped:
+            return
+        self._segments = self._segments[-self.max_segments:]
+        for segment in dropped:
+            try:
+                os.remove(self._segment_path(segment))
+            except FileNotFoundError:
+                pass
+        dropped = set(dropped)
+        for digest in list(self._by_key):
+            locations = [loc for loc in self._by_key[digest] if loc[0] not in dropped]
+            if locations:
+                self._by_key[digest] = locations
+            else:
+                del self._by_key[digest]
+        self._by_time = [entry for entry in self._by_time if entry[1] not in dropped]
+        self._index_file.close()
+        self._rewrite_index()
+        self._index_file = open(os.path.join(self.ledger_dir, _INDEX_NAME), 'ab')
+
+    def record(self, intent_id=None, activation_key=None, machine_id=None,
+               impulses_requested: int = 0, impulses_delivered: int = 0,
+               first_edge: float = None, last_edge: float = None,
+               status: str = None, error_code: str = None, device_id: str = None):
+        """Append one activation attempt. Durability is bounded by FSYNC_INTERVAL_S."""
+        record = {
+            "intent_id": intent_id,
+            "activation_key": activation_key,
+            "machine_id": machine_id,
+            "impulses_requested": impulses_requested,
+            "impulses_delivered": impulses_delivered,
+            "first_edge": first_edge,
+            "last_edge": last_edge,
+            "status": status,
+            "error_code": error_code,
+            "device_id": device_id,
+            "recorded_at": time.time(),
+        }
+        data = encode_record(record)
+        digests = [key_digest(key) for key in dict.fromkeys((intent_id, activation_key)) if key] or [_NO_KEY]
+
+        with self._lock:
+            if self._segment_file.tell() + len(data) > self.segment_max_bytes:
+                self._rotate()
+            offset = self._segment_file.tell()
+            self._segment_file.write(data)
+            for digest in digests:
+                self._index_file.write(_INDEX_ENTRY.pack(digest, self._segment_number, offset, record['recorded_at']))
+                if digest != _NO_KEY:
+                    self._by_key.setdefault(digest, []).append((self._segment_number, offset))
+            bisect.insort(self._by_time, (record['recorded_at'], self._segment_number, offset))
+            self._pending += 1
+            if self._pending >= FSYNC_MAX_PENDING:
+                self._sync()
+        return record
+
+    def _read_from(self, file, segment: int, offset: int):
+        file.seek(offset)
+        prefix = file.read(_RECORD_PREFIX.size)
+        if len(prefix) < _RECORD_PREFIX.size:
+            return None
+        length, crc = _RECORD_PREFIX.unpack(prefix)
+        body = file.read(length)
+        if len(body) != length or zlib.crc32(body) != crc:
+            logging.warning("activation_ledger: Corrupted record at segment %s offset %s", segment, offset)
+            return None
+        return decode_record(body)
+
+    def _read_locations(self, locations: list) -> list:
+        """Read the records at the given (segment, offset) locations, opening each segment once."""
+        self._segment_file.flush()
+        records = []
+        file = None
+        current_segment = None
+        try:
+            for segment, offset in locations:
+                if segment != current_segment:
+                    if file is not None:
+                        file.close()
+                        file = None
+                    current_segment = segment
+                    try:
+                        file = open(self._segment_path(segment), 'rb')
+                    except FileNotFoundError:
+                        continue
+                if file is None:
+                    continue
+                record = self._read_from(file, segment, offset)
+                if record:
+                    records.append(record)
+        finally:
+            if file is not None:
+                file.close()
+        return records
+
+    def lookup(self, key: str, device_id: str = None, include_untagged: bool = False) -> list:
+        """
+        Return every recorded attempt for an intent ID or activation key, oldest first.
+        With a device_id, only that device's attempts (and untagged ones if include_untagged).
+        """
+        with self._lock:
+            records = self._read_locations(self._by_key.get(key_digest(key), []))
+        # Digests are short, so confirm the key really matches
+        return [record for record in records if key in (record['intent_id'], record['activation_key'])
+                and _belongs(record, device_id, include_untagged)]
+
+    def lookup_many(self, keys: list, device_id: str = None, include_untagged: bool = False) -> dict:
+        """Look up several intent IDs / activation keys at once."""
+        return {key: self.lookup(key, device_id, include_untagged) for key in keys}
+
+    def _range(self, start: float, end: float) -> list:
+        low = 0 if start is None else bisect.bisect_left(self._by_time, (start,))
+        high = len(self._by_time) if end is None else bisect.bisect_right(self._by_time, (end, float('inf')))
+        return self._by_time[low:high]
+
+    def _scan_range(self, start: float, end: float, device_id: str, include_untagged: bool):
+        """Yield the records of one device between start and end, reading SCAN_BATCH at a time."""
+        entries = self._range(start, end)
+        for first in range(0, len(entries), SCAN_BATCH):
+            batch = self._read_locations([(segment, offset) for _, segment, offset in entries[first:first + SCAN_BATCH]])
+            for record in batch:
+                if _belongs(record, device_id, include_untagged):
+                    yield record
+
+    def query_range(self, start: float = None, end: float = None, limit: int = None,
+                    device_id: str = None, include_untagged: bool = False) -> list:
+        """
+        Return the attempts recorded between start and end (epoch seconds, inclusive).
+        Uses the in-memory time index, so only records in the range are read from disk;
+        the time index has no device, so with a device_id the range is read until limit matches.
+        """
+        with self._lock:
+            if device_id is None:
+                entries = self._range(start, end)
+                if limit is not None:
+                    entries = entries[:limit]
+                return self._read_locations([(segment, offset) for _, segment, offset in entries])
+            records = []
+            for record in self._scan_range(start, end, device_id, include_untagged):
+                if limit is not None and len(records) >= limit:
+                    break
+                records.append(record)
+            return records
+
+    def count_range(self, start: float = None, end: float = None,
+                    device_id: str = None, include_untagged: bool = False) -> int:
+        with self._lock:
+            if device_id is None:
+                return len(self._range(start, end))
+            return sum(1 for _ in self._scan_range(start, end, device_id, include_untagged))
+
+    def _sync(self):
+        if not self._pending:
+            return
+        self._segment_file.flush()
+        os.fsync(self._segment_file.fileno())
+        self._index_file.flush()
+        os.fsync(self._index_file.fileno())
+        self._pending = 0
+
+    def _flush_loop(self):
+        while not self._stop.wait(FSYNC_INTERVAL_S):
+            with self._lock:
+                try:
+                    self._sync()
+                except Exception as e:
+                    logging.error("activation_ledger: Failed to sync ledger - %s", e)
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self._sync()
+            self._segment_file.close()
+            self._index_file.close()
@@ -0,0 +1,496 @@
+"""
+Filename: bandwidth.py
+
+Accounting of the data the device sends and receives, per category, for shops
+on metered (4G) uplinks, and the budget mode that saves data when the monthly
+cap of the data plan comes close.
+
+Categories:
+    keepalive   IoT Hub connection upkeep: MQTT keep-alive pings and (re)connection handshakes
+    c2d         cloud-to-device messages (activate, get_version, ...)
+    telemetry   device-to-cloud messages (heartbeat)
+    twin        device twin reported properties (machine state)
+    callbacks   HTTPS requests to the backend, with the TLS handshake of every new connection
+    logs        get_logs bundle uploads
+    upgrade     git fetch of message_upgrade
+
+HTTP traffic is measured from the requests and responses of the sessions
+(request line, headers and bodies). The SDK does not expose the byte counts of
+the MQTT connection, so hub traffic is estimated from the payload sizes plus
+the MQTT, TLS and TCP/IP overheads. Upgrade traffic is the growth of the
+counters of the metered interface while the update script runs. Those counters
+(/proc/net/dev) are also kept for the whole billing cycle as the reference
+closest to what the operator bills: what the categories do not explain is
+reported as "other" (SSH sessions, DNS, NTP, apt, ...). The metered interface is
+the one of the default route (/proc/net/route), so LAN traffic on the other
+interfaces (a technician's SSH over Ethernet, a second network) is not
+counted; BANDWIDTH_INTERFACE names it explicitly.
+
+Budget mode starts when the data used in the cycle reaches the threshold of the
+cap, or when the usage projected to the end of the cycle exceeds the cap (from
+the third day of the cycle on). While it is on:
+    - the hub clients reconnect with a longer MQTT keep-alive
+    - callbacks are held for a few seconds and sent together over one connection,
+      without the latency trace fields
+    - heartbeats are only sent at their maximum staleness, machine state updates
+      at a longer interval, and get_logs uploads are refused unless forced
+
+Counters are saved in data/bandwidth.json every 10 minutes and when the
+service stops; the last 12 cycles are kept.
+
+Environment:
+    BANDWIDTH_MONTHLY_CAP_MB     data cap of the plan (default 0: accounting only, no budget mode)
+    BANDWIDTH_CYCLE_DAY          day of the month the plan renews, 1 to 28 (default 1)
+    BANDWIDTH_BUDGET_THRESHOLD   fraction of the cap at which budget mode starts (default 0.8)
+    BANDWIDTH_KEEP_ALIVE_S       MQTT keep-alive in budget mode (default 600, keep it below the
+                                 idle timeout of the carrier's NAT)
+    BANDWIDTH_COALESCE_S         how long callbacks are held in budget mode (default 20)
+    BANDWIDTH_INTERFACE          interface of the metered uplink (default: the one of the default route)
+
+Usage:
+    python bandwidth.py report [--json]
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import weakref
+from datetime import date, datetime
+
+from paths import DATA_DIR
+STATE_FILE = os.path.join(DATA_DIR, "bandwidth.json")
+
+CAP_MB = float(os.getenv("BANDWIDTH_MONTHLY_CAP_MB", "0"))
+CYCLE_DAY = min(28, max(1, int(os.getenv("BANDWIDTH_CYCLE_DAY", "1"))))
+BUDGET_THRESHOLD = float(os.getenv("BANDWIDTH_BUDGET_THRESHOLD", "0.8"))
+BUDGET_KEEP_ALIVE_S = int(os.getenv("BANDWIDTH_KEEP_ALIVE_S", "600"))
+BUDGET_COALESCE_S = float(os.getenv("BANDWIDTH_COALESCE_S", "20"))
+INTERFACE = os.getenv("BANDWIDTH_INTERFACE", "").strip()
+
+CATEGORIES = ("keepalive", "c2d", "telemetry", "twin", "callbacks", "logs", "upgrade")
+
+SAVE_INTERVAL_S = 600
+HISTORY_CYCLES = 12
+# The projection is too noisy before this
+MIN_PROJECTION_S = 3 * 86400
+
+# Wire overheads, in bytes
+TCP_IP_HEADERS = 52          # IPv4 + TCP with timestamps, per segment (and per ACK)
+TCP_SEGMENT = 1400           # payload of a segment on a typical 4G path
+TLS_RECORD = 29              # TLS 1.2 AES-GCM header, nonce and tag, per record
+TLS_RECORD_SIZE = 16384
+# Estimated (sent, received) of a TLS handshake with the certificate chain of the server,
+# and of a hub connection (handshake, CONNECT with the SAS token, CONNACK, subscriptions)
+HTTPS_HANDSHAKE = (700, 5500)
+HUB_CONNECT = (1800, 6500)
+# Estimated MQTT topic lengths, with the system properties URL-encoded in them
+C2D_TOPIC = 180
+D2C_TOPIC = 100
+TWIN_TOPIC = 60
+PING = 2
+PUBACK = 4
+PUBLISH_HEADER = 7           # fixed header, topic length and packet ID
+
+_MB = 1024 * 1024
+
+
+def wire_bytes(sent: int, received: int):
+    """Bytes on the wire (sent, received) of a TLS exchange, with the TCP ACKs of each direction."""
+    def framed(size):
+        segments = math.ceil(size / TCP_SEGMENT)
+        return size + math.ceil(size / TLS_RECORD_SIZE) * TLS_RECORD + segments * TCP_IP_HEADERS, segments
+
+    sent_wire, sent_segments = framed(sent)
+    received_wire, received_segments = framed(received)
+    # Delayed ACK: one per two segments received
+    return (sent_wire + math.ceil(received_segments / 2) * TCP_IP_HEADERS,
+            received_wire + math.ceil(sent_segments / 2) * TCP_IP_HEADERS)
+
+
+def properties_bytes(properties: dict) -> int:
+    """Length of message properties once URL-encoded in an MQTT topic."""
+    return sum(len(str(key)) + len(str(value)) + 2 for key, value in (properties or {}).items())
+
+
+def _headers_bytes(headers) -> int:
+    return sum(len(str(key)) + len(str(value)) + 4 for key, value in (headers or {}).items()) + 2
+
+
+def default_route_interface(path: str = "/proc/net/route"):
+    """Interface of the IPv4 default route with the lowest metric, None if there is none."""
+    try:
+        with open(path, 'r') as file:
+            lines = file.read().splitlines()[1:]
+    except OSError:
+        return None
+    routes = []
+    for line in lines:
+        fields = line.split()
+        # Iface, Destination, Gateway, Flags, RefCnt, Use, Metric, Mask
+        if len(fields) >= 8 and fields[1] == "00000000" and fields[7] == "00000000" and int(fields[3], 16) & 0x1:
+            routes.append((int(fields[6]), fields[0]))
+    return min(routes)[1] if routes else None
+
+
+def metered_interface():
+    """The interface the operator bills: BANDWIDTH_INTERFACE, or the one of the default route."""
+    return INTERFACE or default_route_interface()
+
+
+def read_interface_counters(interface: str, path: str = "/proc/net/dev"):
+    """Bytes (sent, received) of one network interface since boot, None if unavailable."""
+    if not interface:
+        return None
+    try:
+        with open(path, 'r') as file:
+            lines = file.read().splitlines()[2:]
+    except OSError:
+        return None
+    for line in lines:
+        name, _, data = line.partition(":")
+        fields = data.split()
+        if name.strip() == interface and len(fields) >= 9:
+            return int(fields[8]), int(fields[0])
+    return None
+
+
+def _read_boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id", 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def cycle_bounds(now: float, cycle_day: int = CYCLE_DAY):
+    """First day of the billing cycle containing now, and of the next one."""
+    today = date.fromtimestamp(now)
+    if today.day >= cycle_day:
+        start = today.replace(day=cycle_day)
+    elif today.month > 1:
+        start = date(today.year, today.month - 1, cycle_day)
+    else:
+        start = date(today.year - 1, 12, cycle_day)
+    end = date(start.year + 1, 1, cycle_day) if start.month == 12 else date(start.year, start.month + 1, cycle_day)
+    return start, end
+
+
+def _timestamp(day: date) -> float:
+    return datetime(day.year, day.month, day.day).timestamp()
+
+
+def _new_cycle(start: date) -> dict:
+    return {
+        "cycle": start.isoformat(),
+        "categories": {category: [0, 0, 0] for category in CATEGORIES},  # sent, received, events
+        "interface": [0, 0],
+    }
+
+
+class BandwidthMeter:
+    """Per-category byte counters of the current billing cycle and the budget mode they drive."""
+
+    def __init__(self, state_file: str = STATE_FILE, cap_mb: float = CAP_MB, cycle_day: int = CYCLE_DAY,
+                 threshold: float = BUDGET_THRESHOLD):
+        self.state_file = state_file
+        self.cap_bytes = int(cap_mb * _MB)
+        self.cycle_day = cycle_day
+        self.threshold = threshold
+        self.budget = False
+        self._lock = threading.Lock()
+        self._hubs = {}                              # name -> [keep-alive s, pings accounted until]
+        self._pools = weakref.WeakKeyDictionary()    # urllib3 pool -> connections already accounted
+        self._listeners = []
+        self._last_save = time.monotonic()
+        self._state = self._load()
+
+    # Persistence
+
+    def _load(self) -> dict:
+        state = None
+        try:
+            with open(self.state_file, 'r') as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            pass
+        if not isinstance(state, dict) or "cycle" not in state:
+            state = _new_cycle(cycle_bounds(time.time(), self.cycle_day)[0])
+        for category in CATEGORIES:
+            state["categories"].setdefault(category, [0, 0, 0])
+        state.setdefault("history", [])
+        return state
+
+    def save(self):
+        with self._lock:
+            state = json.loads(json.dumps(self._state))
+            self._last_save = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            temporary = self.state_file + ".tmp"
+            with open(temporary, 'w') as file:
+                json.dump(state, file)
+            os.replace(temporary, self.state_file)
+        except OSError as e:
+            logging.warning("bandwidth: Could not save the counters - %s", e)
+
+    def _roll_cycle(self, now: float):
+        """Start a new cycle when the plan renews, keeping the totals of the last ones. Lock held."""
+        start = cycle_bounds(now, self.cycle_day)[0].isoformat()
+        if self._state["cycle"] == start:
+            return
+        finished = {key: self._state[key] for key in ("cycle", "categories", "interface")}
+        history = (self._state["history"] + [finished])[-HISTORY_CYCLES:]
+        raw = {key: self._state[key] for key in ("interface_raw", "interface_name", "boot_id") if key in self._state}
+        self._state = _new_cycle(date.fromisoformat(start))
+        self._state.update(raw, history=history)
+        logging.info("bandwidth: New billing cycle from %s", start)
+
+    # Accounting
+
+    def record(self, category: str, sent: int, received: int, events: int = 1):
+        with self._lock:
+            self._roll_cycle(time.time())
+            counters = self._state["categories"][category]
+            counters[0] += int(sent)
+            counters[1] += int(received)
+            counters[2] += events
+
+    def hub_connected(self, name: str, keep_alive_s: float):
+        """A hub connection was (re)established: its handshake, then a ping every keep-alive interval."""
+        self.record("keepalive", *wire_bytes(*HUB_CONNECT))
+        with self._lock:
+            self._hubs[name] = [keep_alive_s, time.monotonic()]
+
+    def hub_disconnected(self, name: str):
+        self._accrue_keepalive()
+        with self._lock:
+            self._hubs.pop(name, None)
+
+    def _accrue_keepalive(self):
+        """Pings since the last accrual. Counted as if the link was idle: an upper bound."""
+        now = time.monotonic()
+        pings = 0
+        with self._lock:
+            for hub in self._hubs.values():
+                count = int((now - hub[1]) // hub[0])
+                hub[1] += count * hub[0]
+                pings += count
+        if pings:
+            sent, received = wire_bytes(PING, PING)
+            self.record("keepalive", sent * pings, received * pings, pings)
+
+    def hub_publish(self, category: str, payload_bytes: int, topic_bytes: int, outgoing: bool = True):
+        """One MQTT PUBLISH (QoS 1) and its acknowledgement."""
+        publish, ack = wire_bytes(PUBLISH_HEADER + topic_bytes + payload_bytes, PUBACK)
+        if outgoing:
+            self.record(category, publish, ack)
+        else:
+            self.record(category, ack, publish)
+
+    def attach(self, session, category: str):
+        """Account every request of a requests session to a category."""
+        def hook(response, **kwargs):
+            try:
+                self._account_http(category, response, kwargs.get("stream", False))
+            except Exception as e:
+                logging.debug("bandwidth: Could not account %s request - %s", category, e)
+
+        session.hooks["response"].append(hook)
+
+    def _account_http(self, category: str, response, stream: bool):
+        request = response.request
+        body = request.body or b""
+        sent = len(request.method) + len(request.path_url) + 11 + _headers_bytes(request.headers) + len(body)
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None:
+            content = int(content_length)
+        else:
+            content = 0 if stream else len(response.content)
+        received = 15 + len(response.reason or "") + _headers_bytes(response.headers) + content
+        sent, received = wire_bytes(sent, received)
+
+        # New connections of the pool since the last request paid a TLS handshake
+        pool = getattr(response.raw, "_pool", None)
+        handshakes = 0
+        if pool is not None:
+            with self._lock:
+                handshakes = pool.num_connections - self._pools.get(pool, 0)
+                self._pools[pool] = pool.num_connections
+        if handshakes > 0:
+            handshake_sent, handshake_received = wire_bytes(*HTTPS_HANDSHAKE)
+            sent += handshakes * handshake_sent
+            received += handshakes * handshake_received
+        self.record(category, sent, received)
+
+    @contextlib.contextmanager
+    def measure(self, category: str):
+        """Attribute the growth of the metered interface's counters during the block to a category."""
+        interface = metered_interface()
+        before = read_interface_counters(interface)
+        try:
+            yield
+        finally:
+            after = read_interface_counters(interface)
+            if before is not None and after is not None:
+                self.record(category, max(0, after[0] - before[0]), max(0, after[1] - before[1]))
+
+    def _sample_interface(self):
+        """Add the growth of the metered interface's counters since the last sample. Lock held."""
+        name = metered_interface()
+        raw = read_interface_counters(name)
+        if raw is None:
+            return
+        boot_id = _read_boot_id()
+        last = self._state.get("interface_raw")
+        if last is not None and self._state.get("boot_id") == boot_id:
+            if self._state.get("interface_name") != name:
+                # The uplink changed (e.g. Wi-Fi to 4G): start from the new interface's counters
+                delta = [0, 0]
+            else:
+                # A counter lower than before has wrapped around
+                delta = [value - previous if value >= previous else value for value, previous in zip(raw, last)]
+        else:
+            # First sample since boot: everything since boot belongs to this cycle
+            delta = list(raw)
+        interface = self._state["interface"]
+        interface[0] += delta[0]
+        interface[1] += delta[1]
+        self._state["interface_raw"] = list(raw)
+        self._state["interface_name"] = name
+        self._state["boot_id"] = boot_id
+
+    # Budget mode
+
+    def add_listener(self, listener):
+        """Call listener(budget) whenever budget mode starts or ends."""
+        self._listeners.append(listener)
+
+    def update(self):
+        """Periodic work (every ~30 s): keep-alive pings, interface counters, budget mode, saving."""
+        self._accrue_keepalive()
+        with self._lock:
+            self._roll_cycle(time.time())
+            self._sample_interface()
+        report = self.report()
+        budget = bool(self.cap_bytes) and (report["used"] >= self.threshold * self.cap_bytes
+                                           or (report["projected"] or 0) > self.cap_bytes)
+        if budget != self.budget:
+            self.budget = budget
+            logging.warning("bandwidth: Budget mode %s, %.1f of %.0f MB used, %s MB projected",
+                            "on" if budget else "off", report["used"] / _MB, self.cap_bytes / _MB,
+                            "%.0f" % (report["projected"] / _MB) if report["projected"] else "no")
+            for listener in self._listeners:
+                try:
+                    listener(budget)
+                except Exception as e:
+                    logging.error("bandwidth: Budget mode listener failed - %s", e)
+        if time.monotonic() - self._last_save >= SAVE_INTERVAL_S:
+            self.save()
+
+    def keep_alive(self, default_s: int) -> int:
+        return max(default_s, BUDGET_KEEP_ALIVE_S) if self.budget else default_s
+
+    def report(self) -> dict:
+        """Where the data of the current cycle went, in bytes."""
+        now = time.time()
+        with self._lock:
+            state = json.loads(json.dumps({key: self._state[key] for key in ("cycle", "categories", "interface")}))
+            state["interface_name"] = self._state.get("interface_name")
+        return summarize(state, self.cap_bytes, self.cycle_day, now, budget=self.budget)
+
+
+def summarize(cycle: dict, cap_bytes: int = 0, cycle_day: int = CYCLE_DAY, now: float = None,
+              budget: bool = None) -> dict:
+    """Report of one cycle: bytes per category, interface totals, unexplained remainder and projection."""
+    categories = {category: {"sent": sent, "received": received, "events": events}
+                  for category, (sent, received, events) in cycle["categories"].items()}
+    accounted = sum(counters["sent"] + counters["received"] for counters in categories.values())
+    measured = sum(cycle["interface"])
+    used = max(accounted, measured)
+    report = {
+        "cycle": cycle["cycle"],
+        "categories": categories,
+        "accounted": accounted,
+        "measured": measured or None,
+        "interface": cycle.get("interface_name"),
+        "other": max(0, measured - accounted),
+        "used": used,
+    }
+    if now is not None:
+        start = date.fromisoformat(cycle["cycle"])
+        _, end = cycle_bounds(_timestamp(start), cycle_day)
+        elapsed = now - _timestamp(start)
+        report["cycle_end"] = end.isoformat()
+        report["projected"] = (int(used * (_timestamp(end) - _timestamp(start)) / elapsed)
+                               if elapsed >= MIN_PROJECTION_S else None)
+    if cap_bytes:
+        report["cap"] = cap_bytes
+    if budget is not None:
+        report["budget_mode"] = budget
+    return report
+
+
+def print_report(report: dict):
+    def mb(value):
+        return f"{value / _MB:9.2f}"
+
+    used = report["used"]
+    print(f"Cycle from {report['cycle']}" + (f" to {report['cycle_end']}" if report.get("cycle_end") else ""))
+    print(f"{'category':<10} {'sent MB':>9} {'recv MB':>9} {'total MB':>9} {'share':>6} {'events':>8}")
+    rows = sorted(report["categories"].items(), key=lambda item: item[1]["sent"] + item[1]["received"],
+                  reverse=True)
+    for category, counters in rows:
+        total = counters["sent"] + counters["received"]
+        share = 100.0 * total / used if used else 0.0
+        print(f"{category:<10} {mb(counters['sent'])} {mb(counters['received'])} {mb(total)} "
+              f"{share:5.1f}% {counters['events']:>8}")
+    if report["measured"] is not None:
+        share = 100.0 * report["other"] / used if used else 0.0
+        print(f"{'other':<10} {'':>9} {'':>9} {mb(report['other'])} {share:5.1f}%")
+        where = f"interface {report['interface']}" if report.get("interface") else "the metered interface"
+        print(f"Measured on {where}: {report['measured'] / _MB:.2f} MB")
+    line = f"Used {used / _MB:.2f} MB"
+    if report.get("cap"):
+        line += f" of {report['cap'] / _MB:.0f} MB"
+    if report.get("projected"):
+        line += f", {report['projected'] / _MB:.0f} MB projected to the end of the cycle"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Data usage of the PagaLava IoT service per category")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser("report", help="Where the data of the billing cycle went")
+    report_parser.add_argument("--file", default=STATE_FILE, help="Counters file")
+    report_parser.add_argument("--history", action="store_true", help="Include the previous cycles")
+    report_parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    args = parser.parse_args()
+    try:
+        with open(args.file, 'r') as file:
+            state = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"No bandwidth counters in {args.file} ({e})")
+        return 1
+
+    cap_bytes = int(CAP_MB * _MB)
+    reports = [summarize(state, cap_bytes, CYCLE_DAY, time.time())]
+    if args.history:
+        reports += [summarize(cycle, cap_bytes) for cycle in reversed(state.get("history", []))]
+    for report in reports:
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_report(report)
+            print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+Filename: callback_outbox.py
+
+Outbox for HTTP callbacks to the backend.
+
+Callbacks are queued and sent by one background thread, so a slow or
+unreachable backend never holds up the message handler, and a callback that
+fails because of a network problem is retried with exponential backoff instead
+of being lost. Entries that are refused by the backend (4xx) are dropped, as are
+entries older than the maximum age or beyond the maximum queue length. Large,
+non-essential payloads (profiles) can be given a shorter age and a limit on
+attempts when they are posted.
+
+On a metered uplink callbacks can be coalesced: new entries are held for a few
+seconds, joining the batch already held, and the batch is then sent back to back
+over one connection instead of paying a TLS handshake for each callback.
+"""
+
+import logging
+import threading
+import time
+
+MAX_ENTRIES = 500
+MAX_AGE_S = 6 * 3600
+FIRST_RETRY_S = 5
+MAX_RETRY_S = 300
+TIMEOUT_S = 10
+
+
+class _Entry:
+    __slots__ = ("url", "payload", "label", "before_send", "created", "attempts", "next_attempt",
+                 "max_age_s", "max_attempts")
+
+    def __init__(self, url: str, payload: dict, label: str, before_send=None,
+                 max_age_s: float = None, max_attempts: int = None):
+        self.url = url
+        self.payload = payload
+        self.label = label
+        self.before_send = before_send
+        self.max_age_s = max_age_s
+        self.max_attempts = max_attempts
+        self.created = time.monotonic()
+        self.attempts = 0
+        self.next_attempt = self.created
+
+
+class CallbackOutbox:
+    """Queued, retried HTTP callbacks sent by a background thread."""
+
+    def __init__(self, session, max_entries: int = MAX_ENTRIES, max_age_s: float = MAX_AGE_S,
+                 timeout_s: float = TIMEOUT_S):
+        """
+        :param session: requests.Session (or anything with a compatible post method).
+        """
+        self.session = session
+        self.max_entries = max_entries
+        self.max_age_s = max_age_s
+        self.timeout_s = timeout_s
+
+        self._entries = []
+        self._cond = threading.Condition()
+        self.sent = 0
+        self.failed_attempts = 0
+        self.dropped = 0
+        self.coalesce_s = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="callback-outbox", daemon=True)
+        self._thread.start()
+
+    def post(self, url: str, payload: dict, label: str = "callback", before_send=None,
+             max_age_s: float = None, max_attempts: int = None):
+        """
+        Queue a JSON POST. Returns immediately.
+
+        :param before_send: Optional callable given the payload right before every attempt,
+                            e.g. to stamp the send time.
+        :param max_age_s: Drop the entry after this long instead of the outbox's maximum age.
+        :param max_attempts: Drop the entry after this many failed attempts (default: no limit).
+        """
+        with self._cond:
+            if len(self._entries) >= self.max_entries:
+                oldest = min(self._entries, key=lambda entry: entry.created)
+                self._entries.remove(oldest)
+                self.dropped += 1
+                logging.warning("callback_outbox: Queue full, dropped %s to %s", oldest.label, oldest.url)
+            entry = _Entry(url, payload, label, before_send, max_age_s, max_attempts)
+            if self.coalesce_s > 0:
+                # Join the batch being held, or start one
+                held = [item.next_attempt for item in self._entries
+                        if item.attempts == 0 and item.next_attempt > entry.created]
+                entry.next_attempt = min(held) if held else entry.created + self.coalesce_s
+            self._entries.append(entry)
+            self._cond.notify()
+
+    def set_coalesce(self, seconds: float):
+        """Hold new entries up to this long to send them together, 0 to send them right away."""
+        with self._cond:
+            self.coalesce_s = seconds
+            if not seconds:
+                now = time.monotonic()
+                for entry in self._entries:
+                    if entry.attempts == 0:
+                        entry.next_attempt = min(entry.next_attempt, now)
+            self._cond.notify()
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "depth": len(self._entries),
+                "sent": self.sent,
+                "failed_attempts": self.failed_attempts,
+                "dropped": self.dropped,
+                "coalesce_s": self.coalesce_s,
+            }
+
+    def _next_due(self):
+        """Wait for the entry with the earliest attempt time to be due and return it."""
+        with self._cond:
+            while True:
+                if not self._entries:
+                    self._cond.wait()
+                    continue
+                entry = min(self._entries, key=lambda item: item.next_attempt)
+                delay = entry.next_attempt - time.monotonic()
+                if delay <= 0:
+                    return entry
+                self._cond.wait(delay)
+
+    def _send(self, entry: _Entry):
+        entry.attempts += 1
+        if entry.before_send is not None:
+            try:
+                entry.before_send(entry.payload)
+            except Exception as e:
+                logging.warning("callback_outbox: before_send of %s failed - %s", entry.label, e)
+        try:
+            response = self.session.post(entry.url, json=entry.payload, timeout=self.timeout_s)
+            status_code = response.status_code
+        except Exception as e:
+            status_code = None
+            logging.warning("callback_outbox: %s to %s failed (attempt %d) - %s",
+                            entry.label, entry.url, entry.attempts, e)
+
+        with self._cond:
+            if status_code is not None and 200 <= status_code < 300:
+                self._entries.remove(entry)
+                self.sent += 1
+                logging.info("callback_outbox: %s sent to %s (status %s)", entry.label, entry.url, status_code)
+                return
+            if status_code is not None and 400 <= status_code < 500 and status_code not in (408, 429):
+                self._entries.remove(entry)
+                self.dropped += 1
+                logging.error("callback_outbox: %s refused by %s (status %s), dropped",
+                              entry.label, entry.url, status_code)
+                return
+
+            self.failed_attempts += 1
+            if status_code is not None:
+                logging.warning("callback_outbox: %s to %s failed with status %s (attempt %d)",
+                                entry.label, entry.url, status_code, entry.attempts)
+            max_age_s = self.max_age_s if entry.max_age_s is None else min(entry.max_age_s, self.max_age_s)
+            if (time.monotonic() - entry.created > max_age_s
+                    or (entry.max_attempts is not None and entry.attempts >= entry.max_attempts)):
+                self._entries.remove(entry)
+                self.dropped += 1
+                logging.error("callback_outbox: %s to %s expired after %d attempts",
+                              entry.label, entry.url, entry.attempts)
+                return
+            entry.next_attempt = time.monotonic() + min(MAX_RETRY_S, FIRST_RETRY_S * 2 ** (entry.attempts - 1))
+
+    def _run(self):
+        while True:
+            try:
+                self._send(self._next_due())
+            except Exception as e:
+                logging.error("callback_outbox: Unexpected error - %s", e)
+                time.sleep(1)
+
+    def flush(self, timeout_s: float) -> bool:
+        """Wait until the queue is empty or the timeout expires. Returns True if empty."""
+        deadline = time.monotonic() + timeout_s
+        while time.monotonic() < deadline:
+            if not self.depth():
+                return True
+            time.sleep(0.05)
+        return not self.depth()
@@ -12,6 +12,10 @@ a configuração e conectividade adequadas:
 4. Validade da string de conexão do IoT Hub
 5. Correção do ficheiro de configuração (config.json)
 6. Conectividade ao IoT Hub
+7. Contadores de desgaste dos relés
+8. Tempos de rede (DNS, TCP, TLS, TTFB) para o IoT Hub e a dashboard
+
+Com --watch as verificações repetem-se continuamente e o ecrã mostra apenas as alterações.
 """
 
 import os
@@ -27,10 +31,15 @@ from datetime import datetime
 import requests
 import uuid
 
-from dotenv import load_dotenv
+from dotenv import dotenv_values, load_dotenv
 from azure.iot.device import IoTHubDeviceClient
 from azure.iot.device import exceptions as iot_exceptions
 
+import relay_counters
+from paths import DIAGNOSTICS_DIR
+import net_probe
+import integrity
+
 # Configurar logging
 logging.basicConfig(
     level=logging.INFO,
@@ -42,6 +51,25 @@ logger = logging.getLogger(__name__)
 REQUIRED_FILES = [
     "ReceiveMessages.py",
     "relay_ops.py",
+    "sd_notify.py",
+    "memory_stats.py",
+    "relay_backends.py",
+    "relay_counters.py",
+    "activation_ledger.py",
+    "pulse_scheduler.py",
+    "inflight_journal.py",
+    "machine_state.py",
+    "heartbeat.py",
+    "callback_outbox.py",
+    "net_probe.py",
+    "sampling_profiler.py",
+    "latency_trace.py",
+    "usage_store.py",
+    "integrity.py",
+    "log_bundle.py",
+    "handler_watchdog.py",
+    "bandwidth.py",
+    "paths.py",
     "requirements.txt",
     "config.json",
     "version.json",
@@ -94,28 +122,8 @@ def check_internet_connectivity():
         error("Falha na resolução DNS - não é possível resolver nomes de domínio")
         return False
     
-    # Método 2: Teste de ping
-    try:
-        result = subprocess.run(
-            ["ping", "-c", "3", "8.8.8.8"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=10
-        )
-        
-        if result.returncode == 0:
-            ping_output = result.stdout.strip().split("\n")[-1]
-            if "0% packet loss" in result.stdout:
-                success(f"Teste de ping bem-sucedido: {ping_output}")
-            else:
-                warning(f"Teste de ping concluído com alguma perda de pacotes: {ping_output}")
-        else:
-            error("Falha no teste de ping")
-    except (subprocess.TimeoutExpired, subprocess.SubprocessError) as e:
-        error(f"Erro no teste de ping: {str(e)}")
-    
-    # Método 3: Pedido HTTP
+    # Método 2: Pedido HTTP (o ping é bloqueado em muitas redes das lojas;
+    # os tempos detalhados estão em check_network_timing)
     try:
         response = requests.get("https://azure.microsoft.com", timeout=10)
         if response.status_code == 200:
@@ -128,6 +136,41 @@ def check_internet_connectivity():
     
     return True
 
+def dashboard_host(env):
+    """Host da dashboard PagaLava para o ambiente (mesma regra que determine_environment)"""
+    return "digipay2-dashboard-dev.azurewebsites.net" if env == "dev" else "digipay2-dashboard.azurewebsites.net"
+
+def check_network_timing(environment, samples=5):
+    """
+    Mede separadamente os tempos de DNS, ligação TCP, handshake TLS e primeiro byte
+    (TTFB) para o IoT Hub e para a dashboard, em várias amostras, sem subprocessos.
+    Apenas informativo: mostra onde se perde o tempo quando as ativações estão lentas.
+    """
+    header("TEMPOS DE REDE")
+
+    hosts = [("IoT Hub", environment["hostname"]), ("Dashboard", dashboard_host(environment["env"]))]
+    all_ok = True
+    for label, host in hosts:
+        info(f"{label} ({host}): {samples} amostras")
+        summary = net_probe.probe(host, samples=samples)
+
+        for phase in net_probe.PHASES:
+            stats = summary["phases"].get(phase)
+            if stats:
+                print(f"    {phase.upper():5} p50 {stats['p50']:8.1f} ms   p95 {stats['p95']:8.1f} ms   max {stats['max']:8.1f} ms")
+        if summary.get("status"):
+            info(f"Resposta: {summary['status']} ({summary.get('address', '?')})")
+
+        if summary["errors"]:
+            all_ok = False
+            for failure in sorted(set(summary["errors"])):
+                error(f"{label}: {summary['errors'].count(failure)}/{samples} amostras falharam em {failure}")
+        else:
+            slowest = max(summary["phases"].items(), key=lambda item: item[1]["p50"], default=None)
+            if slowest:
+                success(f"{label}: todas as amostras concluídas, fase mais lenta {slowest[0].upper()} ({slowest[1]['p50']:.0f} ms p50)")
+    return all_ok
+
 def get_version():
     """Obtém a versão atual do software do version.json"""
     header("VERSÃO DO SOFTWARE")
@@ -173,7 +216,6 @@ def check_required_files():
     
     if not missing_files and not empty_files:
         success("Todos os ficheiros necessários estão presentes e não estão vazios")
-        return True
     
     if missing_files:
         error(f"Ficheiros em falta: {', '.join(missing_files)}")
@@ -181,6 +223,28 @@ def check_required_files():
     if empty_files:
         error(f"Ficheiros vazios: {', '.join(empty_files)}")
     
+    return check_manifest() and not missing_files and not empty_files
+
+def check_manifest():
+    """Compara os ficheiros instalados com os SHA-256 do manifesto da versão (manifest.json)"""
+    try:
+        result = integrity.verify()
+    except Exception as e:
+        warning(f"Não foi possível verificar o manifesto: {str(e)}")
+        return True
+    if result["status"] == "no_manifest":
+        info("Sem manifest.json: a integridade dos ficheiros não foi verificada")
+        return True
+    if result["status"] == "ok":
+        success(f"Ficheiros idênticos ao manifesto da versão {result['version']} "
+                f"({result['checked']} ficheiros, {result['hashed']} lidos)")
+        return True
+    if result.get("error"):
+        error(f"Manifesto inválido: {result['error']}")
+    if result.get("missing"):
+        error(f"Em falta face ao manifesto: {', '.join(result['missing'])}")
+    if result.get("modified"):
+        error(f"Diferentes do manifesto (atualização incompleta ou cartão corrompido): {', '.join(result['modified'])}")
     return False
 
 def check_connection_string():
@@ -307,10 +371,117 @@ def check_config_json():
         error(f"Erro ao analisar config.json: {str(e)}")
         return False  # Erro ao processar o arquivo é crítico
 
+def check_relay_counters():
+    """Mostra os contadores de desgaste dos relés (ativações e tempo ligado)"""
+    header("DESGASTE DOS RELÉS")
+
+    try:
+        counters = relay_counters.read_counters()
+    except Exception as e:
+        warning(f"Não foi possível ler os contadores dos relés: {str(e)}")
+        return True  # Os contadores são informativos, não são erro crítico
+
+    if counters is None:
+        info("Ficheiro de contadores ainda não existe (nenhuma ativação registada)")
+        return True
+
+    if not counters:
+        info("Nenhuma ativação registada até ao momento")
+        return True
+
+    for relay_number, relay_data in sorted(counters.items()):
+        on_time_h = relay_data['on_time_s'] / 3600.0
+        info(f"Relé {relay_number}: {relay_data['actuations']} ativações, " +
+             f"{on_time_h:.2f} h ligado, " +
+             f"última ativação {relay_data['last_actuation']}")
+
+    return True
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DIAGNOSTIC_DIR = DIAGNOSTICS_DIR
+VERIFICATION_FILE = os.path.join(DIAGNOSTIC_DIR, "verification_code.txt")
+# O serviço avisa neste socket quando recebe um código de verificação (ver message_diagnostic)
+PROBE_SOCKET = os.path.join(DIAGNOSTIC_DIR, "probe.sock")
+
+def open_probe_socket():
+    """Cria o socket local onde o serviço notifica a receção dos códigos de verificação"""
+    os.makedirs(DIAGNOSTIC_DIR, exist_ok=True)
+    try:
+        os.unlink(PROBE_SOCKET)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(PROBE_SOCKET)
+    # O serviço pode correr com outro utilizador
+    os.chmod(PROBE_SOCKET, 0o666)
+    return sock
+
+def close_probe_socket(sock):
+    sock.close()
+    try:
+        os.unlink(PROBE_SOCKET)
+    except FileNotFoundError:
+        pass
+
+def parse_iot_connection_string(connection_string):
+    """Extrai o ID do dispositivo, o hostname e a URL da API de verificação"""
+    device_id_match = re.search(r'DeviceId=([^;]+)', connection_string)
+    hostname_match = re.search(r'HostName=([^;]+)', connection_string)
+    if not device_id_match or not hostname_match:
+        return None
+    hostname = hostname_match.group(1)
+    env = "dev" if "IoTHub-dev" in hostname else "prod"
+    api_url = f"https://{dashboard_host(env)}/api/laundries/iot/verify_device"
+    return device_id_match.group(1), hostname, api_url
+
+def wait_for_verification(verification_code, sock, max_wait_time=60, show_progress=True):
+    """
+    Espera pelo código de verificação. Com o socket local a chegada é detetada de
+    imediato e o serviço indica a hora de receção da mensagem e a hora a que o IoT Hub
+    a pôs em fila; com versões antigas do serviço, que apenas gravam o ficheiro, este é
+    verificado a cada 250 ms.
+
+    :return: Tuplo (estado, hora de receção no dispositivo, código recebido, hora de entrada
+             na fila do IoT Hub ou None), com estado "ok", "mismatch" ou "timeout".
+    """
+    start_time = time.time()
+    last_progress = start_time
+    sock.settimeout(0.25)
+
+    while (time.time() - start_time) < max_wait_time:
+        try:
+            data = sock.recv(4096)
+            notification = json.loads(data.decode('utf-8'))
+            if notification.get("verification_code") == verification_code:
+                if os.path.exists(VERIFICATION_FILE):
+                    os.remove(VERIFICATION_FILE)
+                enqueued_at = notification.get("enqueued_at")
+                return ("ok", float(notification.get("received_at") or time.time()), verification_code,
+                        float(enqueued_at) if enqueued_at else None)
+            # Notificação atrasada de uma amostra anterior
+        except socket.timeout:
+            pass
+        except (ValueError, OSError) as e:
+            warning(f"Notificação inválida no socket de diagnóstico: {str(e)}")
+
+        if os.path.exists(VERIFICATION_FILE):
+            with open(VERIFICATION_FILE, 'r') as file:
+                received_code = file.read().strip()
+            os.remove(VERIFICATION_FILE)
+            if received_code == verification_code:
+                return "ok", time.time(), received_code, None
+            return "mismatch", None, received_code, None
+
+        if show_progress and time.time() - last_progress >= 2:
+            last_progress = time.time()
+            info(f"A aguardar resposta... {int(last_progress - start_time)}s/{max_wait_time}s")
+
+    return "timeout", None, None, None
+
 def check_iot_hub_connection_via_cloud(connection_string):
     """
     Verifica a conectividade ao IoT Hub enviando uma mensagem para a API 
-    e esperando que o dispositivo a receba e escreva um ficheiro.
+    e esperando que o dispositivo a receba e a notifique.
     """
     header("CONECTIVIDADE AO IOT HUB")
     
@@ -334,24 +505,16 @@ def check_iot_hub_connection_via_cloud(connection_string):
         # Não retornamos False para permitir teste mesmo sem systemd
     
     # Extrair informações da string de conexão
-    device_id_match = re.search(r'DeviceId=([^;]+)', connection_string)
-    hostname_match = re.search(r'HostName=([^;]+)', connection_string)
-    
-    if not device_id_match or not hostname_match:
+    parsed = parse_iot_connection_string(connection_string)
+    if parsed is None:
         error("Não foi possível extrair o ID do dispositivo ou hostname da string de conexão")
         return False
-    
-    device_id = device_id_match.group(1)
-    hostname = hostname_match.group(1)
+    device_id, hostname, api_url = parsed
     
     # Gerar código de verificação único
     verification_code = str(uuid.uuid4())
     info(f"Código de verificação gerado: {verification_code[:8]}...")
     
-    # Determinar o ambiente e URL da API
-    env = "dev" if "IoTHub-dev" in hostname else "prod"
-    api_url = f"https://digipay2-dashboard{'-dev' if env == 'dev' else ''}.azurewebsites.net/api/laundries/iot/verify_device"
-    
     # Dados para enviar à API
     payload = {
         "device_id": device_id,
@@ -360,8 +523,12 @@ def check_iot_hub_connection_via_cloud(connection_string):
     
     info(f"A enviar pedido de diagnóstico para: {api_url}")
     
+    sock = None
     try:
+        sock = open_probe_socket()
+
         # Enviar pedido para a API
+        sent_at = time.time()
         response = requests.post(api_url, json=payload, timeout=15)
         
         if response.status_code != 200:
@@ -372,40 +539,19 @@ def check_iot_hub_connection_via_cloud(connection_string):
         
         info("Pedido de diagnóstico enviado com sucesso. A aguardar resposta do dispositivo...")
         
-        # Caminho para o ficheiro de verificação
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        diagnostic_dir = os.path.join(script_dir, "diagnostics")
-        verification_file = os.path.join(diagnostic_dir, "verification_code.txt")
-        
-        # Aguardar até 60 segundos pelo ficheiro de verificação
         max_wait_time = 60
-        start_time = time.time()
-        
-        while (time.time() - start_time) < max_wait_time:
-            if os.path.exists(verification_file):
-                try:
-                    with open(verification_file, 'r') as file:
-                        received_code = file.read().strip()
-                    
-                    # Verificar se o código recebido corresponde ao enviado
-                    if received_code == verification_code:
-                        success("Código de verificação recebido corretamente!")
-                        success("Comunicação bidirecional com o IoT Hub confirmada")
-                        
-                        # Limpar ficheiro de verificação
-                        os.remove(verification_file)
-                        return True
-                    else:
-                        error(f"Código de verificação não corresponde! Esperado: {verification_code}, Recebido: {received_code}")
-                        os.remove(verification_file)
-                        return False
-                except Exception as e:
-                    error(f"Erro ao ler ficheiro de verificação: {str(e)}")
-                    return False
-            
-            # Aguardar 2 segundos antes de verificar novamente
-            time.sleep(2)
-            info(f"A aguardar resposta... {int(time.time() - start_time)}s/{max_wait_time}s")
+        status, received_at, received_code, enqueued_at = wait_for_verification(verification_code, sock, max_wait_time)
+
+        if status == "ok":
+            success("Código de verificação recebido corretamente!")
+            success("Comunicação bidirecional com o IoT Hub confirmada")
+            info(f"Latência C2D: {(received_at - sent_at) * 1000:.0f} ms desde o pedido à API")
+            if enqueued_at is not None:
+                info(f"Latência do IoT Hub (fila → dispositivo): {(received_at - enqueued_at) * 1000:.0f} ms")
+            return True
+        if status == "mismatch":
+            error(f"Código de verificação não corresponde! Esperado: {verification_code}, Recebido: {received_code}")
+            return False
         
         error(f"Timeout após {max_wait_time} segundos. Nenhuma resposta recebida do IoT Hub.")
         return False
@@ -416,6 +562,104 @@ def check_iot_hub_connection_via_cloud(connection_string):
     except Exception as e:
         error(f"Erro inesperado durante verificação: {str(e)}")
         return False
+    finally:
+        if sock is not None:
+            close_probe_socket(sock)
+
+def check_c2d_latency(connection_string, probes, max_wait_time=60):
+    """
+    Mede a latência de entrega C2D com várias mensagens de verificação seguidas.
+    A latência do IoT Hub vai da entrada da mensagem na fila (hora do IoT Hub) até à
+    receção no serviço; o pedido à API do backend, que a antecede, é medido à parte.
+    Depende de o relógio do dispositivo estar acertado (NTP). Com versões antigas do
+    serviço, sem a hora de entrada na fila, só é apresentado o total.
+    """
+    header("LATÊNCIA C2D")
+
+    parsed = parse_iot_connection_string(connection_string)
+    if parsed is None:
+        error("Não foi possível extrair o ID do dispositivo ou hostname da string de conexão")
+        return False
+    device_id, _, api_url = parsed
+
+    latencies = []
+    hub_latencies = []
+    lost = 0
+    sock = open_probe_socket()
+    try:
+        for index in range(probes):
+            verification_code = str(uuid.uuid4())
+            sent_at = time.time()
+            try:
+                response = requests.post(api_url, json={"device_id": device_id, "verification_code": verification_code}, timeout=15)
+            except requests.RequestException as e:
+                error(f"Amostra {index + 1}: erro ao comunicar com a API: {str(e)}")
+                lost += 1
+                continue
+            if response.status_code != 200:
+                error(f"Amostra {index + 1}: a API respondeu com o código de estado {response.status_code}")
+                lost += 1
+                continue
+
+            status, received_at, _, enqueued_at = wait_for_verification(verification_code, sock, max_wait_time,
+                                                                        show_progress=False)
+            if status != "ok":
+                warning(f"Amostra {index + 1}: sem resposta ({status})")
+                lost += 1
+                continue
+            latency_ms = (received_at - sent_at) * 1000.0
+            latencies.append(latency_ms)
+            if enqueued_at is not None:
+                hub_ms = (received_at - enqueued_at) * 1000.0
+                hub_latencies.append(hub_ms)
+                info(f"Amostra {index + 1}/{probes}: IoT Hub {hub_ms:.0f} ms, total {latency_ms:.0f} ms")
+            else:
+                info(f"Amostra {index + 1}/{probes}: total {latency_ms:.0f} ms")
+    finally:
+        close_probe_socket(sock)
+
+    if not latencies:
+        error(f"Nenhuma das {probes} amostras foi recebida")
+        return False
+
+    series = [("IoT Hub (fila → dispositivo)", hub_latencies)] if hub_latencies else []
+    series.append(("Total (pedido à API → dispositivo)", latencies))
+    for label, values in series:
+        print(f"    {label:<36} p50 {net_probe.percentile(values, 0.50):8.0f} ms   "
+              f"p95 {net_probe.percentile(values, 0.95):8.0f} ms   max {max(values):8.0f} ms")
+    if lost:
+        warning(f"{lost}/{probes} amostras perdidas")
+        return False
+    success(f"{probes} amostras recebidas")
+    return True
+
+def get_service_status_text():
+    """Obtém o estado reportado pelo próprio serviço ao systemd (sd_notify STATUS=)"""
+    try:
+        return subprocess.run(
+            ["systemctl", "show", "receive_messages.service", "-p", "StatusText", "--value"],
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+def check_reported_connection(status_text):
+    """
+    Compara as lavandarias ligadas com as configuradas no estado do serviço, "(ligadas/total devices)".
+    Devolve None se o estado não indicar as contagens.
+    """
+    match = re.search(r"\((\d+)/(\d+) devices\)", status_text or "")
+    if not match:
+        return None
+    connected, total = int(match.group(1)), int(match.group(2))
+    if total and connected == total:
+        success(f"O serviço confirma que está conectado ao IoT Hub ({connected}/{total} dispositivos)")
+        return True
+    if connected:
+        warning(f"Só {connected} de {total} dispositivos estão conectados ao IoT Hub")
+    else:
+        error(f"O serviço não está conectado ao IoT Hub (0/{total} dispositivos)")
+    return False
 
 def check_service_status_only():
     """Verifica apenas o estado do serviço, sem tentar conexão direta ao IoT Hub"""
@@ -431,6 +675,14 @@ def check_service_status_only():
         if service_status == "active":
             success("Serviço receive_messages está ativo")
             
+            # O serviço reporta o seu estado ao systemd, não é preciso adivinhar pelos logs
+            status_text = get_service_status_text()
+            if status_text:
+                info(f"Estado reportado pelo serviço: {status_text}")
+                reported = check_reported_connection(status_text)
+                if reported is not None:
+                    return reported
+            
             # Verificar logs do serviço para confirmar conectividade
             try:
                 # Obter os logs mais recentes, limitados a 50 linhas
@@ -483,6 +735,17 @@ def check_service_and_connectivity(connection_string):
         if service_status == "active":
             success("Serviço receive_messages está ativo")
             
+            # O serviço reporta o seu estado ao systemd, não é preciso adivinhar pelos logs
+            status_text = get_service_status_text()
+            if status_text:
+                info(f"Estado reportado pelo serviço: {status_text}")
+            reported = check_reported_connection(status_text)
+            if reported:
+                return True
+            if reported is False:
+                # Os logs podem ter "Connected to IoT Hub" de uma ligação que já caiu
+                return check_iot_hub_connection_via_cloud(connection_string)
+            
             # Verificar logs do serviço para confirmar conectividade
             try:
                 # Obter os logs mais recentes, limitados a 50 linhas
@@ -559,10 +822,256 @@ def create_quick_test_report(results):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"\nDiagnóstico concluído em: {timestamp}")
 
+# ---------------------------------------------------------------------------
+# Modo contínuo (--watch)
+# ---------------------------------------------------------------------------
+
+WATCH_TICK_S = 2
+WATCH_MAX_CHANGES = 12
+
+def file_signature(*paths):
+    """(mtime, tamanho) de cada ficheiro, None se não existir; muda quando o ficheiro é alterado"""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None))
+    return tuple(signature)
+
+def directory_signature(directory):
+    """Assinatura dos ficheiros de um diretório (nomes, mtime e tamanho), sem os ler"""
+    try:
+        return tuple(sorted((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                            for entry in os.scandir(directory) if entry.is_file()))
+    except OSError:
+        return None
+
+def network_signature():
+    """Estado das interfaces de rede, rotas e DNS; muda quando o cabo ou o Wi-Fi mudam de estado"""
+    signature = []
+    try:
+        for name in sorted(os.listdir("/sys/class/net")):
+            if name == "lo":
+                continue
+            try:
+                with open(f"/sys/class/net/{name}/operstate") as file:
+                    signature.append((name, file.read().strip()))
+            except OSError:
+                signature.append((name, None))
+    except OSError:
+        pass
+    try:
+        with open("/proc/net/route") as file:
+            signature.append(file.read())
+    except OSError:
+        pass
+    signature.append(file_signature("/etc/resolv.conf"))
+    return tuple(signature)
+
+def service_signature():
+    """Estado e PID do serviço; muda quando o serviço é reiniciado ou parado"""
+    try:
+        return subprocess.run(
+            ["systemctl", "show", "receive_messages.service", "-p", "ActiveState", "-p", "MainPID", "--value"],
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except Exception:
+        return None
+
+class WatchedCheck:
+    """
+    Uma verificação do modo contínuo. As verificações baratas repetem-se a cada
+    interval_s; as caras (interval_s None) só quando a assinatura das suas
+    entradas (inputs) muda. requires lista verificações que têm de ter passado.
+    """
+
+    def __init__(self, name, label, run, interval_s=None, inputs=None, requires=()):
+        self.name = name
+        self.label = label
+        self.run = run
+        self.interval_s = interval_s
+        self.inputs = inputs
+        self.requires = requires
+        self.ok = None
+        self.lines = []
+        self.ran_at = None
+        self.duration_s = 0.0
+        self.signature = None
+        self.skipped = False
+
+    def due(self, now, results):
+        if any(results.get(name) is not True for name in self.requires):
+            return False
+        if self.ran_at is None:
+            return True
+        if self.interval_s is not None and now - self.ran_at >= self.interval_s:
+            return True
+        return self.inputs is not None and self.inputs() != self.signature
+
+def run_captured(function):
+    """Executa uma verificação guardando o que ela imprime, para mostrar só as diferenças"""
+    import contextlib
+    import io
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        try:
+            value = function()
+        except Exception as e:
+            error(f"Erro inesperado: {str(e)}")
+            value = False
+    return value, buffer.getvalue().splitlines()
+
+def watch_checks(samples, env_holder):
+    """Verificações do modo contínuo, das mais baratas às mais caras"""
+    env_file = os.path.join(SCRIPT_DIR, ".env")
+    config_file = os.path.join(SCRIPT_DIR, "config.json")
+
+    loaded_env = {"signature": None, "keys": set()}
+
+    def connection_string():
+        signature = file_signature(env_file)
+        if signature != loaded_env["signature"]:
+            # O .env mudou: sem override, os.environ ficava com os valores da primeira leitura
+            values = dotenv_values(env_file)
+            for key in loaded_env["keys"] - set(values):
+                os.environ.pop(key, None)
+            load_dotenv(env_file, override=True)
+            loaded_env["signature"], loaded_env["keys"] = signature, set(values)
+        ok, environment = check_connection_string()
+        env_holder["environment"] = environment
+        return ok
+
+    return [
+        WatchedCheck("files", "Ficheiros", check_required_files,
+                     inputs=lambda: directory_signature(SCRIPT_DIR)),
+        WatchedCheck("version", "Versão", lambda: get_version() != "Desconhecida",
+                     inputs=lambda: file_signature(os.path.join(SCRIPT_DIR, "version.json"))),
+        WatchedCheck("connection_string", "String de conexão", connection_string,
+                     inputs=lambda: file_signature(env_file)),
+        WatchedCheck("config", "config.json", check_config_json,
+                     inputs=lambda: file_signature(config_file)),
+        WatchedCheck("relays", "Desgaste dos relés", check_relay_counters, interval_s=15),
+        WatchedCheck("service", "Serviço", check_service_status_only, interval_s=10),
+        WatchedCheck("internet", "Internet", check_internet_connectivity, interval_s=30),
+        WatchedCheck("network_timing", "Tempos de rede",
+                     lambda: check_network_timing(env_holder["environment"], samples=samples),
+                     inputs=lambda: (network_signature(), file_signature(env_file)),
+                     requires=("internet", "connection_string")),
+        WatchedCheck("iot_hub", "IoT Hub (ida e volta)",
+                     lambda: check_iot_hub_connection_via_cloud(os.getenv("IOT_CONNECTION_STRING")),
+                     inputs=lambda: (network_signature(), file_signature(env_file), service_signature()),
+                     requires=("internet", "connection_string")),
+    ]
+
+def _age_text(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f} s"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds / 3600:.1f} h"
+
+def draw_watch(checks, changes, running=None):
+    """Redesenha o ecrã no lugar: estado de cada verificação e as últimas alterações"""
+    import shutil
+    width = shutil.get_terminal_size((100, 40)).columns
+    now = time.monotonic()
+    labels = {check.name: check.label for check in checks}
+    out = ["\033[H\033[J"]
+    out.append(f"{Colors.BOLD}DIAGNÓSTICO CONTÍNUO PAGALAVA{Colors.ENDC}  "
+               f"{datetime.now().strftime('%H:%M:%S')}  (Ctrl+C para sair)\n\n")
+    for check in checks:
+        if check.name == running:
+            symbol, color = "…", Colors.BLUE
+        elif check.ok is None:
+            symbol, color = "-", Colors.BLUE
+        elif check.ok:
+            symbol, color = "✓", Colors.GREEN
+        else:
+            symbol, color = "✗", Colors.RED
+        if check.name == running:
+            detail = "a verificar"
+        elif check.skipped:
+            detail = "à espera de: " + ", ".join(labels[name] for name in check.requires)
+        elif check.ran_at is None:
+            detail = "pendente"
+        else:
+            when = f"há {_age_text(now - check.ran_at)} ({check.duration_s:.1f} s)"
+            renew = (f"a cada {_age_text(check.interval_s)}" if check.interval_s is not None
+                     else "quando as entradas mudarem")
+            detail = f"{when}, {renew}"
+        out.append(f"{color}{symbol} {check.label:<24}{Colors.ENDC} {detail}\n")
+
+    if changes:
+        out.append(f"\n{Colors.HEADER}{Colors.BOLD}==== ALTERAÇÕES ===={Colors.ENDC}\n")
+        for stamp, label, transition, lines in changes:
+            out.append(f"{stamp} {label}: {transition}\n")
+            for line in lines:
+                out.append(f"    {line[:width - 4]}\n")
+
+    failed = [check for check in checks if check.ok is False and check.name != running]
+    if failed:
+        out.append(f"\n{Colors.HEADER}{Colors.BOLD}==== FALHAS ===={Colors.ENDC}\n")
+        for check in failed:
+            for line in check.lines:
+                if "✗" in line or "⚠" in line:
+                    out.append(f"  {line[:width - 2]}\n")
+    sys.stdout.write("".join(out))
+    sys.stdout.flush()
+
+def watch(samples):
+    """
+    Modo contínuo: mantém os resultados em memória, repete as verificações baratas
+    periodicamente e as caras (tempos de rede, ida e volta pelo IoT Hub) só quando
+    .env, config.json, os ficheiros, a rede ou o serviço mudam. Mostra apenas as diferenças.
+    """
+    import collections
+    import difflib
+
+    env_holder = {"environment": None}
+    checks = watch_checks(samples, env_holder)
+    changes = collections.deque(maxlen=WATCH_MAX_CHANGES)
+    try:
+        while True:
+            results = {check.name: check.ok for check in checks}
+            for check in checks:
+                now = time.monotonic()
+                if not check.due(now, results):
+                    if any(results.get(name) is not True for name in check.requires) and not check.skipped:
+                        # Resultado antigo deixa de valer; volta a correr quando os pré-requisitos passarem
+                        check.skipped, check.ok, check.ran_at = True, None, None
+                    continue
+                draw_watch(checks, changes, running=check.name)
+                signature = check.inputs() if check.inputs is not None else None
+                started = time.monotonic()
+                ok, lines = run_captured(check.run)
+                ok = bool(ok)
+
+                first_run = check.ran_at is None
+                if not first_run and (ok != check.ok or lines != check.lines):
+                    transition = ("OK" if check.ok else "FALHA") + " → " + ("OK" if ok else "FALHA")
+                    diff = [line for line in difflib.unified_diff(check.lines, lines, lineterm="", n=0)
+                            if line[:1] in "+-" and not line.startswith(("+++", "---"))]
+                    changes.appendleft((datetime.now().strftime("%H:%M:%S"), check.label, transition, diff[:8]))
+                check.ok, check.lines, check.signature = ok, lines, signature
+                check.ran_at, check.duration_s, check.skipped = time.monotonic(), time.monotonic() - started, False
+                results[check.name] = ok
+            draw_watch(checks, changes)
+            time.sleep(WATCH_TICK_S)
+    except KeyboardInterrupt:
+        print()
+        return 0 if all(check.ok for check in checks) else 1
+
 def main():
     """Função principal que executa todos os diagnósticos"""
     parser = argparse.ArgumentParser(description='Ferramenta de Diagnóstico de Dispositivo IoT PagaLava')
     parser.add_argument('--verbose', '-v', action='store_true', help='Ativar saída detalhada')
+    parser.add_argument('--samples', type=int, default=5, help='Número de amostras nos tempos de rede')
+    parser.add_argument('--latency-probe', type=int, metavar='N',
+                        help='Apenas medir a latência C2D com N mensagens de verificação')
+    parser.add_argument('--watch', '-w', action='store_true',
+                        help='Modo contínuo: repete as verificações e mostra apenas as alterações')
     args = parser.parse_args()
     
     if args.verbose:
@@ -570,6 +1079,15 @@ def main():
     
     print(f"{Colors.BOLD}FERRAMENTA DE DIAGNÓSTICO DE DISPOSITIVO IOT DIGIPAY{Colors.ENDC}")
     print(f"A executar diagnósticos em {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    if args.latency_probe:
+        conn_string_ok, _ = check_connection_string()
+        if not conn_string_ok:
+            return 1
+        return 0 if check_c2d_latency(os.getenv("IOT_CONNECTION_STRING"), args.latency_probe) else 1
+
+    if args.watch:
+        return watch(samples=max(1, args.samples))
     
     # Executar todas as verificações
     internet_ok = check_internet_connectivity()
@@ -577,6 +1095,9 @@ def main():
     files_ok = check_required_files()
     conn_string_ok, env_info = check_connection_string()
     config_ok = check_config_json()  # Agora retorna True mesmo sem config.json
+    if internet_ok and conn_string_ok:
+        check_network_timing(env_info, samples=max(1, args.samples))  # Apenas informativo
+    check_relay_counters()  # Apenas informativo
     
     # Verificar conectividade IoT, não apenas estado do serviço
     iot_service_ok = False
@@ -0,0 +1,157 @@
+"""
+Filename: handler_watchdog.py
+
+Runs every C2D message handler in its own worker thread under a per-type
+deadline, so one stuck handler (an HTTP call without a timeout, a hanging
+git, a slow backend) never silences the device for longer than its budget.
+
+The receive path waits for the handler up to its deadline, which keeps
+messages in order as before. When the deadline passes, the watchdog:
+    - records the handler's stack in the log and in diagnostics/stuck_handler_*.txt
+    - cancels it, if its type is cancellable, by raising HandlerCancelled in
+      the worker thread (delivered as soon as it returns to Python code, so a
+      blocking call is cancelled when it returns or times out). The exception
+      can land anywhere, including inside a library holding a lock or a pooled
+      connection, so only handlers that share nothing may be cancellable; the
+      others are abandoned: left to finish on their own, reported as stuck
+    - frees the receive path for the next message
+
+Handlers that are still running after that are reported as stuck until they
+finish; they are counted so the service can give up (systemd watchdog) if
+they keep piling up.
+"""
+
+import collections
+import ctypes
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from paths import DIAGNOSTICS_DIR
+
+STACK_DIR = DIAGNOSTICS_DIR
+
+CANCEL_GRACE_S = 2.0
+MAX_STACK_FILES = 20
+
+
+class HandlerCancelled(BaseException):
+    """Raised in a handler that exceeded its deadline (BaseException, so `except Exception` does not swallow it)."""
+
+
+def _raise_in_thread(thread_id: int, exception_type) -> bool:
+    result = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), ctypes.py_object(exception_type))
+    if result > 1:
+        # More than one thread state modified: undo, as the C API documentation requires
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), None)
+        return False
+    return result == 1
+
+
+class HandlerRunner:
+    """Runs handlers in worker threads with deadlines and keeps track of the ones that overran."""
+
+    def __init__(self, stack_dir: str = STACK_DIR):
+        self.stack_dir = stack_dir
+        self._lock = threading.Lock()
+        self._running = {}  # thread id -> (name, started at, deadline in s)
+        self._stuck = set()
+        self.timeouts = collections.Counter()
+        self.cancelled = collections.Counter()
+
+    def run(self, name: str, target, deadline_s: float, cancellable: bool = True, setup=None) -> bool:
+        """
+        Run target() in a worker thread and wait for it up to deadline_s.
+
+        :param setup: Optional callable run first in the worker (e.g. to copy thread-local context).
+        :return: True if the handler finished within its deadline.
+        """
+        finished = threading.Event()
+
+        def finish(thread_id):
+            with self._lock:
+                _, started_at, _ = self._running.pop(thread_id, (name, time.monotonic(), deadline_s))
+                late = thread_id in self._stuck
+                self._stuck.discard(thread_id)
+            if late:
+                logging.warning("handler_watchdog: Stuck %s handler finished after %.1f s",
+                                name, time.monotonic() - started_at)
+            finished.set()
+
+        def worker():
+            thread_id = threading.get_ident()
+            with self._lock:
+                self._running[thread_id] = (name, time.monotonic(), deadline_s)
+            try:
+                if setup is not None:
+                    setup()
+                target()
+            except HandlerCancelled:
+                logging.warning("handler_watchdog: %s handler cancelled", name)
+            except Exception:
+                logging.exception("handler_watchdog: %s handler failed", name)
+            finally:
+                # A cancellation raised just as the handler returned may land here; finish() is idempotent
+                while True:
+                    try:
+                        finish(thread_id)
+                        break
+                    except HandlerCancelled:
+                        continue
+
+        thread = threading.Thread(target=worker, name=f"handler-{name}", daemon=True)
+        thread.start()
+        if finished.wait(deadline_s):
+            return True
+
+        self.timeouts[name] += 1
+        self._record_stack(name, thread, deadline_s)
+        if cancellable:
+            with self._lock:
+                # Only while the handler is still registered, never into a thread that is cleaning up
+                cancelled = thread.ident in self._running and _raise_in_thread(thread.ident, HandlerCancelled)
+            if cancelled:
+                self.cancelled[name] += 1
+                if finished.wait(CANCEL_GRACE_S):
+                    return False
+        with self._lock:
+            if thread.ident in self._running:
+                self._stuck.add(thread.ident)
+        logging.error("handler_watchdog: %s handler still running after %.0f s, receive path released",
+                      name, deadline_s)
+        return False
+
+    def _record_stack(self, name: str, thread: threading.Thread, deadline_s: float):
+        frame = sys._current_frames().get(thread.ident)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "(finished)\n"
+        logging.error("handler_watchdog: %s handler exceeded its %.0f s deadline, stack:\n%s", name, deadline_s, stack)
+        try:
+            os.makedirs(self.stack_dir, exist_ok=True)
+            safe_name = re.sub(r"[^A-Za-z0-9_-]", "_", name)[:40]
+            path = os.path.join(self.stack_dir, f"stuck_handler_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{safe_name}.txt")
+            with open(path, 'w') as file:
+                file.write(f"{name} handler exceeded its {deadline_s:.0f} s deadline\n\n{stack}")
+            stack_files = sorted(entry for entry in os.listdir(self.stack_dir) if entry.startswith("stuck_handler_"))
+            for old in stack_files[:-MAX_STACK_FILES]:
+                os.remove(os.path.join(self.stack_dir, old))
+        except OSError as e:
+            logging.warning("handler_watchdog: Could not save the stack - %s", e)
+
+    def stuck(self) -> list:
+        """Handlers still running past their deadline: [(name, running for s)]."""
+        now = time.monotonic()
+        with self._lock:
+            return [(self._running[ident][0], now - self._running[ident][1])
+                    for ident in self._stuck if ident in self._running]
+
+    def stats(self) -> dict:
+        return {
+            "timeouts": dict(self.timeouts),
+            "cancelled": dict(self.cancelled),
+            "stuck": [{"msg_type": name, "running_s": round(running, 1)} for name, running in self.stuck()],
+        }
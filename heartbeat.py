@@ -0,0 +1,136 @@
+"""
+Filename: heartbeat.py
+
+Periodic heartbeat telemetry (device-to-cloud message) with device health
+metrics, so a silent healthy device can be told apart from a dead one without
+sending it a diagnostic message.
+
+The payload uses short keys and no whitespace. Values that drift continuously
+are compared after rounding, and a beat is skipped when nothing changed since
+the last one sent, but never for longer than the maximum staleness, so the
+backend can still declare a device dead after that time. While the data budget
+is short (see bandwidth.py) beats are only sent at that maximum staleness.
+
+    up   process uptime (s)          v    version (version.json)
+    rx   C2D messages received       rc   IoT Hub (re)connections
+    rss  resident memory (kB)        t    CPU temperature (°C)
+    ld   1-minute load average       df   free space on the SD card (MB)
+    ob   callback outbox depth       seq  heartbeat sequence number
+
+Environment:
+    HEARTBEAT_INTERVAL_S    interval between beats (default 300, 0 disables the heartbeat)
+    HEARTBEAT_MAX_STALE_S   maximum time between two beats sent (default 3600)
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+INTERVAL_S = float(os.getenv("HEARTBEAT_INTERVAL_S", "300"))
+MAX_STALE_S = float(os.getenv("HEARTBEAT_MAX_STALE_S", "3600"))
+
+# Rounding applied before deciding whether a beat carries news
+_CHANGE_RESOLUTION = {"rss": 1024, "t": 2.0, "ld": 0.25, "df": 50}
+# Fields that change on every beat and do not count as news
+_IGNORED_FIELDS = ("up", "seq")
+
+
+def read_cpu_temperature():
+    """SoC temperature in °C, or None if the thermal zone is not available."""
+    try:
+        with open("/sys/class/thermal/thermal_zone0/temp", 'r') as file:
+            return round(int(file.read().strip()) / 1000.0, 1)
+    except (OSError, ValueError):
+        return None
+
+
+def read_load_average():
+    try:
+        return round(os.getloadavg()[0], 2)
+    except OSError:
+        return None
+
+
+def read_disk_free_mb(path: str = SCRIPT_DIR):
+    try:
+        stats = os.statvfs(path)
+        return stats.f_bavail * stats.f_frsize // (1024 * 1024)
+    except OSError:
+        return None
+
+
+def encode(fields: dict) -> str:
+    """Compact JSON encoding, None values are left out."""
+    return json.dumps({key: value for key, value in fields.items() if value is not None},
+                      separators=(',', ':'))
+
+
+def _comparable(fields: dict) -> dict:
+    comparable = {}
+    for key, value in fields.items():
+        if key in _IGNORED_FIELDS:
+            continue
+        resolution = _CHANGE_RESOLUTION.get(key)
+        if resolution and value is not None:
+            value = round(value / resolution)
+        comparable[key] = value
+    return comparable
+
+
+class Heartbeat:
+    """Sends a heartbeat at a fixed interval, skipping beats that carry no news."""
+
+    def __init__(self, name: str, collect, send, interval_s: float = INTERVAL_S,
+                 max_stale_s: float = MAX_STALE_S, defer=None):
+        """
+        :param name: Label used in the logs (the device ID).
+        :param collect: Function returning the heartbeat fields.
+        :param send: Function sending the encoded heartbeat. Returns False while offline.
+        :param defer: Optional function, True while only stale beats should be sent.
+        """
+        self.name = name
+        self._collect = collect
+        self._send = send
+        self._defer = defer or (lambda: False)
+        self.interval_s = interval_s
+        self.max_stale_s = max_stale_s
+
+        self.sequence = 0
+        self.sent = 0
+        self.skipped = 0
+        self._last_sent = None
+        self._last_sent_at = 0.0
+
+        if interval_s > 0:
+            self._thread = threading.Thread(target=self._run, name=f"heartbeat-{name}", daemon=True)
+            self._thread.start()
+
+    def beat(self, force: bool = False) -> bool:
+        """Collect the fields and send them if something changed or the last beat is too old."""
+        fields = self._collect()
+        comparable = _comparable(fields)
+        stale = time.monotonic() - self._last_sent_at >= self.max_stale_s
+        if not force and not stale and (comparable == self._last_sent or self._defer()):
+            self.skipped += 1
+            return False
+
+        self.sequence += 1
+        fields["seq"] = self.sequence
+        if not self._send(encode(fields)):
+            return False
+        self._last_sent = comparable
+        self._last_sent_at = time.monotonic()
+        self.sent += 1
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval_s)
+            try:
+                self.beat()
+            except Exception as e:
+                logging.warning("heartbeat: %s: Could not send heartbeat - %s", self.name, e)
@@ -0,0 +1,160 @@
+"""
+Filename: inflight_journal.py
+
+Journal of the pulse trains in flight, kept in a small memory-mapped file.
+
+A slot is taken when a train is submitted (with the activation details needed
+to report it), its delivered pulse count is a single store into the mapping
+after every pulse, and the slot is released when the train ends. Stores into
+a shared mapping survive the process being killed (SIGKILL, OOM), so at the
+next start the slots still in use are exactly the activations that were
+interrupted, with the impulses actually delivered.
+
+The journal belongs to one process, the service: opening it takes an exclusive
+flock on the file, held until close() or the process ends, and raises
+JournalBusy while another process holds it.
+"""
+
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from paths import DATA_DIR
+JOURNAL_FILE = os.path.join(DATA_DIR, "inflight.bin")
+
+MAGIC = b"PLIJ"
+FORMAT_VERSION = 1
+MAX_SLOTS = 64
+SLOT_SIZE = 512
+
+# magic, format version, number of slots, slot size
+_HEADER = struct.Struct("<4sHHI")
+# in use, relay number, pulses requested, pulses delivered, started at (epoch s), details length
+_SLOT = struct.Struct("<BxHIIdH")
+_DELIVERED_OFFSET = 8
+_MAX_DETAILS = SLOT_SIZE - _SLOT.size
+_FILE_SIZE = _HEADER.size + MAX_SLOTS * SLOT_SIZE
+
+
+class JournalBusy(Exception):
+    """Raised when another process (the running service) holds the journal."""
+
+
+def _slot_offset(slot: int) -> int:
+    return _HEADER.size + slot * SLOT_SIZE
+
+
+class InflightJournal:
+    """Memory-mapped journal of in-flight pulse trains, one fixed slot per train."""
+
+    def __init__(self, file_path: str = JOURNAL_FILE):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._free = list(range(MAX_SLOTS - 1, -1, -1))
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # The details include the callback token
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise JournalBusy(f"{file_path} is held by another process")
+        try:
+            if os.fstat(fd).st_size != _FILE_SIZE:
+                os.ftruncate(fd, _FILE_SIZE)
+            self._map = mmap.mmap(fd, _FILE_SIZE)
+        except Exception:
+            os.close(fd)
+            raise
+        # Kept open: closing it would release the lock
+        self._fd = fd
+
+        magic, version, slots, slot_size = _HEADER.unpack_from(self._map, 0)
+        if (magic, version, slots, slot_size) != (MAGIC, FORMAT_VERSION, MAX_SLOTS, SLOT_SIZE):
+            if magic != bytes(4):
+                logging.warning("inflight_journal: Unrecognised journal file %s, resetting it", file_path)
+            self._map[:] = bytes(_FILE_SIZE)
+            _HEADER.pack_into(self._map, 0, MAGIC, FORMAT_VERSION, MAX_SLOTS, SLOT_SIZE)
+            self._map.flush()
+
+    def recover(self) -> list:
+        """
+        Return the trains left in flight by a previous run and release their slots.
+        Must be called before the first begin().
+
+        :return: List of dictionaries with relay_number, impulses_requested,
+                 impulses_delivered, started_at and the details given to begin().
+        """
+        interrupted = []
+        with self._lock:
+            for slot in range(MAX_SLOTS):
+                offset = _slot_offset(slot)
+                in_use, relay_number, requested, delivered, started_at, length = _SLOT.unpack_from(self._map, offset)
+                if not in_use:
+                    continue
+                try:
+                    details = json.loads(bytes(self._map[offset + _SLOT.size:offset + _SLOT.size + length]))
+                except ValueError:
+                    details = {}
+                details.update({
+                    "relay_number": relay_number,
+                    "impulses_requested": requested,
+                    "impulses_delivered": delivered,
+                    "started_at": started_at,
+                })
+                interrupted.append(details)
+                self._map[offset] = 0
+            if interrupted:
+                self._map.flush()
+        return interrupted
+
+    def begin(self, relay_number: int, pulses: int, details: dict = None):
+        """
+        Record a train about to be submitted.
+
+        :return: Slot number to pass to update()/end(), or None if the journal is full.
+        :raises struct.error: If relay_number or pulses do not fit the slot; no slot is used.
+        """
+        data = json.dumps(details or {}, separators=(',', ':')).encode('utf-8')
+        if len(data) > _MAX_DETAILS:
+            logging.warning("inflight_journal: Details too long, journaling the train without them")
+            data = b"{}"
+        # Packed before a slot is taken: struct.error on a bad value must not lose the slot
+        header = _SLOT.pack(1, relay_number, pulses, 0, time.time(), len(data))
+        with self._lock:
+            if not self._free:
+                logging.warning("inflight_journal: No free slot, train on relay %s not journaled", relay_number)
+                return None
+            slot = self._free.pop()
+            offset = _slot_offset(slot)
+            self._map[offset + _SLOT.size:offset + _SLOT.size + len(data)] = data
+            self._map[offset:offset + _SLOT.size] = header
+            # One msync per activation so the entry also survives a power cut
+            self._map.flush()
+        return slot
+
+    def update(self, slot: int, delivered: int):
+        """Store the delivered pulse count. Cheap enough to call from the timing thread."""
+        if slot is None:
+            return
+        struct.pack_into("<I", self._map, _slot_offset(slot) + _DELIVERED_OFFSET, delivered)
+
+    def end(self, slot: int):
+        """Release the slot of a train that finished (or failed and was reported)."""
+        if slot is None:
+            return
+        with self._lock:
+            self._map[_slot_offset(slot)] = 0
+            self._free.append(slot)
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            os.close(self._fd)
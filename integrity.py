@@ -0,0 +1,185 @@
+"""
+Filename: integrity.py
+
+Verification of the installed files against the release manifest.
+
+manifest.json (built at release time with `python integrity.py build` and
+committed with the release) holds the SHA-256 digest of every tracked file.
+Verification compares the installed files with it, which catches an update
+that was only half applied and files corrupted on the SD card.
+
+Digests are cached in data/digest_cache.json keyed by (inode, mtime, size),
+so a repeat verification only stats the files; a file is read again only when
+one of those changed, or when a full verification is requested (to catch
+corruption that left the metadata intact).
+
+Usage:
+    python integrity.py build            # at release time, from a clean checkout
+    python integrity.py verify [--full]
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from paths import DATA_DIR, SCRIPT_DIR
+MANIFEST_FILE = os.path.join(SCRIPT_DIR, "manifest.json")
+CACHE_FILE = os.path.join(DATA_DIR, "digest_cache.json")
+
+# Files that legitimately differ on every device, never part of the manifest
+EXCLUDED_FILES = {"manifest.json", "config.json", ".env", ".gitignore"}
+
+_CHUNK_SIZE = 256 * 1024
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tracked_files(directory: str = SCRIPT_DIR) -> list:
+    """Files of the release: the files tracked by git, without the per-device ones."""
+    output = subprocess.run(["git", "ls-files", "-z"], cwd=directory, capture_output=True, check=True).stdout
+    names = [name for name in output.decode('utf-8').split("\0") if name]
+    return sorted(name for name in names if os.path.basename(name) not in EXCLUDED_FILES)
+
+
+def build_manifest(directory: str = SCRIPT_DIR, manifest_file: str = MANIFEST_FILE) -> dict:
+    version = None
+    try:
+        with open(os.path.join(directory, "version.json"), 'r') as file:
+            version = json.load(file).get("version")
+    except (OSError, ValueError):
+        pass
+    manifest = {
+        "version": version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "files": {name: file_digest(os.path.join(directory, name)) for name in tracked_files(directory)},
+    }
+    with open(manifest_file, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+        file.write("\n")
+    return manifest
+
+
+class DigestCache:
+    """SHA-256 digests of files, reused while their (inode, mtime, size) do not change."""
+
+    def __init__(self, cache_file: str = CACHE_FILE):
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(cache_file, 'r') as file:
+                self._entries = json.load(file)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def digest(self, path: str, full: bool = False):
+        """
+        :return: (digest, hashed) where hashed tells whether the file had to be read.
+        :raises OSError: If the file cannot be read.
+        """
+        stat = os.stat(path)
+        key = [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+        with self._lock:
+            entry = self._entries.get(path)
+        if not full and entry is not None and entry[:3] == key:
+            return entry[3], False
+        digest = file_digest(path)
+        with self._lock:
+            self._entries[path] = key + [digest]
+            self._dirty = True
+        return digest, True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            temporary = self.cache_file + ".tmp"
+            with open(temporary, 'w') as file:
+                json.dump(entries, file)
+            os.replace(temporary, self.cache_file)
+        except OSError as e:
+            logging.warning("integrity: Could not save the digest cache - %s", e)
+
+
+def verify(directory: str = SCRIPT_DIR, manifest_file: str = MANIFEST_FILE,
+           cache: DigestCache = None, full: bool = False) -> dict:
+    """
+    Compare the installed files with the manifest.
+
+    :return: Dictionary with status ("ok", "mismatch" or "no_manifest"), the manifest version,
+             the missing and modified files, and how many files were checked and actually read.
+    """
+    started = time.perf_counter()
+    try:
+        with open(manifest_file, 'r') as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        return {"status": "no_manifest"}
+    except ValueError as e:
+        return {"status": "mismatch", "error": f"unreadable manifest: {e}", "missing": [], "modified": []}
+
+    cache = cache or DigestCache()
+    missing, modified, hashed = [], [], 0
+    for name, expected in sorted(manifest.get("files", {}).items()):
+        path = os.path.join(directory, name)
+        try:
+            digest, was_hashed = cache.digest(path, full)
+        except FileNotFoundError:
+            missing.append(name)
+            continue
+        except OSError as e:
+            logging.warning("integrity: Could not read %s - %s", name, e)
+            modified.append(name)
+            continue
+        hashed += was_hashed
+        if digest != expected:
+            modified.append(name)
+    cache.save()
+    return {
+        "status": "ok" if not missing and not modified else "mismatch",
+        "version": manifest.get("version"),
+        "checked": len(manifest.get("files", {})),
+        "hashed": hashed,
+        "missing": missing,
+        "modified": modified,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000.0, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Release manifest of the PagaLava IoT files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Write manifest.json from the files tracked by git")
+    verify_parser = subparsers.add_parser("verify", help="Compare the installed files with manifest.json")
+    verify_parser.add_argument("--full", action="store_true", help="Read every file, ignoring the digest cache")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        manifest = build_manifest()
+        print(f"{len(manifest['files'])} files written to {MANIFEST_FILE} (version {manifest['version']})")
+        return 0
+
+    result = verify(full=args.full)
+    print(json.dumps(result, indent=2))
+    return 0 if result["status"] == "ok" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,667 @@
+"""
+Filename: iothub_standin.py
+
+Local stand-in for Azure IoT Hub, for reproducing the connection failure modes
+of the receiver (reconnects, half-open links, redelivery, C2D bursts) offline.
+
+It is a small MQTT 3.1.1 server over TLS that speaks the subset of the IoT Hub
+device protocol used by azure-iot-device:
+    CONNECT/CONNACK (any SAS token is accepted; with CleanSession=0 the
+    subscriptions survive a reconnect, as on the hub), SUBSCRIBE/UNSUBSCRIBE, PINGREQ,
+    C2D delivery on devices/<id>/messages/devicebound/ (QoS 1, redelivered with
+    DUP until acknowledged, like the hub's message lock), telemetry on
+    devices/<id>/messages/events/, and twin GET / reported PATCH requests.
+
+Faults are injected on cue: drop() closes the connection, stall() keeps the
+socket open but stops reading and writing (a half-open link), refuse() answers
+new connections with "server unavailable".
+
+The bench command starts the stand-in and the receiver (relays simulated, data
+in a temporary directory) and measures start-up, C2D throughput, reconnect
+time, half-open detection and backlog drain:
+
+    python iothub_standin.py bench [--messages 500] [--keep-alive 10]
+
+The SDK always connects to port 8883 of the host in the connection string, so
+the stand-in listens on localhost:8883 with a self-signed certificate (made
+with openssl) that the receiver trusts through IOT_SERVER_CERT.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from datetime import datetime, timezone
+
+from net_probe import percentile
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PORT = 8883
+BENCH_DEVICE_ID = "bench-device"
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+CONNACK_ACCEPTED = 0
+CONNACK_SERVER_UNAVAILABLE = 3
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def _encode_str(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return struct.pack("!H", len(data)) + data
+
+
+def _decode_str(data: bytes, offset: int):
+    (length,) = struct.unpack_from("!H", data, offset)
+    return data[offset + 2:offset + 2 + length].decode('utf-8'), offset + 2 + length
+
+
+def _packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([(packet_type << 4) | flags]) + _encode_length(len(body)) + body
+
+
+def make_certificate(directory: str, host: str = "localhost"):
+    """Self-signed certificate for host (and 127.0.0.1). Returns (certfile, keyfile)."""
+    certfile = os.path.join(directory, "standin.crt")
+    keyfile = os.path.join(directory, "standin.key")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30",
+         "-keyout", keyfile, "-out", certfile, "-subj", f"/CN={host}",
+         "-addext", f"subjectAltName=DNS:{host},IP:127.0.0.1"],
+        check=True, capture_output=True)
+    return certfile, keyfile
+
+
+class _Device:
+    """Hub-side state of one device identity."""
+
+    def __init__(self, device_id: str):
+        self.device_id = device_id
+        self.connection = None
+        self.queue = collections.deque()  # C2D messages not delivered yet
+        self.unacked = {}                 # packet id -> message, delivered but not acknowledged
+        self.next_packet_id = 1
+        self.reported = {}
+        self.twin_version = 1
+        self.telemetry = []
+        self.subscriptions = set()        # topic filters, kept across connections without CleanSession
+        self.connects = []                # monotonic time of every accepted CONNECT
+        self.c2d_subscribed = []          # monotonic time C2D delivery started (SUBSCRIBE or resumed session)
+        self.acks = []                    # (message id, enqueued, first sent, acked, deliveries)
+
+
+class _Message:
+    __slots__ = ("message_id", "body", "properties", "enqueued", "enqueued_wall", "first_sent", "deliveries")
+
+    def __init__(self, body: bytes, properties: dict):
+        self.message_id = str(uuid.uuid4())
+        self.body = body
+        self.properties = properties
+        self.enqueued = time.monotonic()
+        self.enqueued_wall = time.time()
+        self.first_sent = None
+        self.deliveries = 0
+
+
+class _Connection:
+    """One MQTT connection, served by its own thread."""
+
+    def __init__(self, hub, sock, address):
+        self.hub = hub
+        self.sock = sock
+        self.address = address
+        self.device = None
+        self.stalled = threading.Event()
+        self.closed = False
+        self._write_lock = threading.Lock()
+        self._buffer = b""
+
+    def _read_exact(self, count: int) -> bytes:
+        while len(self._buffer) < count:
+            if self.stalled.is_set():
+                # Half-open: leave the client's packets unread until the link is dropped
+                time.sleep(0.05)
+                if self.closed:
+                    raise ConnectionError("closed while stalled")
+                continue
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("connection closed by the client")
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:count], self._buffer[count:]
+        return data
+
+    def _read_packet(self):
+        header = self._read_exact(1)[0]
+        multiplier, length = 1, 0
+        while True:
+            byte = self._read_exact(1)[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return header >> 4, header & 0x0F, self._read_exact(length)
+
+    def send(self, data: bytes) -> bool:
+        if self.closed or self.stalled.is_set():
+            return False
+        with self._write_lock:
+            try:
+                self.sock.sendall(data)
+                return True
+            except OSError:
+                self.close()
+                return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def serve(self):
+        try:
+            packet_type, flags, body = self._read_packet()
+            if packet_type != CONNECT:
+                return
+            self._on_connect(body)
+            while not self.closed:
+                packet_type, flags, body = self._read_packet()
+                if packet_type == PUBLISH:
+                    self._on_publish(flags, body)
+                elif packet_type == PUBACK:
+                    self.hub._on_puback(self.device, struct.unpack("!H", body[:2])[0])
+                elif packet_type == SUBSCRIBE:
+                    self._on_subscribe(body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.send(_packet(UNSUBACK, 0, body[:2]))
+                elif packet_type == PINGREQ:
+                    self.send(_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+        except (OSError, ConnectionError, ssl.SSLError, ValueError, IndexError, struct.error) as e:
+            logging.debug("standin: Connection from %s ended - %s", self.address, e)
+        finally:
+            self.close()
+            self.hub._on_disconnect(self)
+
+    def _on_connect(self, body: bytes):
+        _, offset = _decode_str(body, 0)            # protocol name
+        clean_session = bool(body[offset + 1] & 0x02)
+        offset += 4                                 # level, flags, keep alive
+        client_id, _ = _decode_str(body, offset)
+        if self.hub.refusing():
+            self.send(_packet(CONNACK, 0, bytes([0, CONNACK_SERVER_UNAVAILABLE])))
+            raise ConnectionError("connection refused on cue")
+        self.device, session_present = self.hub._on_connect(self, client_id, clean_session)
+        self.send(_packet(CONNACK, 0, bytes([1 if session_present else 0, CONNACK_ACCEPTED])))
+        if session_present and any("/messages/devicebound/" in topic for topic in self.device.subscriptions):
+            # The SDK does not subscribe again on a resumed session: delivery restarts right away
+            self.hub._on_c2d_subscribed(self.device)
+
+    def _on_subscribe(self, body: bytes):
+        packet_id = body[:2]
+        offset, granted, topics = 2, bytearray(), []
+        while offset < len(body):
+            topic, offset = _decode_str(body, offset)
+            granted.append(min(body[offset], 1))
+            offset += 1
+            topics.append(topic)
+        self.send(_packet(SUBACK, 0, packet_id + bytes(granted)))
+        self.device.subscriptions.update(topics)
+        if any("/messages/devicebound/" in topic for topic in topics):
+            self.hub._on_c2d_subscribed(self.device)
+
+    def _on_publish(self, flags: int, body: bytes):
+        qos = (flags >> 1) & 0x03
+        topic, offset = _decode_str(body, 0)
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            self.send(_packet(PUBACK, 0, packet_id))
+        payload = body[offset:]
+
+        if topic.startswith("$iothub/twin/"):
+            self.hub._on_twin_request(self, topic, payload)
+        elif "/messages/events/" in topic:
+            properties = dict(urllib.parse.parse_qsl(topic.split("/messages/events/", 1)[1]))
+            self.device.telemetry.append((time.monotonic(), properties, payload))
+
+
+class IoTHubStandIn:
+    """MQTT/TLS server emulating the IoT Hub device endpoint."""
+
+    def __init__(self, certfile: str, keyfile: str, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self._context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self._context.load_cert_chain(certfile, keyfile)
+        self._lock = threading.Condition()
+        self._devices = {}
+        self._refuse_until = 0.0
+        self._listener = None
+        self._running = False
+
+    # Lifecycle
+
+    def start(self):
+        self._listener = socket.create_server((self.host, self.port), reuse_port=False)
+        self._running = True
+        threading.Thread(target=self._accept_loop, name="standin-accept", daemon=True).start()
+        logging.info("standin: Listening on %s:%d", self.host, self.port)
+
+    def stop(self):
+        self._running = False
+        try:
+            # Wakes the accept loop; close() alone leaves the port bound while accept() blocks
+            self._listener.shutdown(socket.SHUT_RDWR)
+            self._listener.close()
+        except OSError:
+            pass
+        with self._lock:
+            for device in self._devices.values():
+                if device.connection is not None:
+                    device.connection.close()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, address = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(sock, address), name="standin-conn", daemon=True).start()
+
+    def _serve(self, sock, address):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock = self._context.wrap_socket(sock, server_side=True)
+        except (OSError, ssl.SSLError) as e:
+            logging.warning("standin: TLS handshake with %s failed - %s", address, e)
+            sock.close()
+            return
+        _Connection(self, sock, address).serve()
+
+    # Hub side state, called by the connections
+
+    def device(self, device_id: str) -> _Device:
+        with self._lock:
+            if device_id not in self._devices:
+                self._devices[device_id] = _Device(device_id)
+            return self._devices[device_id]
+
+    def _on_connect(self, connection, device_id: str, clean_session: bool = True):
+        """Register a connection. Returns the device and whether its session was resumed."""
+        device = self.device(device_id)
+        with self._lock:
+            previous = device.connection
+            device.connection = connection
+            device.connects.append(time.monotonic())
+            if clean_session:
+                device.subscriptions.clear()
+            session_present = bool(device.subscriptions)
+            self._lock.notify_all()
+        if previous is not None and previous is not connection:
+            # Like the hub, a new connection of the same device closes the old one
+            previous.close()
+        logging.info("standin: %s connected from %s%s", device_id, connection.address,
+                     " (session resumed)" if session_present else "")
+        return device, session_present
+
+    def _on_c2d_subscribed(self, device: _Device):
+        with self._lock:
+            device.c2d_subscribed.append(time.monotonic())
+            # Unacknowledged messages are redelivered first, then the queue
+            pending = list(device.unacked.items())
+            self._lock.notify_all()
+        for packet_id, message in pending:
+            self._deliver(device, message, packet_id, dup=True)
+        self._pump(device)
+
+    def _on_disconnect(self, connection):
+        device = connection.device
+        if device is None:
+            return
+        with self._lock:
+            if device.connection is connection:
+                device.connection = None
+            self._lock.notify_all()
+
+    def _on_puback(self, device: _Device, packet_id: int):
+        with self._lock:
+            message = device.unacked.pop(packet_id, None)
+            if message is not None:
+                device.acks.append((message.message_id, message.enqueued, message.first_sent,
+                                    time.monotonic(), message.deliveries))
+            self._lock.notify_all()
+
+    def _on_twin_request(self, connection, topic: str, payload: bytes):
+        device = connection.device
+        query = dict(urllib.parse.parse_qsl(topic.split("?", 1)[1])) if "?" in topic else {}
+        request_id = query.get("$rid", "")
+        if topic.startswith("$iothub/twin/GET/"):
+            document = {"desired": {"$version": 1}, "reported": dict(device.reported, **{"$version": device.twin_version})}
+            response_topic = f"$iothub/twin/res/200/?$rid={request_id}"
+            body = json.dumps(document).encode('utf-8')
+        elif topic.startswith("$iothub/twin/PATCH/properties/reported/"):
+            try:
+                device.reported.update(json.loads(payload or b"{}"))
+            except ValueError:
+                pass
+            device.twin_version += 1
+            response_topic = f"$iothub/twin/res/204/?$rid={request_id}&$version={device.twin_version}"
+            body = b""
+        else:
+            return
+        connection.send(_packet(PUBLISH, 0, _encode_str(response_topic) + body))
+
+    # C2D delivery
+
+    def _deliver(self, device: _Device, message: _Message, packet_id: int, dup: bool = False) -> bool:
+        connection = device.connection
+        if connection is None:
+            return False
+        properties = dict(message.properties)
+        properties.setdefault("$.mid", message.message_id)
+        properties.setdefault("iothub-enqueuedtime", datetime.fromtimestamp(
+            message.enqueued_wall, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f0Z"))
+        topic = f"devices/{device.device_id}/messages/devicebound/{urllib.parse.urlencode(properties)}"
+        body = _encode_str(topic) + struct.pack("!H", packet_id) + message.body
+        if not connection.send(_packet(PUBLISH, 0x02 | (0x08 if dup else 0), body)):
+            return False
+        with self._lock:
+            message.deliveries += 1
+            message.first_sent = message.first_sent or time.monotonic()
+        return True
+
+    def _pump(self, device: _Device):
+        """Deliver the queued messages of a device while it is connected."""
+        while True:
+            with self._lock:
+                if not device.queue or device.connection is None or device.connection.stalled.is_set():
+                    return
+                message = device.queue.popleft()
+                packet_id = device.next_packet_id
+                device.next_packet_id = device.next_packet_id % 65535 + 1
+                device.unacked[packet_id] = message
+            if not self._deliver(device, message, packet_id):
+                # Stays in unacked, redelivered at the next subscription
+                return
+
+    def send_c2d(self, device_id: str, body, properties: dict = None) -> str:
+        """Queue a C2D message (dict bodies are sent as JSON). Returns its message ID."""
+        if isinstance(body, dict):
+            body = json.dumps(body).encode('utf-8')
+        message = _Message(body, properties or {})
+        device = self.device(device_id)
+        with self._lock:
+            device.queue.append(message)
+        self._pump(device)
+        return message.message_id
+
+    def inject(self, device_id: str, bodies, rate_per_s: float = 0.0):
+        """Send a sequence of C2D messages, spaced to rate_per_s (0: as fast as possible)."""
+        interval = 1.0 / rate_per_s if rate_per_s else 0.0
+        next_send = time.monotonic()
+        for body in bodies:
+            if interval:
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send += interval
+            self.send_c2d(device_id, body)
+
+    # Fault injection
+
+    def drop(self, device_id: str):
+        """Close the device's connection abruptly (no DISCONNECT)."""
+        connection = self.device(device_id).connection
+        if connection is not None:
+            connection.close()
+
+    def stall(self, device_id: str):
+        """Stop reading from and writing to the device's connection, leaving the socket open."""
+        connection = self.device(device_id).connection
+        if connection is not None:
+            connection.stalled.set()
+        return connection
+
+    def refuse(self, seconds: float):
+        """Answer new connections with "server unavailable" for the given time."""
+        self._refuse_until = time.monotonic() + seconds
+
+    def refusing(self) -> bool:
+        return time.monotonic() < self._refuse_until
+
+    # Observation
+
+    def wait_for(self, predicate, timeout_s: float) -> bool:
+        """Wait until predicate() is true (checked under the hub lock on every state change)."""
+        deadline = time.monotonic() + timeout_s
+        with self._lock:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._lock.wait(min(remaining, 0.5))
+            return True
+
+    def wait_for_subscription(self, device_id: str, after: float, timeout_s: float):
+        """Time of the first C2D subscription after the given monotonic time, or None."""
+        device = self.device(device_id)
+        found = self.wait_for(lambda: any(at > after for at in device.c2d_subscribed), timeout_s)
+        return next(at for at in device.c2d_subscribed if at > after) if found else None
+
+    def wait_for_acks(self, device_id: str, count: int, timeout_s: float) -> bool:
+        device = self.device(device_id)
+        return self.wait_for(lambda: len(device.acks) >= count, timeout_s)
+
+
+def _receiver_env(certfile: str, data_dir: str, keep_alive_s: int) -> dict:
+    env = dict(os.environ)
+    for key in list(env):
+        # Only the bench identity, never the device's real ones from the environment
+        if key.startswith(("IOT_CONNECTION_STRING", "IOT_CONFIG_FILE", "IOT_RELAYS")):
+            del env[key]
+    env.update({
+        "IOT_CONNECTION_STRING": f"HostName=localhost;DeviceId={BENCH_DEVICE_ID};SharedAccessKey=c3RhbmRpbg==",
+        "IOT_CONFIG_FILE": os.path.join(data_dir, "config.json"),
+        "IOT_SERVER_CERT": certfile,
+        "IOT_KEEP_ALIVE_S": str(keep_alive_s),
+        "RELAY_SIMULATED": "1",
+        "PAGALAVA_DATA_DIR": data_dir,
+        "PYTHONUNBUFFERED": "1",
+    })
+    return env
+
+
+def _memory_kb(pid: int) -> dict:
+    """VmRSS and VmHWM (peak RSS) of a process in kB."""
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status", 'r') as file:
+            for line in file:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    memory[line.split(":")[0]] = int(line.split()[1])
+    except OSError:
+        pass
+    return memory
+
+
+def bench(messages: int, rate: float, keep_alive_s: int, backlog: int, verbose: bool) -> int:
+    results = []
+    failures = []
+
+    def report(name, value, unit="s"):
+        text = f"{value:.3f} {unit}".rstrip() if isinstance(value, float) else f"{value} {unit}".rstrip()
+        results.append((name, text))
+        print(f"  {name:<34} {text}")
+
+    with tempfile.TemporaryDirectory(prefix="standin_") as work_dir:
+        certfile, keyfile = make_certificate(work_dir)
+        with open(os.path.join(work_dir, "config.json"), "w") as file:
+            json.dump({}, file)
+        hub = IoTHubStandIn(certfile, keyfile)
+        hub.start()
+
+        receiver = subprocess.Popen(
+            [sys.executable, os.path.join(SCRIPT_DIR, "ReceiveMessages.py")],
+            cwd=SCRIPT_DIR, env=_receiver_env(certfile, work_dir, keep_alive_s),
+            stdout=None if verbose else subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        device_id = BENCH_DEVICE_ID
+        wake_up = {"msg_type": "wake_up"}
+        try:
+            print("Start-up")
+            started = time.monotonic()
+            subscribed = hub.wait_for_subscription(device_id, 0.0, 60)
+            if subscribed is None:
+                print("  the receiver did not connect within 60 s")
+                return 1
+            report("start to C2D subscription", subscribed - started)
+            report("receiver RSS", _memory_kb(receiver.pid).get("VmRSS", 0), "kB")
+
+            print(f"C2D throughput ({messages} messages{f', {rate:g}/s' if rate else ''})")
+            acked_before = len(hub.device(device_id).acks)
+            sent_at = time.monotonic()
+            hub.inject(device_id, [wake_up] * messages, rate)
+            if hub.wait_for_acks(device_id, acked_before + messages, 120):
+                acks = hub.device(device_id).acks[acked_before:]
+                elapsed = acks[-1][3] - sent_at
+                latencies = [(acked - enqueued) * 1000.0 for _, enqueued, _, acked, _ in acks]
+                report("messages acknowledged / s", round(messages / elapsed, 1), "")
+                report("enqueue to ack p50", round(percentile(latencies, 0.5), 1), "ms")
+                report("enqueue to ack p95", round(percentile(latencies, 0.95), 1), "ms")
+                report("receiver RSS", _memory_kb(receiver.pid).get("VmRSS", 0), "kB")
+            else:
+                failures.append("throughput: not every message was acknowledged within 120 s")
+
+            print("Reconnect after a dropped connection")
+            dropped = time.monotonic()
+            hub.drop(device_id)
+            resubscribed = hub.wait_for_subscription(device_id, dropped, 120)
+            if resubscribed is None:
+                failures.append("reconnect: no new connection within 120 s")
+            else:
+                report("drop to C2D subscription", resubscribed - dropped)
+
+            print(f"Half-open link (keep-alive {keep_alive_s} s)")
+            stalled = time.monotonic()
+            hub.stall(device_id)
+            resubscribed = hub.wait_for_subscription(device_id, stalled, 4 * keep_alive_s + 60)
+            if resubscribed is None:
+                failures.append("half-open: the link was never detected as dead")
+            else:
+                report("stall to C2D subscription", resubscribed - stalled)
+
+            print(f"Backlog drain ({backlog} messages queued while stalled)")
+            acked_before = len(hub.device(device_id).acks)
+            stalled_connection = hub.stall(device_id)
+            hub.inject(device_id, [wake_up] * backlog)
+            time.sleep(1.0)
+            reconnect_from = time.monotonic()
+            if stalled_connection is not None:
+                stalled_connection.close()
+            if hub.wait_for_acks(device_id, acked_before + backlog, 4 * keep_alive_s + 120):
+                acks = hub.device(device_id).acks[acked_before:]
+                report("drop to backlog drained", acks[-1][3] - reconnect_from)
+                report("redelivered messages", sum(1 for ack in acks if ack[4] > 1), "")
+            else:
+                failures.append("backlog: not every queued message was acknowledged")
+
+            print("Refused connections")
+            refused_from = time.monotonic()
+            hub.refuse(5.0)
+            hub.drop(device_id)
+            resubscribed = hub.wait_for_subscription(device_id, refused_from, 400)
+            if resubscribed is None:
+                failures.append("refused: no reconnection after the refusal window")
+            else:
+                report("refusal (5 s) to C2D subscription", resubscribed - refused_from)
+
+            device = hub.device(device_id)
+            report("connections", len(device.connects), "")
+            report("telemetry messages", len(device.telemetry), "")
+            memory = _memory_kb(receiver.pid)
+            report("receiver RSS / peak", f"{memory.get('VmRSS', 0)} / {memory.get('VmHWM', 0)}", "kB")
+        finally:
+            receiver.terminate()
+            try:
+                receiver.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                receiver.kill()
+            hub.stop()
+
+    if receiver.returncode not in (0, -15):
+        failures.append(f"receiver exited with status {receiver.returncode}")
+    if failures:
+        print(f"FAILED: {len(failures)}")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print("OK")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local IoT Hub stand-in and receiver bench")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the stand-in only")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--cert", help="Certificate (PEM); a self-signed one is made if omitted")
+    serve_parser.add_argument("--key", help="Private key of --cert (PEM)")
+
+    bench_parser = subparsers.add_parser("bench", help="Run the receiver against the stand-in and measure it")
+    bench_parser.add_argument("--messages", type=int, default=500, help="C2D messages in the throughput test")
+    bench_parser.add_argument("--rate", type=float, default=0.0, help="C2D messages per second (0: burst)")
+    bench_parser.add_argument("--keep-alive", type=int, default=10, help="MQTT keep-alive of the receiver, s")
+    bench_parser.add_argument("--backlog", type=int, default=50, help="Messages queued during the backlog test")
+    bench_parser.add_argument("--verbose", "-v", action="store_true", help="Show receiver logs")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == "bench":
+        return bench(args.messages, args.rate, args.keep_alive, args.backlog, args.verbose)
+
+    with tempfile.TemporaryDirectory(prefix="standin_") as work_dir:
+        certfile, keyfile = (args.cert, args.key) if args.cert else make_certificate(work_dir)
+        hub = IoTHubStandIn(certfile, keyfile, port=args.port)
+        hub.start()
+        print(f"Certificate for IOT_SERVER_CERT: {certfile}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            hub.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+Filename: latency_trace.py
+
+End-to-end latency trace of an activation, from the IoT Hub enqueuing the C2D
+message to the confirmation callback being sent, so the latency of every
+payment can be attributed to the cloud, the network or the device.
+
+Trace points (epoch seconds):
+    hub_enqueued    iothub-enqueuedtime system property of the message (hub clock)
+    received        SDK delivered the message to the receiver
+    dispatched      message_activate started
+    config_loaded   machine configuration read
+    first_edge      first relay edge applied
+    last_edge       last relay edge applied
+    callback_sent   confirmation callback sent (stamped on every attempt)
+
+hub_delivery compares the hub clock with the device clock, so it includes the
+clock offset; NTP keeps it within a few ms on a healthy device.
+"""
+
+import collections
+import threading
+from datetime import datetime, timezone
+
+from net_probe import percentile
+
+POINTS = ("hub_enqueued", "received", "dispatched", "config_loaded", "first_edge", "last_edge", "callback_sent")
+
+# Stage name, start point, end point
+STAGES = (
+    ("hub_delivery", "hub_enqueued", "received"),
+    ("device_queue", "received", "dispatched"),
+    ("config", "dispatched", "config_loaded"),
+    ("relay_start", "config_loaded", "first_edge"),
+    ("pulses", "first_edge", "last_edge"),
+    ("callback", "last_edge", "callback_sent"),
+)
+
+ENQUEUED_TIME_PROPERTY = "iothub-enqueuedtime"
+
+
+def parse_enqueued_time(message):
+    """
+    Time the hub enqueued a C2D message, in epoch seconds, or None.
+    The SDK keeps the system properties it does not map in custom_properties.
+    """
+    properties = getattr(message, "custom_properties", None) or {}
+    value = properties.get(ENQUEUED_TIME_PROPERTY) or getattr(message, "enqueued_time", None)
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).replace("Z", "+00:00")
+    # The hub sends 7 fractional digits, fromisoformat accepts at most 6
+    if "." in text:
+        head, tail = text.split(".", 1)
+        digits = len(tail) - len(tail.lstrip("0123456789"))
+        text = f"{head}.{tail[:min(digits, 6)]}{tail[digits:]}"
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def durations_ms(trace: dict) -> dict:
+    """Duration of every stage whose two trace points are known, plus the total."""
+    durations = {}
+    for stage, start, end in STAGES:
+        if trace.get(start) and trace.get(end):
+            durations[stage] = round((trace[end] - trace[start]) * 1000.0, 1)
+    known = [trace[point] for point in POINTS if trace.get(point)]
+    if len(known) > 1:
+        durations["total"] = round((known[-1] - known[0]) * 1000.0, 1)
+    return durations
+
+
+def compact(trace: dict) -> dict:
+    """Trace points rounded to the millisecond, unknown points left out."""
+    return {point: round(trace[point], 3) for point in POINTS if trace.get(point)}
+
+
+class StageMetrics:
+    """Recent per-stage durations of the device, for status replies."""
+
+    def __init__(self, history: int = 200):
+        self._durations = collections.defaultdict(lambda: collections.deque(maxlen=history))
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, durations: dict):
+        with self._lock:
+            self.count += 1
+            for stage, value in durations.items():
+                self._durations[stage].append(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snapshot = {"activations": self.count}
+            for stage, values in self._durations.items():
+                snapshot[stage] = {
+                    "p50_ms": percentile(values, 0.50),
+                    "p95_ms": percentile(values, 0.95),
+                    "max_ms": max(values),
+                }
+            return snapshot
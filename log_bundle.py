@@ -0,0 +1,356 @@
+"""
+Filename: log_bundle.py
+
+On-demand upload of a compressed log bundle: the journal of the receiver for a
+time window (or since a journal cursor), optionally followed by the
+diagnostics output and the configuration files.
+
+The bundle is produced as a stream: the output of journalctl is read in blocks
+and gzip-compressed on the fly into a spool file in data/log_uploads, and each
+chunk of compressed data is uploaded as soon as it is complete, so neither the
+text nor the compressed bundle is ever held in memory. Every chunk is a POST to
+the URL given in the message, with headers:
+
+    X-Upload-Id, X-Upload-Token, X-Chunk-Index, X-Chunk-Offset,
+    X-Final-Chunk (1 on the last one, which also carries X-Total-Bytes and,
+    when known, X-Journal-Cursor to continue from next time)
+
+Progress is saved after every acknowledged chunk, with the CRC32 of the bytes
+acknowledged so far. If the upload stops (network down, service restarted), a
+new get_logs with the same upload_id continues after the last acknowledged
+chunk: from the spool if the bundle was fully spooled, otherwise the bundle is
+rebuilt for the saved window (the compressor state is gone) and, once its
+acknowledged part matches the saved CRC, the upload goes on from there. If it
+does not match (journal vacuumed, a diagnostics section changed), the upload
+fails as not resumable.
+
+The upload runs in its own thread at the lowest CPU priority, with journalctl
+at idle I/O priority, and holds back while any relay is pulsing, so it never
+delays an activation.
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+import zlib
+
+from paths import DATA_DIR, SCRIPT_DIR
+UPLOAD_DIR = os.path.join(DATA_DIR, "log_uploads")
+
+SERVICE_NAME = "receive_messages.service"
+CHUNK_SIZE = 256 * 1024
+READ_SIZE = 64 * 1024
+DEFAULT_WINDOW_S = 24 * 3600
+MAX_ATTEMPTS = 5
+FIRST_RETRY_S = 5
+MAX_RETRY_S = 60
+TIMEOUT_S = 30
+MAX_SPOOL_AGE_S = 24 * 3600
+
+_CURSOR_RE = re.compile(rb"^-- cursor: (.+)$", re.MULTILINE)
+_UPLOAD_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class UploadFailed(Exception):
+    """The bundle could not be uploaded; it can be resumed with the same upload_id."""
+
+
+class BundleChanged(Exception):
+    """The rebuilt bundle differs from the part already acknowledged; a new upload is needed."""
+
+
+def _lower_priority():
+    """Lowest CPU priority for the calling thread (Linux schedules threads individually)."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+def _low_priority_command(command: list) -> list:
+    prefix = ["nice", "-n", "19"] if shutil.which("nice") else []
+    if shutil.which("ionice"):
+        prefix += ["ionice", "-c", "3"]
+    return prefix + command
+
+
+class LogUploader:
+    """Builds and uploads log bundles, one at a time, in a background thread."""
+
+    def __init__(self, session, is_busy=None, upload_dir: str = UPLOAD_DIR):
+        """
+        :param session: requests.Session (or anything with a compatible post method).
+        :param is_busy: Optional callable, True while an activation is running.
+        """
+        self.session = session
+        self.is_busy = is_busy or (lambda: False)
+        self.upload_dir = upload_dir
+        self._lock = threading.Lock()
+        self._running = None
+
+    def start(self, request: dict, sections: list, on_done=None):
+        """
+        Start (or resume) an upload in the background.
+
+        :param request: upload_url, upload_token, upload_id, since, until, after_cursor.
+        :param sections: (title, command or file path) tuples to append after the journal.
+        :param on_done: Optional callable given the final status dictionary.
+        :return: The upload ID, or None if an upload is already running.
+        """
+        upload_id = request.get("upload_id") or uuid.uuid4().hex
+        if not _UPLOAD_ID_RE.match(upload_id):
+            raise ValueError(f"invalid upload_id {upload_id!r}")
+        with self._lock:
+            if self._running is not None:
+                return None
+            self._running = upload_id
+        thread = threading.Thread(target=self._run, args=(upload_id, request, sections, on_done),
+                                  name="log-upload", daemon=True)
+        thread.start()
+        return upload_id
+
+    def running(self):
+        with self._lock:
+            return self._running
+
+    # Progress and spool files
+
+    def _paths(self, upload_id: str):
+        base = os.path.join(self.upload_dir, upload_id)
+        return base + ".json", base + ".gz"
+
+    def _load_progress(self, upload_id: str):
+        progress_path, _ = self._paths(upload_id)
+        try:
+            with open(progress_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _save_progress(self, upload_id: str, progress: dict):
+        progress_path, _ = self._paths(upload_id)
+        temporary = progress_path + ".tmp"
+        with open(temporary, 'w') as file:
+            json.dump(progress, file)
+        os.replace(temporary, progress_path)
+
+    def _prune(self):
+        now = time.time()
+        try:
+            for name in os.listdir(self.upload_dir):
+                path = os.path.join(self.upload_dir, name)
+                if now - os.path.getmtime(path) > MAX_SPOOL_AGE_S:
+                    os.remove(path)
+        except OSError:
+            pass
+
+    # Upload
+
+    def _run(self, upload_id: str, request: dict, sections: list, on_done):
+        _lower_priority()
+        status = {"upload_id": upload_id}
+        try:
+            os.makedirs(self.upload_dir, exist_ok=True)
+            self._prune()
+            status.update(self._upload(upload_id, request, sections))
+            status["status"] = "COMPLETED"
+            for path in self._paths(upload_id):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        except UploadFailed as e:
+            logging.error("log_bundle: Upload %s stopped, can be resumed - %s", upload_id, e)
+            status.update({"status": "FAILED", "error": str(e), "resumable": True})
+        except BundleChanged as e:
+            logging.error("log_bundle: Upload %s cannot be resumed - %s", upload_id, e)
+            status.update({"status": "FAILED", "error": str(e), "resumable": False})
+            for path in self._paths(upload_id):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        except Exception as e:
+            logging.exception("log_bundle: Upload %s failed", upload_id)
+            status.update({"status": "FAILED", "error": str(e), "resumable": False})
+        finally:
+            with self._lock:
+                self._running = None
+        if on_done is not None:
+            on_done(status)
+
+    def _upload(self, upload_id: str, request: dict, sections: list) -> dict:
+        progress = self._load_progress(upload_id)
+        _, spool_path = self._paths(upload_id)
+        if progress is not None and progress.get("complete") and os.path.exists(spool_path):
+            # The bundle was fully spooled: only the unacknowledged chunks are sent again
+            logging.info("log_bundle: Resuming upload %s at chunk %d", upload_id, progress["chunks"])
+            with open(spool_path, 'rb') as spool:
+                self._send_spooled(upload_id, request, progress, spool, final=True)
+            return {"bytes": progress["bytes"], "chunks": progress["chunks"], "cursor": progress.get("cursor")}
+
+        if progress is not None and progress.get("bytes"):
+            # Stopped while spooling: rebuild the same window and check the acknowledged part
+            logging.info("log_bundle: Rebuilding upload %s to resume at chunk %d", upload_id, progress["chunks"])
+            progress.update(spooled=0, complete=False)
+        else:
+            # Fixed window, so a rebuilt bundle covers the same entries
+            until = request.get("until") or time.time()
+            progress = {"chunks": 0, "bytes": 0, "acked_crc": 0, "spooled": 0, "complete": False,
+                        "until": until, "since": request.get("since") or until - DEFAULT_WINDOW_S,
+                        "after_cursor": request.get("after_cursor")}
+        self._save_progress(upload_id, progress)
+        started = time.monotonic()
+        with open(spool_path, 'w+b') as spool:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # gzip container
+            raw_bytes = 0
+            tail = b""
+            checked = not progress["bytes"]
+
+            def write(data: bytes):
+                nonlocal checked
+                compressed = compressor.compress(data)
+                if compressed:
+                    spool.seek(0, os.SEEK_END)
+                    spool.write(compressed)
+                    progress["spooled"] += len(compressed)
+                if not checked and progress["spooled"] >= progress["bytes"]:
+                    self._check_acknowledged(spool, progress)
+                    checked = True
+                if checked and progress["spooled"] - progress["bytes"] >= CHUNK_SIZE:
+                    self._send_spooled(upload_id, request, progress, spool, final=False)
+
+            for title, source in [("journal", self._journal_command(progress))] + list(sections):
+                write(f"\n===== {title} =====\n".encode('utf-8'))
+                for block in self._read_source(source):
+                    raw_bytes += len(block)
+                    if title == "journal":
+                        tail = (tail + block)[-4096:]
+                    write(block)
+
+            spool.seek(0, os.SEEK_END)
+            final = compressor.flush()
+            spool.write(final)
+            progress["spooled"] += len(final)
+            if not checked:
+                self._check_acknowledged(spool, progress)
+            match = _CURSOR_RE.search(tail)
+            progress["cursor"] = match.group(1).decode('utf-8', errors='replace').strip() if match else None
+            progress["complete"] = True
+            self._save_progress(upload_id, progress)
+            self._send_spooled(upload_id, request, progress, spool, final=True)
+
+        logging.info("log_bundle: Upload %s completed, %d bytes of logs in %d compressed bytes (%d chunks) in %.1f s",
+                     upload_id, raw_bytes, progress["bytes"], progress["chunks"], time.monotonic() - started)
+        return {"bytes": progress["bytes"], "raw_bytes": raw_bytes, "chunks": progress["chunks"],
+                "cursor": progress["cursor"]}
+
+    @staticmethod
+    def _journal_command(window: dict) -> list:
+        """journalctl for the window saved in the progress: until, and after_cursor or since."""
+        command = ["journalctl", "-u", SERVICE_NAME, "--no-pager", "-o", "short-iso", "--show-cursor",
+                   "--until", f"@{int(window['until'])}"]
+        if window.get("after_cursor"):
+            command += ["--after-cursor", window["after_cursor"]]
+        else:
+            command += ["--since", f"@{int(window.get('since') or window['until'] - DEFAULT_WINDOW_S)}"]
+        return command
+
+    @staticmethod
+    def _check_acknowledged(spool, progress: dict):
+        """Compare the acknowledged part of a rebuilt spool with the CRC saved while uploading it."""
+        if progress["spooled"] < progress["bytes"] or "acked_crc" not in progress:
+            raise BundleChanged(f"only {progress['spooled']} of the {progress['bytes']} acknowledged bytes rebuilt")
+        spool.seek(0)
+        crc = 0
+        remaining = progress["bytes"]
+        while remaining:
+            block = spool.read(min(READ_SIZE, remaining))
+            crc = zlib.crc32(block, crc)
+            remaining -= len(block)
+        if crc != progress["acked_crc"]:
+            raise BundleChanged(f"the first {progress['bytes']} bytes differ from the ones acknowledged")
+
+    def _read_source(self, source):
+        """Blocks of a command's output (list) or of a file (str)."""
+        if isinstance(source, str):
+            try:
+                with open(source, 'rb') as file:
+                    for block in iter(lambda: file.read(READ_SIZE), b""):
+                        yield block
+            except OSError as e:
+                yield f"(not readable: {e})\n".encode('utf-8')
+            return
+
+        try:
+            process = subprocess.Popen(_low_priority_command(source), stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, cwd=SCRIPT_DIR)
+        except OSError as e:
+            yield f"(could not run {source[0]}: {e})\n".encode('utf-8')
+            return
+        try:
+            for block in iter(lambda: process.stdout.read1(READ_SIZE), b""):
+                yield block
+        finally:
+            process.stdout.close()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def _send_spooled(self, upload_id: str, request: dict, progress: dict, spool, final: bool):
+        """Upload the complete chunks of the spool (and the last partial one when final)."""
+        while True:
+            available = progress["spooled"] - progress["bytes"]
+            if available <= 0 or (not final and available < CHUNK_SIZE):
+                return
+            spool.seek(progress["bytes"])
+            chunk = spool.read(CHUNK_SIZE)
+            last = final and progress["bytes"] + len(chunk) >= progress["spooled"]
+            self._post_chunk(upload_id, request, progress, chunk, last)
+            progress["chunks"] += 1
+            progress["bytes"] += len(chunk)
+            progress["acked_crc"] = zlib.crc32(chunk, progress.get("acked_crc", 0))
+            self._save_progress(upload_id, progress)
+
+    def _post_chunk(self, upload_id: str, request: dict, progress: dict, chunk: bytes, last: bool):
+        headers = {
+            "Content-Type": "application/gzip",
+            "X-Upload-Id": upload_id,
+            "X-Upload-Token": request.get("upload_token") or "",
+            "X-Chunk-Index": str(progress["chunks"]),
+            "X-Chunk-Offset": str(progress["bytes"]),
+            "X-Final-Chunk": "1" if last else "0",
+        }
+        if last:
+            headers["X-Total-Bytes"] = str(progress["bytes"] + len(chunk))
+            if progress.get("cursor"):
+                headers["X-Journal-Cursor"] = progress["cursor"]
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            # Never compete with a pulse train for the CPU or the uplink
+            while self.is_busy():
+                time.sleep(0.5)
+            try:
+                response = self.session.post(request["upload_url"], data=chunk, headers=headers, timeout=TIMEOUT_S)
+                if 200 <= response.status_code < 300:
+                    return
+                if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                    raise UploadFailed(f"chunk {progress['chunks']} refused with status {response.status_code}")
+                reason = f"status {response.status_code}"
+            except UploadFailed:
+                raise
+            except Exception as e:
+                reason = str(e)
+            logging.warning("log_bundle: Chunk %d of %s failed (attempt %d) - %s",
+                            progress["chunks"], upload_id, attempt, reason)
+            if attempt < MAX_ATTEMPTS:
+                time.sleep(min(MAX_RETRY_S, FIRST_RETRY_S * 2 ** (attempt - 1)))
+        raise UploadFailed(f"chunk {progress['chunks']} not accepted after {MAX_ATTEMPTS} attempts")
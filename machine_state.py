@@ -0,0 +1,115 @@
+"""
+Filename: machine_state.py
+
+Publishes the busy state of each machine (idle or pulsing, and the number of
+activations queued behind the running one) as device-twin reported properties,
+so the backend can steer customers to free machines.
+
+Changes are debounced and coalesced: a change is published after a short settle
+delay, and never more often than once per minimum interval, with only the
+machines whose state changed in the patch. A busy hour therefore produces a
+handful of twin updates per minute instead of one per relay edge. While the
+data budget is short (see bandwidth.py) the deferred interval applies instead.
+
+Environment:
+    MACHINE_STATE_SETTLE_S              wait for further changes before publishing (default 2)
+    MACHINE_STATE_MIN_INTERVAL_S        minimum time between two twin updates (default 15)
+    MACHINE_STATE_DEFERRED_INTERVAL_S   the same, in bandwidth budget mode (default 120)
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+SETTLE_S = float(os.getenv("MACHINE_STATE_SETTLE_S", "2"))
+MIN_INTERVAL_S = float(os.getenv("MACHINE_STATE_MIN_INTERVAL_S", "15"))
+DEFERRED_INTERVAL_S = float(os.getenv("MACHINE_STATE_DEFERRED_INTERVAL_S", "120"))
+
+
+class MachineStatePublisher:
+    """Debounced publisher of the per-machine state of one device."""
+
+    def __init__(self, name: str, read_states, publish,
+                 settle_s: float = SETTLE_S, min_interval_s: float = MIN_INTERVAL_S,
+                 defer=None, deferred_interval_s: float = DEFERRED_INTERVAL_S):
+        """
+        :param name: Label used in the logs (the device ID).
+        :param read_states: Function returning {machine_id: {"state": ..., "queued": ...}}.
+        :param publish: Function sending a reported properties patch. Returns False when the
+                        device is offline (the full state is sent again by reset() after
+                        the reconnect) and raises on failure.
+        :param defer: Optional function, True while updates should use the deferred interval.
+        """
+        self.name = name
+        self._read_states = read_states
+        self._publish = publish
+        self.settle_s = settle_s
+        self.min_interval_s = min_interval_s
+        self._defer = defer or (lambda: False)
+        self.deferred_interval_s = deferred_interval_s
+
+        self._changed = threading.Event()
+        self._published = None       # states as last acknowledged by the hub, None = unknown
+        self._generation = 0         # incremented by reset()
+        self._last_publish = 0.0
+        self.updates = 0
+
+        self._thread = threading.Thread(target=self._run, name=f"machine-state-{name}", daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        """Signal that some machine may have changed state. Cheap, never blocks."""
+        self._changed.set()
+
+    def reset(self):
+        """Forget what was published (e.g. after a reconnect) and publish the full state again."""
+        self._generation += 1
+        self._published = None
+        self._changed.set()
+
+    def _patch(self, states: dict) -> dict:
+        """Reported properties patch with only the machines that changed since the last update."""
+        published = self._published or {}
+        machines = {machine_id: state for machine_id, state in states.items()
+                    if published.get(machine_id) != state}
+        if self._published is not None:
+            # Machines removed from the configuration are deleted from the twin
+            machines.update({machine_id: None for machine_id in published if machine_id not in states})
+        if not machines and self._published is not None:
+            return None
+        return {
+            "machines": machines,
+            "machines_updated_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+
+    def _run(self):
+        while True:
+            self._changed.wait()
+            # Let bursts of edges (and the next train of a queue) settle
+            time.sleep(self.settle_s)
+            interval = self.deferred_interval_s if self._defer() else self.min_interval_s
+            wait = self._last_publish + interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._changed.clear()
+
+            generation = self._generation
+            try:
+                states = self._read_states()
+                patch = self._patch(states)
+                if patch is None or not self._publish(patch):
+                    continue
+            except Exception as e:
+                logging.warning("machine_state: %s: Could not publish machine state - %s", self.name, e)
+                self._last_publish = time.monotonic()
+                # Try again after the minimum interval
+                self._changed.set()
+                continue
+
+            if generation == self._generation:
+                self._published = states
+            self._last_publish = time.monotonic()
+            self.updates += 1
+            logging.info("machine_state: %s: Published %d machine(s)", self.name, len(patch["machines"]))
@@ -0,0 +1,180 @@
+"""
+Filename: memory_stats.py
+
+Memory accounting for the receiver process.
+
+A background thread samples RSS, garbage collector and thread statistics at a
+fixed interval. RSS is also recorded at every IoT Hub reconnect, and growth
+across consecutive reconnects is flagged. On demand (SIGUSR2 or the
+memory_snapshot C2D message) a tracemalloc snapshot is captured and diffed
+against the previous one; the first trigger only starts tracing, because
+tracemalloc costs memory and CPU while active.
+
+Environment:
+    MEMORY_SAMPLE_INTERVAL_S   sampling interval (default 300)
+    MEMORY_TRACEMALLOC=1       trace allocations from startup
+"""
+
+import collections
+import gc
+import logging
+import os
+import resource
+import signal
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from paths import DIAGNOSTICS_DIR
+
+SNAPSHOT_DIR = DIAGNOSTICS_DIR
+
+SAMPLE_INTERVAL_S = float(os.getenv("MEMORY_SAMPLE_INTERVAL_S", "300"))
+TRACE_FRAMES = 10
+TOP_DIFFERENCES = 20
+# Flag growth when RSS went up at each of the last N reconnects by this much in total
+RECONNECT_GROWTH_WINDOW = 3
+RECONNECT_GROWTH_KB = 2048
+
+
+def read_rss_kb() -> int:
+    """Current resident set size of this process in kB."""
+    try:
+        with open("/proc/self/statm", 'r') as file:
+            resident_pages = int(file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is the peak, better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MemoryMonitor:
+    """Periodic RSS/GC sampling, reconnect growth detection and tracemalloc diffs."""
+
+    def __init__(self, interval_s: float = SAMPLE_INTERVAL_S, history: int = 288):
+        self.interval_s = interval_s
+        self.samples = collections.deque(maxlen=history)
+        self.reconnects = collections.deque(maxlen=RECONNECT_GROWTH_WINDOW + 1)
+        self.growth_flagged = False
+        self._previous_snapshot = None
+        self._lock = threading.Lock()
+
+        if os.getenv("MEMORY_TRACEMALLOC", "0").lower() in ("1", "true", "yes"):
+            tracemalloc.start(TRACE_FRAMES)
+
+        self._thread = threading.Thread(target=self._run, name="memory-monitor", daemon=True)
+        self._thread.start()
+
+    def sample(self) -> dict:
+        generations = gc.get_stats()
+        entry = {
+            "time": time.time(),
+            "rss_kb": read_rss_kb(),
+            "gc_collections": [generation['collections'] for generation in generations],
+            "gc_uncollectable": sum(generation['uncollectable'] for generation in generations),
+            "threads": threading.active_count(),
+        }
+        with self._lock:
+            self.samples.append(entry)
+        return entry
+
+    def _run(self):
+        while True:
+            try:
+                entry = self.sample()
+                logging.info("memory_stats: RSS %d kB, GC collections %s, uncollectable %d, threads %d",
+                             entry['rss_kb'], entry['gc_collections'],
+                             entry['gc_uncollectable'], entry['threads'])
+            except Exception as e:
+                logging.error("memory_stats: Sampling failed - %s", e)
+            time.sleep(self.interval_s)
+
+    def mark_reconnect(self):
+        """Record RSS at an IoT Hub (re)connection and flag steady growth."""
+        rss_kb = read_rss_kb()
+        with self._lock:
+            self.reconnects.append(rss_kb)
+            values = list(self.reconnects)
+        if len(values) <= RECONNECT_GROWTH_WINDOW:
+            return
+        increasing = all(later > earlier for earlier, later in zip(values, values[1:]))
+        growth = values[-1] - values[0]
+        if increasing and growth >= RECONNECT_GROWTH_KB:
+            self.growth_flagged = True
+            logging.warning("memory_stats: RSS grew by %d kB over the last %d reconnects (%s kB)",
+                            growth, RECONNECT_GROWTH_WINDOW, values)
+
+    def summary(self) -> dict:
+        """Compact view for status replies."""
+        with self._lock:
+            latest = self.samples[-1] if self.samples else None
+            peak = max((entry['rss_kb'] for entry in self.samples), default=None)
+            reconnects = list(self.reconnects)
+        return {
+            "rss_kb": read_rss_kb(),
+            "peak_sampled_rss_kb": peak,
+            "threads": threading.active_count(),
+            "gc_uncollectable": latest['gc_uncollectable'] if latest else None,
+            "rss_at_reconnects_kb": reconnects,
+            "reconnect_growth": self.growth_flagged,
+            "tracing": tracemalloc.is_tracing(),
+        }
+
+    def snapshot(self, reason: str = "manual") -> dict:
+        """
+        Capture a tracemalloc snapshot and diff it against the previous one.
+        The first call starts tracing and only records a baseline.
+
+        :return: Report with the top allocation differences and the report file path.
+        """
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACE_FRAMES)
+                self._previous_snapshot = tracemalloc.take_snapshot()
+                logging.info("memory_stats: tracemalloc started (%s), baseline captured", reason)
+                return {"status": "baseline", "rss_kb": read_rss_kb()}
+
+            current = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ))
+            previous = self._previous_snapshot
+            self._previous_snapshot = current
+
+        traced_kb, peak_kb = (value // 1024 for value in tracemalloc.get_traced_memory())
+        if previous is None:
+            top = [str(stat) for stat in current.statistics('lineno')[:TOP_DIFFERENCES]]
+        else:
+            top = [str(stat) for stat in current.compare_to(previous, 'lineno')[:TOP_DIFFERENCES]]
+
+        report = {
+            "status": "diff" if previous is not None else "snapshot",
+            "reason": reason,
+            "rss_kb": read_rss_kb(),
+            "traced_kb": traced_kb,
+            "traced_peak_kb": peak_kb,
+            "top": top,
+        }
+
+        try:
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+            report_path = os.path.join(SNAPSHOT_DIR, f"memory_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
+            with open(report_path, 'w') as file:
+                file.write(f"reason: {reason}\nrss_kb: {report['rss_kb']}\n")
+                file.write(f"traced_kb: {traced_kb}\ntraced_peak_kb: {peak_kb}\n\n")
+                file.write("\n".join(top) + "\n")
+            report["file"] = report_path
+        except OSError as e:
+            logging.warning("memory_stats: Could not write snapshot report - %s", e)
+
+        logging.info("memory_stats: Snapshot (%s) RSS %d kB, traced %d kB", reason, report['rss_kb'], traced_kb)
+        for line in top[:5]:
+            logging.info("memory_stats:     %s", line)
+        return report
+
+    def install_signal_handler(self, signum: int = signal.SIGUSR2):
+        """Take a snapshot on SIGUSR2. Must be called from the main thread."""
+        def handler(signum, frame):
+            threading.Thread(target=self.snapshot, args=("signal",), name="memory-snapshot", daemon=True).start()
+        signal.signal(signum, handler)
@@ -0,0 +1,111 @@
+"""
+Filename: net_probe.py
+
+Network path timing probe: measures DNS resolution, TCP connect, TLS handshake
+and time to first byte of an HTTPS request separately, over several samples,
+using sockets only (no subprocesses). Each sample opens a new connection, so
+every phase is measured as a cold activation would see it.
+"""
+
+import math
+import socket
+import ssl
+import time
+
+DEFAULT_TIMEOUT_S = 10
+PHASES = ("dns", "tcp", "tls", "ttfb")
+
+
+def percentile(values: list, fraction: float):
+    """Nearest-rank percentile, None for an empty list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def probe_once(host: str, port: int = 443, path: str = "/", timeout_s: float = DEFAULT_TIMEOUT_S) -> dict:
+    """
+    Time one HTTPS request phase by phase.
+
+    :return: Dictionary with the duration of each phase in ms, the HTTP status line and
+             the address used; "error" and "phase" are set when a phase failed.
+    """
+    result = {"host": host}
+    phase = "dns"
+    sock = None
+    try:
+        start = time.perf_counter()
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+        result["dns"] = (resolved - start) * 1000.0
+        family, sock_type, proto, _, address = addresses[0]
+        result["address"] = address[0]
+
+        phase = "tcp"
+        sock = socket.socket(family, sock_type, proto)
+        sock.settimeout(timeout_s)
+        sock.connect(address)
+        connected = time.perf_counter()
+        result["tcp"] = (connected - resolved) * 1000.0
+
+        phase = "tls"
+        context = ssl.create_default_context()
+        sock = context.wrap_socket(sock, server_hostname=host)
+        handshaken = time.perf_counter()
+        result["tls"] = (handshaken - connected) * 1000.0
+        result["tls_version"] = sock.version()
+
+        phase = "ttfb"
+        request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: pagalava-probe\r\nConnection: close\r\n\r\n"
+        sock.sendall(request.encode('ascii'))
+        sent = time.perf_counter()
+        first = sock.recv(256)
+        received = time.perf_counter()
+        if not first:
+            raise ConnectionError("connection closed before the response")
+        result["ttfb"] = (received - sent) * 1000.0
+        result["status"] = first.split(b"\r\n", 1)[0].decode('ascii', errors='replace')
+    except (OSError, ssl.SSLError, ValueError) as e:
+        result["error"] = str(e) or type(e).__name__
+        result["phase"] = phase
+    finally:
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+    return result
+
+
+def probe(host: str, samples: int = 5, port: int = 443, path: str = "/",
+          timeout_s: float = DEFAULT_TIMEOUT_S, pause_s: float = 0.2) -> dict:
+    """
+    Run several samples against a host and summarize each phase.
+
+    :return: {"host", "samples", "errors": [...], "phases": {phase: {"p50", "p95", "max"}}, "status"}
+    """
+    results = []
+    for index in range(samples):
+        results.append(probe_once(host, port, path, timeout_s))
+        if pause_s and index < samples - 1:
+            time.sleep(pause_s)
+
+    summary = {"host": host, "samples": samples, "errors": [], "phases": {}}
+    for result in results:
+        if "error" in result:
+            summary["errors"].append(f"{result['phase']}: {result['error']}")
+        if "status" in result:
+            summary["status"] = result["status"]
+        if "address" in result:
+            summary["address"] = result["address"]
+    for phase in PHASES:
+        values = [result[phase] for result in results if phase in result]
+        if values:
+            summary["phases"][phase] = {
+                "p50": round(percentile(values, 0.50), 1),
+                "p95": round(percentile(values, 0.95), 1),
+                "max": round(max(values), 1),
+            }
+    return summary
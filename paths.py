@@ -0,0 +1,18 @@
+"""
+Filename: paths.py
+
+Directories the service writes to, defined once for every module.
+
+PAGALAVA_DATA_DIR moves all of them: trace_replay.py and the bench of
+iothub_standin.py run the receiver against a scratch directory, and nothing may
+then be written into the installation. Without it, state goes to data/ and the
+reports, snapshots and stacks meant for the technician to diagnostics/, next to
+the code.
+"""
+
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.getenv("PAGALAVA_DATA_DIR", os.path.join(SCRIPT_DIR, "data"))
+DIAGNOSTICS_DIR = (os.path.join(DATA_DIR, "diagnostics") if os.getenv("PAGALAVA_DATA_DIR")
+                   else os.path.join(SCRIPT_DIR, "diagnostics"))
@@ -0,0 +1,402 @@
+"""
+Filename: pulse_scheduler.py
+
+Pulse-timing thread for relay activations.
+
+Pulse trains are turned into absolute edge deadlines (anchored to the start of
+the train, so late wake-ups do not accumulate) and executed by one dedicated
+thread. Edges of different relays that fall in the same tick are applied with a
+single backend call. The timing error of every edge is kept in a histogram per
+relay, so the worst-case jitter under load can be read back from the device.
+
+Optional real-time mode (PULSE_REALTIME=1) puts the timing thread under
+SCHED_FIFO, locks the process memory (mlockall) and pins the thread to an
+isolated CPU core when the kernel was booted with isolcpus. The systemd unit
+must allow it (LimitRTPRIO, LimitMEMLOCK); failures only log a warning.
+"""
+
+import ctypes
+import ctypes.util
+import heapq
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+
+from relay_backends import LOW, HIGH
+
+REALTIME_ENABLED = os.getenv("PULSE_REALTIME", "0").lower() in ("1", "true", "yes")
+REALTIME_PRIORITY = int(os.getenv("PULSE_RT_PRIORITY", "50"))
+
+# Wake up this long before an edge and busy-wait the rest
+SPIN_S = 0.002
+# Edges due within this window are applied together
+COALESCE_S = 0.0005
+# The thread wakes up at least this often, see heartbeat
+IDLE_WAKE_S = 1.0
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+class JitterHistogram:
+    """Edge timing error histogram with power-of-two microsecond buckets."""
+
+    BUCKETS = 22  # <=1us ... <=2^20us (~1s), last bucket is everything above
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.count = 0
+        self.total_us = 0.0
+        self.max_us = 0.0
+
+    def record(self, error_s: float):
+        error_us = max(0.0, error_s * 1e6)
+        index = 0
+        while index < self.BUCKETS and error_us > (1 << index):
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total_us += error_us
+        self.max_us = max(self.max_us, error_us)
+
+    def percentile_us(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of the samples."""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return float(1 << index) if index < self.BUCKETS else self.max_us
+        return self.max_us
+
+    def snapshot(self) -> dict:
+        return {
+            "edges": self.count,
+            "mean_us": round(self.total_us / self.count, 1) if self.count else 0.0,
+            "p99_us": self.percentile_us(0.99),
+            "max_us": round(self.max_us, 1),
+            "buckets_us": {
+                (f"<={1 << index}" if index < self.BUCKETS else f">{1 << (self.BUCKETS - 1)}"): bucket_count
+                for index, bucket_count in enumerate(self.counts) if bucket_count
+            },
+        }
+
+
+class TrainAborted(Exception):
+    """Raised for a pulse train that was aborted before it finished (e.g. service stopping)."""
+
+
+class PulseTrain:
+    """A number of relay pulses with fixed on-time and interval, executed by the scheduler."""
+
+    def __init__(self, relay_number: int, pulses: int, on_s: float, interval_s: float,
+                 tail_s: float = 0.0, progress: dict = None, on_pulse=None):
+        """
+        :param on_pulse: Optional function called with the train after every completed
+                         pulse, on the timing thread. Must be cheap and never block.
+        """
+        self.relay_number = relay_number
+        self.pulses = pulses
+        self.on_s = on_s
+        self.interval_s = interval_s
+        self.tail_s = tail_s
+        self.progress = progress if progress is not None else {}
+        self.progress['impulses_requested'] = pulses
+        self.progress.setdefault('impulses_delivered', 0)
+        self.on_pulse = on_pulse
+
+        self.delivered = 0
+        self.start = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self.done.wait(timeout)
+
+
+def _isolated_cpus() -> set:
+    """CPUs listed in /sys/devices/system/cpu/isolated (isolcpus= boot option)."""
+    try:
+        with open("/sys/devices/system/cpu/isolated", 'r') as file:
+            text = file.read().strip()
+    except OSError:
+        return set()
+    cpus = set()
+    for part in filter(None, text.split(',')):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def enable_realtime(priority: int = REALTIME_PRIORITY) -> dict:
+    """
+    Switch the calling thread to SCHED_FIFO, lock the process memory and pin the
+    thread to an isolated core if there is one. Returns what could be applied.
+    """
+    applied = {"sched_fifo": False, "mlockall": False, "cpu": None}
+
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        applied["sched_fifo"] = True
+    except (AttributeError, OSError) as e:
+        logging.warning("pulse_scheduler: SCHED_FIFO not available - %s", e)
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+            applied["mlockall"] = True
+        else:
+            logging.warning("pulse_scheduler: mlockall failed - %s", os.strerror(ctypes.get_errno()))
+    except (OSError, AttributeError) as e:
+        logging.warning("pulse_scheduler: mlockall not available - %s", e)
+
+    isolated = _isolated_cpus() & os.sched_getaffinity(0)
+    if isolated:
+        cpu = max(isolated)
+        try:
+            os.sched_setaffinity(0, {cpu})
+            applied["cpu"] = cpu
+        except OSError as e:
+            logging.warning("pulse_scheduler: Could not pin to CPU %s - %s", cpu, e)
+
+    # The timing thread still needs the GIL, hand it over more often
+    sys.setswitchinterval(0.001)
+
+    logging.info("pulse_scheduler: Real-time mode %s", applied)
+    return applied
+
+
+class PulseScheduler:
+    """Runs pulse trains on a dedicated timing thread, one train at a time per relay."""
+
+    def __init__(self, apply_changes, realtime: bool = REALTIME_ENABLED):
+        """
+        :param apply_changes: Function taking {relay_number: state} and driving the relays.
+        :param realtime: Enable SCHED_FIFO/mlockall/affinity on the timing thread.
+        """
+        self._apply_changes = apply_changes
+        self.realtime = realtime
+        self.realtime_status = None
+
+        self._cond = threading.Condition()
+        self._heap = []                # (deadline, seq, train, state), state None = train end
+        self._seq = itertools.count()
+        self._active = {}              # relay_number -> running train
+        self._queued = {}              # relay_number -> [trains waiting for the relay]
+        self.histograms = {}           # relay_number -> JitterHistogram
+        self.heartbeat = time.monotonic()
+        self._listeners = []
+        self._abort_reason = None
+        self._aborted = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name="pulse-timing", daemon=True)
+        self._thread.start()
+
+    def submit(self, train: PulseTrain) -> PulseTrain:
+        """
+        Queue a pulse train. It starts as soon as its relay is free.
+
+        :raises ValueError: If the number of pulses is not a non-negative integer.
+        """
+        # Checked before the relay is marked busy, a bad train must not hold it
+        if isinstance(train.pulses, bool) or not isinstance(train.pulses, int) or train.pulses < 0:
+            raise ValueError(f"invalid number of pulses: {train.pulses!r}")
+        with self._cond:
+            if train.relay_number in self._active:
+                self._queued.setdefault(train.relay_number, []).append(train)
+            else:
+                self._start(train, time.monotonic())
+            self._cond.notify()
+        self._notify_listeners()
+        return train
+
+    def add_listener(self, callback):
+        """
+        Call callback() whenever a relay becomes busy or idle, or a train is queued.
+        It runs on the timing thread (or the submitting thread) and must not block.
+        """
+        self._listeners.append(callback)
+
+    def _notify_listeners(self):
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception as e:
+                logging.warning("pulse_scheduler: Listener failed - %s", e)
+
+    def _start(self, train: PulseTrain, now: float):
+        self._active[train.relay_number] = train
+        train.start = now
+        if train.pulses <= 0:
+            self._push(now, train, None)
+        else:
+            self._push(now, train, LOW)
+
+    def _push(self, deadline: float, train: PulseTrain, state):
+        heapq.heappush(self._heap, (deadline, next(self._seq), train, state))
+
+    def _finish(self, train: PulseTrain, now: float):
+        del self._active[train.relay_number]
+        train.done.set()
+        waiting = self._queued.get(train.relay_number)
+        if waiting:
+            self._start(waiting.pop(0), now)
+            if not waiting:
+                del self._queued[train.relay_number]
+
+    def _wait_next(self):
+        """Sleep until the next edge is close, then busy-wait to its deadline. Returns the due edges."""
+        with self._cond:
+            self.heartbeat = time.monotonic()
+            if not self._heap:
+                self._cond.wait(IDLE_WAKE_S)
+                return []
+            deadline = self._heap[0][0]
+            delay = deadline - time.monotonic()
+            if delay > SPIN_S:
+                self._cond.wait(min(delay - SPIN_S, IDLE_WAKE_S))
+                return []
+
+        while time.monotonic() < deadline:
+            pass
+
+        with self._cond:
+            limit = time.monotonic() + COALESCE_S
+            due = []
+            while self._heap and self._heap[0][0] <= limit:
+                due.append(heapq.heappop(self._heap))
+            return due
+
+    def _fire(self, due: list):
+        changes = {}
+        edges = []
+        endings = []
+        for deadline, _, train, state in due:
+            if state is None:
+                endings.append(train)
+            else:
+                changes[train.relay_number] = state
+                edges.append((deadline, train, state))
+
+        error = None
+        if changes:
+            try:
+                self._apply_changes(changes)
+            except Exception as e:
+                error = e
+        applied_at = time.monotonic()
+        applied_wall = time.time()
+
+        with self._cond:
+            for deadline, train, state in edges:
+                if error is not None:
+                    train.error = error
+                    endings.append(train)
+                    continue
+                self.histograms.setdefault(train.relay_number, JitterHistogram()).record(applied_at - deadline)
+                progress = train.progress
+                if progress.get('first_edge') is None:
+                    progress['first_edge'] = applied_wall
+                progress['last_edge'] = applied_wall
+
+                # Deadlines are anchored to the start of the train
+                pulse_start = train.start + train.delivered * (train.on_s + train.interval_s)
+                if state == LOW:
+                    self._push(pulse_start + train.on_s, train, HIGH)
+                else:
+                    train.delivered += 1
+                    progress['impulses_delivered'] = train.delivered
+                    if train.on_pulse is not None:
+                        try:
+                            train.on_pulse(train)
+                        except Exception as e:
+                            logging.warning("pulse_scheduler: Pulse callback failed - %s", e)
+                    if train.delivered < train.pulses:
+                        self._push(pulse_start + train.on_s + train.interval_s, train, LOW)
+                    else:
+                        self._push(pulse_start + train.on_s + train.tail_s, train, None)
+
+            for train in endings:
+                if train.relay_number in self._active and self._active[train.relay_number] is train:
+                    self._finish(train, applied_at)
+
+        if endings:
+            self._notify_listeners()
+
+        if error is not None:
+            logging.error("pulse_scheduler: Failed to drive relays %s - %s", sorted(changes), error)
+            # Never leave a relay energized after a failed transition
+            try:
+                self._apply_changes({relay: HIGH for relay in changes})
+            except Exception:
+                pass
+
+    def _run(self):
+        if self.realtime:
+            self.realtime_status = enable_realtime()
+        while True:
+            try:
+                due = self._wait_next()
+                if self._abort_reason is not None:
+                    # Edges already due belong to trains that are being aborted
+                    self._abort_in_flight()
+                elif due:
+                    self._fire(due)
+            except Exception as e:
+                logging.error("pulse_scheduler: Unexpected error in timing thread - %s", e)
+
+    def abort_all(self, reason: str = "aborted", timeout: float = 1.0) -> bool:
+        """
+        Abort every running and queued train: their relays are released at once and
+        waiting callers get TrainAborted. Executed by the timing thread, so no edge
+        of an aborted train can be applied after its relay was released.
+
+        :return: True if the timing thread completed the abort within the timeout.
+        """
+        with self._cond:
+            self._aborted.clear()
+            self._abort_reason = reason
+            self._cond.notify()
+        return self._aborted.wait(timeout)
+
+    def _abort_in_flight(self):
+        with self._cond:
+            reason = self._abort_reason
+            trains = list(self._active.values())
+            trains += [train for waiting in self._queued.values() for train in waiting]
+            relays = sorted(self._active)
+            self._heap = []
+            self._active.clear()
+            self._queued.clear()
+            self._abort_reason = None
+
+        if relays:
+            try:
+                self._apply_changes({relay: HIGH for relay in relays})
+            except Exception as e:
+                logging.error("pulse_scheduler: Failed to release relays %s - %s", relays, e)
+        for train in trains:
+            train.error = TrainAborted(f"{reason} after {train.delivered}/{train.pulses} pulses")
+            train.done.set()
+        if trains:
+            logging.warning("pulse_scheduler: Aborted %d train(s) (%s), relays %s released",
+                            len(trains), reason, relays)
+            self._notify_listeners()
+        self._aborted.set()
+
+    def busy_relays(self) -> dict:
+        """Relays with a running train and the number of trains queued behind it."""
+        with self._cond:
+            return {relay: len(self._queued.get(relay, [])) for relay in self._active}
+
+    def jitter_snapshot(self) -> dict:
+        with self._cond:
+            return {relay: histogram.snapshot() for relay, histogram in sorted(self.histograms.items())}
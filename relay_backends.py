@@ -0,0 +1,538 @@
+"""
+Filename: relay_backends.py
+
+Relay output backends. A backend is built from a board profile (relay_boards.json)
+and drives one or more boards:
+
+    gpio      relays wired directly to Raspberry Pi BCM pins, driven through
+              RPi.GPIO, or through the GPIO character device (libgpiod / lgpio)
+              on the Raspberry Pi 5 and wherever RPi.GPIO is unavailable
+    mcp23s17  relays behind an MCP23S17 SPI GPIO expander (spidev)
+    mcp23017  relays behind an MCP23017 I2C GPIO expander (/dev/i2c-N)
+
+Every board keeps a shadow of its output state, so redundant writes are skipped
+and all transitions applied in the same call go out together (one bus
+transaction per expander chip).
+
+The driver of "gpio" boards is chosen with the board's "driver" key or the
+RELAY_GPIO_DRIVER variable: rpi, gpiod, lgpio or auto (default).
+
+Setting RELAY_SIMULATED=1 replaces every driver with an in-memory simulation,
+which allows running the relay code on machines without relay hardware.
+
+Profile example (see archive/relay_boards_sample.json):
+{
+    "boards": [
+        {"type": "gpio", "relays": {"1": 22, "2": 23}},
+        {"type": "mcp23s17", "spi_bus": 0, "spi_device": 0, "address": 0,
+         "relays": {"17": 0, "18": 1}}
+    ]
+}
+"""
+
+import collections
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+# Pin levels. The relay modules are active-low: LOW energizes the relay.
+LOW = 0
+HIGH = 1
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BOARD_PROFILE_FILE = os.getenv("RELAY_BOARD_FILE", os.path.join(SCRIPT_DIR, "relay_boards.json"))
+GPIO_DRIVER = os.getenv("RELAY_GPIO_DRIVER", "auto").lower()
+GPIO_CONSUMER = "pagalava"
+
+
+def _int(value) -> int:
+    """Accept ints and numeric strings, including hexadecimal ones such as '0x20'."""
+    return value if isinstance(value, int) else int(str(value), 0)
+
+
+#
+# Buses for the GPIO expanders
+#
+
+
+# MCP23x17 registers with IOCON.BANK = 0 (power-on default)
+MCP_IODIRA = 0x00
+MCP_IOCON = 0x0A
+MCP_GPIOA = 0x12
+MCP_OLATA = 0x14
+MCP_IOCON_HAEN = 0x08
+
+
+class SpiBus:
+    """MCP23S17 register access through spidev."""
+
+    def __init__(self, bus: int = 0, device: int = 0, speed_hz: int = 1000000):
+        import spidev
+        self._spi = spidev.SpiDev()
+        self._spi.open(bus, device)
+        self._spi.max_speed_hz = speed_hz
+        self._spi.mode = 0
+
+    def write_registers(self, address: int, register: int, data: bytes):
+        self._spi.xfer2([0x40 | (address << 1), register] + list(data))
+
+    def read_registers(self, address: int, register: int, count: int) -> bytes:
+        reply = self._spi.xfer2([0x41 | (address << 1), register] + [0] * count)
+        return bytes(reply[2:])
+
+    def close(self):
+        self._spi.close()
+
+
+class I2cBus:
+    """MCP23017 register access through the i2c-dev character device."""
+
+    I2C_SLAVE = 0x0703
+    BASE_ADDRESS = 0x20
+
+    def __init__(self, bus: int = 1):
+        self._fd = os.open(f"/dev/i2c-{bus}", os.O_RDWR)
+
+    def _select(self, address: int):
+        fcntl.ioctl(self._fd, self.I2C_SLAVE, self.BASE_ADDRESS | address)
+
+    def write_registers(self, address: int, register: int, data: bytes):
+        self._select(address)
+        os.write(self._fd, bytes([register]) + bytes(data))
+
+    def read_registers(self, address: int, register: int, count: int) -> bytes:
+        self._select(address)
+        os.write(self._fd, bytes([register]))
+        return os.read(self._fd, count)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SimulatedBus:
+    """
+    In-memory MCP23x17 register file. Every write is recorded as one
+    transaction (time, address, register, data) for inspection in tests.
+    """
+
+    def __init__(self, history: int = 10000):
+        self.registers = collections.defaultdict(lambda: bytearray(0x16))
+        self.transactions = collections.deque(maxlen=history)
+
+    def write_registers(self, address: int, register: int, data: bytes):
+        self.transactions.append((time.monotonic(), address, register, bytes(data)))
+        self.registers[address][register:register + len(data)] = bytes(data)
+        if register <= MCP_OLATA + 1 and register + len(data) > MCP_OLATA:
+            # Outputs follow the latches
+            self.registers[address][MCP_GPIOA:MCP_GPIOA + 2] = self.registers[address][MCP_OLATA:MCP_OLATA + 2]
+
+    def read_registers(self, address: int, register: int, count: int) -> bytes:
+        return bytes(self.registers[address][register:register + count])
+
+    def close(self):
+        pass
+
+
+#
+# Boards
+#
+
+
+class GpioBoard:
+    """Relays wired directly to BCM pins, driven through RPi.GPIO."""
+
+    def __init__(self, relays: dict):
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+        self.relay_pins = {_int(relay): _int(pin) for relay, pin in relays.items()}
+        self.relays = set(self.relay_pins)
+        self._shadow = {relay: HIGH for relay in self.relays}
+
+        GPIO.setmode(GPIO.BCM)  # Use BCM GPIO numbering
+        GPIO.setup(list(self.relay_pins.values()), GPIO.OUT, initial=GPIO.HIGH)
+
+    def describe(self, relay_number: int) -> str:
+        return f"GPIO: {self.relay_pins[relay_number]}"
+
+    def apply(self, changes: dict):
+        changed = {relay: state for relay, state in changes.items() if self._shadow[relay] != state}
+        if not changed:
+            return
+        # RPi.GPIO accepts a list of channels with a matching list of values
+        self._gpio.output([self.relay_pins[relay] for relay in changed], list(changed.values()))
+        self._shadow.update(changed)
+
+    def read(self, relay_number: int):
+        return self._gpio.input(self.relay_pins[relay_number])
+
+    def close(self):
+        self._gpio.cleanup(list(self.relay_pins.values()))
+
+
+class GpiodBoard:
+    """
+    Relays on BCM pins driven through the GPIO character device with libgpiod
+    (python3-libgpiod, v2 API with a fallback to v1). All relay lines are
+    requested once; transitions of several relays are applied with a single
+    multi-line set call and the shadow state skips redundant writes.
+
+    Works on the Raspberry Pi 5 (RP1 header chip) and on plain Linux with the
+    gpio-sim kernel module, by pointing "chip" at the simulated /dev/gpiochipN.
+    """
+
+    def __init__(self, relays: dict, chip: str = None):
+        import gpiod
+        self._gpiod = gpiod
+        self.chip_path = chip or find_header_chip()
+        self.relay_pins = {_int(relay): _int(pin) for relay, pin in relays.items()}
+        self.relays = set(self.relay_pins)
+        self._shadow = {relay: HIGH for relay in self.relays}
+        offsets = sorted(set(self.relay_pins.values()))
+
+        if hasattr(gpiod, 'request_lines'):
+            from gpiod.line import Direction, Value
+            self._values = {LOW: Value.INACTIVE, HIGH: Value.ACTIVE}
+            self._request = gpiod.request_lines(
+                self.chip_path,
+                consumer=GPIO_CONSUMER,
+                config={tuple(offsets): gpiod.LineSettings(direction=Direction.OUTPUT,
+                                                           output_value=Value.ACTIVE)}
+            )
+            self._v1_lines = None
+        else:
+            chip_handle = gpiod.Chip(self.chip_path)
+            self._v1_lines = chip_handle.get_lines(offsets)
+            self._v1_lines.request(consumer=GPIO_CONSUMER, type=gpiod.LINE_REQ_DIR_OUT,
+                                   default_vals=[HIGH] * len(offsets))
+            self._v1_offsets = offsets
+            self._v1_levels = {offset: HIGH for offset in offsets}
+            self._request = None
+
+    def describe(self, relay_number: int) -> str:
+        return f"GPIO: {self.relay_pins[relay_number]}"
+
+    def apply(self, changes: dict):
+        changed = {relay: state for relay, state in changes.items() if self._shadow[relay] != state}
+        if not changed:
+            return
+        if self._request is not None:
+            self._request.set_values({self.relay_pins[relay]: self._values[state]
+                                      for relay, state in changed.items()})
+        else:
+            # The v1 bulk call takes the values of every requested line
+            for relay, state in changed.items():
+                self._v1_levels[self.relay_pins[relay]] = state
+            self._v1_lines.set_values([self._v1_levels[offset] for offset in self._v1_offsets])
+        self._shadow.update(changed)
+
+    def read(self, relay_number: int):
+        offset = self.relay_pins[relay_number]
+        if self._request is not None:
+            return 1 if self._request.get_value(offset) == self._values[HIGH] else 0
+        return self._v1_lines.get_values()[self._v1_offsets.index(offset)]
+
+    def close(self):
+        if self._request is not None:
+            self._request.set_values({offset: self._values[HIGH] for offset in set(self.relay_pins.values())})
+            self._request.release()
+        else:
+            self._v1_lines.set_values([HIGH] * len(self._v1_offsets))
+            self._v1_lines.release()
+
+
+class LgpioBoard:
+    """
+    Relays on BCM pins driven through lgpio (python3-lgpio). The relay pins are
+    claimed once as a group, and a transition of several relays is a single
+    group_write with a bit mask. The chip is a number or, as for GpiodBoard,
+    a /dev/gpiochipN path.
+    """
+
+    def __init__(self, relays: dict, chip=0):
+        import lgpio
+        self._lgpio = lgpio
+        self.relay_pins = {_int(relay): _int(pin) for relay, pin in relays.items()}
+        self.relays = set(self.relay_pins)
+        self._shadow = {relay: HIGH for relay in self.relays}
+        self._pins = sorted(set(self.relay_pins.values()))
+        self._bit_of = {pin: 1 << index for index, pin in enumerate(self._pins)}
+
+        if isinstance(chip, str) and chip.startswith("/dev/gpiochip"):
+            chip = chip[len("/dev/gpiochip"):]
+        self._handle = lgpio.gpiochip_open(_int(chip))
+        lgpio.group_claim_output(self._handle, self._pins, [HIGH] * len(self._pins))
+
+    def describe(self, relay_number: int) -> str:
+        return f"GPIO: {self.relay_pins[relay_number]}"
+
+    def apply(self, changes: dict):
+        changed = {relay: state for relay, state in changes.items() if self._shadow[relay] != state}
+        if not changed:
+            return
+        bits = 0
+        mask = 0
+        for relay, state in changed.items():
+            bit = self._bit_of[self.relay_pins[relay]]
+            mask |= bit
+            if state:
+                bits |= bit
+        self._lgpio.group_write(self._handle, self._pins[0], bits, mask)
+        self._shadow.update(changed)
+
+    def read(self, relay_number: int):
+        return self._lgpio.gpio_read(self._handle, self.relay_pins[relay_number])
+
+    def close(self):
+        self._lgpio.group_write(self._handle, self._pins[0], (1 << len(self._pins)) - 1)
+        self._lgpio.group_free(self._handle, self._pins[0])
+        self._lgpio.gpiochip_close(self._handle)
+
+
+def is_raspberry_pi_5() -> bool:
+    try:
+        with open("/proc/device-tree/model", 'r') as file:
+            return "Raspberry Pi 5" in file.read()
+    except OSError:
+        return False
+
+
+def find_header_chip() -> str:
+    """
+    Return the character device of the 40-pin header. On the Raspberry Pi 5 it is
+    the RP1 controller, which is gpiochip4 on older kernels and gpiochip0 on newer.
+    """
+    header_labels = ("pinctrl-rp1", "pinctrl-bcm2711", "pinctrl-bcm2835")
+    try:
+        import gpiod
+        for name in sorted(os.listdir("/dev")):
+            if not name.startswith("gpiochip"):
+                continue
+            path = os.path.join("/dev", name)
+            try:
+                if hasattr(gpiod, 'request_lines'):
+                    with gpiod.Chip(path) as chip:
+                        label = chip.get_info().label
+                else:
+                    label = gpiod.Chip(path).label()
+            except (OSError, AttributeError):
+                continue
+            if label in header_labels:
+                return path
+    except (ImportError, OSError):
+        pass
+    return "/dev/gpiochip0"
+
+
+def _create_gpio_board(board: dict):
+    """Pick the GPIO driver for an on-board relay group."""
+    relays = board.get('relays', {})
+    driver = str(board.get('driver', GPIO_DRIVER)).lower()
+
+    if driver == 'auto':
+        # RPi.GPIO cannot drive the Raspberry Pi 5 header
+        if not is_raspberry_pi_5():
+            try:
+                return GpioBoard(relays)
+            except (ImportError, RuntimeError) as e:
+                logging.warning("relay_backends: RPi.GPIO unavailable (%s), trying the GPIO character device", e)
+        try:
+            return GpiodBoard(relays, board.get('chip'))
+        except ImportError:
+            return LgpioBoard(relays, board.get('chip', 0))
+
+    if driver == 'rpi':
+        return GpioBoard(relays)
+    if driver == 'gpiod':
+        return GpiodBoard(relays, board.get('chip'))
+    if driver == 'lgpio':
+        return LgpioBoard(relays, board.get('chip', 0))
+    raise ValueError(f"Unknown GPIO driver: {driver}")
+
+
+class ExpanderBoard:
+    """
+    Relays behind one MCP23S17/MCP23017 chip. The output latches of both
+    ports are shadowed and written together, so any number of transitions
+    on the chip costs a single two-byte register write.
+    """
+
+    def __init__(self, bus, address: int, relays: dict, chip: str = "mcp23s17"):
+        self._bus = bus
+        self.address = address
+        self.chip = chip
+        self.relay_pins = {_int(relay): _int(pin) for relay, pin in relays.items()}
+        self.relays = set(self.relay_pins)
+        for relay, pin in self.relay_pins.items():
+            if not 0 <= pin < 16:
+                raise ValueError(f"Relay {relay}: expander pin {pin} out of range (0-15)")
+
+        used_mask = 0
+        for pin in self.relay_pins.values():
+            used_mask |= 1 << pin
+        # All outputs start de-energized (HIGH), latches are written before the direction
+        self._olat = 0xFFFF
+        if chip == "mcp23s17":
+            self._bus.write_registers(address, MCP_IOCON, bytes([MCP_IOCON_HAEN]))
+        self._write_latches()
+        iodir = ~used_mask & 0xFFFF
+        self._bus.write_registers(address, MCP_IODIRA, bytes([iodir & 0xFF, iodir >> 8]))
+
+    def describe(self, relay_number: int) -> str:
+        return f"{self.chip.upper()}@{self.address}: pin {self.relay_pins[relay_number]}"
+
+    def _write_latches(self):
+        self._bus.write_registers(self.address, MCP_OLATA, bytes([self._olat & 0xFF, self._olat >> 8]))
+
+    def apply(self, changes: dict):
+        olat = self._olat
+        for relay, state in changes.items():
+            bit = 1 << self.relay_pins[relay]
+            olat = (olat | bit) if state else (olat & ~bit)
+        if olat == self._olat:
+            return
+        self._olat = olat
+        self._write_latches()
+
+    def read(self, relay_number: int):
+        port = self._bus.read_registers(self.address, MCP_GPIOA, 2)
+        value = port[0] | (port[1] << 8)
+        return (value >> self.relay_pins[relay_number]) & 1
+
+    def close(self):
+        self._olat = 0xFFFF
+        self._write_latches()
+
+
+class SimulatedBoard:
+    """Stand-in for a GPIO board: keeps the pin levels in memory."""
+
+    def __init__(self, relays: dict):
+        self.relay_pins = {_int(relay): pin for relay, pin in relays.items()}
+        self.relays = set(self.relay_pins)
+        self.states = {relay: HIGH for relay in self.relays}
+
+    def describe(self, relay_number: int) -> str:
+        return f"SIM: {self.relay_pins[relay_number]}"
+
+    def apply(self, changes: dict):
+        self.states.update(changes)
+
+    def read(self, relay_number: int):
+        return self.states[relay_number]
+
+    def close(self):
+        pass
+
+
+#
+# Backend
+#
+
+
+class RelayBackend:
+    """Dispatches relay transitions to the boards that own the relays."""
+
+    def __init__(self, boards: list, simulated: bool = False):
+        self.boards = boards
+        self.simulated = simulated
+        self._board_of = {}
+        for board in boards:
+            for relay in board.relays:
+                if relay in self._board_of:
+                    raise ValueError(f"Relay {relay} is assigned to more than one board")
+                self._board_of[relay] = board
+        self._lock = threading.Lock()
+        # Applied transitions (monotonic time, changes), used by simulations and tests
+        self.history = collections.deque(maxlen=10000)
+
+    @property
+    def relays(self) -> list:
+        return sorted(self._board_of)
+
+    def describe(self, relay_number: int) -> str:
+        return self._board_of[relay_number].describe(relay_number)
+
+    def apply(self, changes: dict):
+        """
+        Apply several relay transitions at once, {relay_number: LOW/HIGH}.
+        Raises KeyError for relays that are not wired in the board profile.
+        """
+        per_board = {}
+        for relay, state in changes.items():
+            board = self._board_of[relay]
+            per_board.setdefault(id(board), (board, {}))[1][relay] = state
+        with self._lock:
+            for board, board_changes in per_board.values():
+                board.apply(board_changes)
+            self.history.append((time.monotonic(), dict(changes)))
+
+    def read(self, relay_number: int):
+        """Read back the output level of a relay, None if the board cannot tell."""
+        try:
+            return self._board_of[relay_number].read(relay_number)
+        except (AttributeError, NotImplementedError):
+            return None
+
+    def close(self):
+        with self._lock:
+            for board in self.boards:
+                try:
+                    board.close()
+                except Exception as e:
+                    logging.error("relay_backends: Failed to release board - %s", e)
+
+
+def load_board_profile(file_path: str = BOARD_PROFILE_FILE, default_relays: dict = None) -> list:
+    """
+    Load the board definitions from the profile file. Without a profile, a single
+    GPIO board with the default relay-to-pin map is used.
+    """
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as file:
+            profile = json.load(file)
+        boards = profile.get('boards', [])
+        if not boards:
+            raise ValueError(f"No boards defined in {file_path}")
+        return boards
+    return [{"type": "gpio", "relays": dict(default_relays or {})}]
+
+
+def create_backend(boards: list, simulated: bool = None) -> RelayBackend:
+    """Build the backend for the given board definitions. All outputs start de-energized."""
+    if simulated is None:
+        simulated = os.getenv("RELAY_SIMULATED", "0").lower() in ("1", "true", "yes")
+
+    buses = {}
+    built = []
+    for board in boards:
+        board_type = board.get('type', 'gpio')
+        relays = board.get('relays', {})
+
+        if board_type == 'gpio':
+            built.append(SimulatedBoard(relays) if simulated else _create_gpio_board(board))
+
+        elif board_type in ('mcp23s17', 'mcp23017'):
+            if simulated or board.get('bus') == 'simulated':
+                bus_key = ('sim', board_type, board.get('spi_bus', board.get('i2c_bus', 0)), board.get('spi_device', 0))
+                if bus_key not in buses:
+                    buses[bus_key] = SimulatedBus()
+            elif board_type == 'mcp23s17':
+                bus_key = ('spi', _int(board.get('spi_bus', 0)), _int(board.get('spi_device', 0)))
+                if bus_key not in buses:
+                    buses[bus_key] = SpiBus(bus_key[1], bus_key[2], _int(board.get('speed_hz', 1000000)))
+            else:
+                bus_key = ('i2c', _int(board.get('i2c_bus', 1)))
+                if bus_key not in buses:
+                    buses[bus_key] = I2cBus(bus_key[1])
+            built.append(ExpanderBoard(buses[bus_key], _int(board.get('address', 0)), relays, chip=board_type))
+
+        else:
+            raise ValueError(f"Unknown relay board type: {board_type}")
+
+    backend = RelayBackend(built, simulated=simulated)
+    logging.info("relay_backends: %d relays on %d boards%s",
+                 len(backend.relays), len(built), " (simulated)" if simulated else "")
+    return backend
@@ -0,0 +1,165 @@
+"""
+Filename: relay_counters.py
+
+Persistent per-relay wear counters (actuations, cumulative on-time and last
+actuation time) kept in a small memory-mapped file.
+
+Each relay owns a fixed-size slot, so recording an edge is a couple of
+struct stores into the mapping instead of rewriting a JSON file. The kernel
+writes the dirty page back on its own; the counters survive service
+restarts and are flushed explicitly on close.
+
+Only the service writes them: it opens the file at start-up and closes the
+on-intervals its previous run left open (close_open_intervals). Other
+processes read them with read_counters().
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+
+from paths import DATA_DIR
+COUNTERS_FILE = os.path.join(DATA_DIR, "relay_counters.bin")
+
+MAGIC = b"PLRC"
+FORMAT_VERSION = 1
+MAX_RELAYS = 128
+
+# magic, format version, number of slots
+_HEADER = struct.Struct("<4sHH")
+# actuations, on-time in ms, last actuation (epoch s), energized since (epoch s, 0 when off)
+_SLOT = struct.Struct("<QQdd")
+_FILE_SIZE = _HEADER.size + MAX_RELAYS * _SLOT.size
+
+
+def _slot_offset(relay_number: int) -> int:
+    return _HEADER.size + relay_number * _SLOT.size
+
+
+def _iso(timestamp: float):
+    if not timestamp:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _snapshot_from_buffer(buffer) -> dict:
+    """Decode every used slot of a counters buffer into a plain dictionary."""
+    counters = {}
+    for relay_number in range(MAX_RELAYS):
+        actuations, on_time_ms, last_actuation, on_since = _SLOT.unpack_from(
+            buffer, _slot_offset(relay_number))
+        if actuations == 0:
+            continue
+        counters[relay_number] = {
+            "actuations": actuations,
+            "on_time_s": round(on_time_ms / 1000.0, 1),
+            "last_actuation": _iso(last_actuation),
+            "energized": on_since != 0,
+        }
+    return counters
+
+
+class RelayCounters:
+    """Memory-mapped wear counters, one fixed slot per relay number."""
+
+    def __init__(self, file_path: str = COUNTERS_FILE):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != _FILE_SIZE:
+                self._initialize(fd)
+            self._map = mmap.mmap(fd, _FILE_SIZE)
+        finally:
+            os.close(fd)
+
+        magic, version, slots = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or slots != MAX_RELAYS:
+            logging.warning("relay_counters: Unrecognised counters file %s, resetting it", file_path)
+            self._map[:] = bytes(_FILE_SIZE)
+            _HEADER.pack_into(self._map, 0, MAGIC, FORMAT_VERSION, MAX_RELAYS)
+
+    @staticmethod
+    def _initialize(fd: int):
+        """(Re)create the file with an empty header and zeroed slots, keeping old slots if possible."""
+        old = os.pread(fd, _FILE_SIZE, 0)
+        data = bytearray(_FILE_SIZE)
+        if old[:4] == MAGIC:
+            data[:len(old)] = old
+        _HEADER.pack_into(data, 0, MAGIC, FORMAT_VERSION, MAX_RELAYS)
+        os.ftruncate(fd, _FILE_SIZE)
+        os.pwrite(fd, bytes(data), 0)
+
+    def close_open_intervals(self):
+        """
+        Account relays left energized by a previous run up to now.
+        The relay stayed on until this process reset the outputs, so the
+        elapsed time is real wear. Only the service may call it, at start-up:
+        in any other process the open intervals belong to relays it is driving.
+        """
+        now = time.time()
+        with self._lock:
+            for relay_number in range(MAX_RELAYS):
+                offset = _slot_offset(relay_number)
+                actuations, on_time_ms, last_actuation, on_since = _SLOT.unpack_from(self._map, offset)
+                if on_since:
+                    on_time_ms += max(0, int((now - on_since) * 1000))
+                    _SLOT.pack_into(self._map, offset, actuations, on_time_ms, last_actuation, 0.0)
+
+    def record_on(self, relay_number: int, timestamp: float = None):
+        """Count an actuation and remember when the relay was energized."""
+        if not 0 <= relay_number < MAX_RELAYS:
+            return
+        now = timestamp or time.time()
+        offset = _slot_offset(relay_number)
+        with self._lock:
+            actuations, on_time_ms, _, on_since = _SLOT.unpack_from(self._map, offset)
+            if on_since:
+                # Already energized, do not count the same actuation twice
+                return
+            _SLOT.pack_into(self._map, offset, actuations + 1, on_time_ms, now, now)
+
+    def record_off(self, relay_number: int, timestamp: float = None):
+        """Add the time since the relay was energized to its cumulative on-time."""
+        if not 0 <= relay_number < MAX_RELAYS:
+            return
+        now = timestamp or time.time()
+        offset = _slot_offset(relay_number)
+        with self._lock:
+            actuations, on_time_ms, last_actuation, on_since = _SLOT.unpack_from(self._map, offset)
+            if not on_since:
+                return
+            on_time_ms += max(0, int((now - on_since) * 1000))
+            _SLOT.pack_into(self._map, offset, actuations, on_time_ms, last_actuation, 0.0)
+
+    def snapshot(self) -> dict:
+        """Return the counters of every relay that was actuated at least once."""
+        with self._lock:
+            return _snapshot_from_buffer(self._map)
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+
+
+def read_counters(file_path: str = COUNTERS_FILE) -> dict:
+    """
+    Read the counters without mapping the file for writing.
+    Used by the diagnostics tool and relay_ops outside the service, which owns the file.
+
+    :return: Dictionary keyed by relay number, or None if the file does not exist.
+    """
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    if len(data) != _FILE_SIZE or data[:4] != MAGIC:
+        raise ValueError(f"Invalid relay counters file: {file_path}")
+    return _snapshot_from_buffer(data)
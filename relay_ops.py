@@ -2,9 +2,17 @@
 Filename: relay_ops.py
 """
 
-import RPi.GPIO as GPIO
+import os
+import math
 import time
 import json
+import logging
+
+import relay_counters
+import relay_backends
+import pulse_scheduler
+import inflight_journal
+from relay_backends import LOW, HIGH
 
 # Custom Exception
 class MachineNotConfiguredException(Exception):
@@ -18,6 +26,14 @@ class MachineNotConfiguredException(Exception):
 ACTIVATION_TIME_INTERVAL: int = 2
 ACTIVATION_TIME_DURATION: int = 2
 
+# Self-test: maximum number of relays energized at the same time (power budget of the relay supply)
+SELF_TEST_MAX_ENERGIZED = int(os.getenv("RELAY_TEST_MAX_ENERGIZED", "4"))
+SELF_TEST_ON_S = 0.5
+SELF_TEST_GAP_S = 0.2
+# Delay between relays of the same group, spreads the coil inrush current
+SELF_TEST_STAGGER_S = 0.05
+
+# Default wiring, used when no board profile (relay_boards.json) is present
 relay_to_gpio_map = {
     # Module 1 - WASH
     1: 22,  # WASH
@@ -37,10 +53,56 @@ relay_to_gpio_map = {
     16: 26
 }
 
-used_gpio = list(relay_to_gpio_map.values())
+# Relay outputs, all relays start de-energized (HIGH)
+backend = relay_backends.create_backend(
+    relay_backends.load_board_profile(default_relays=relay_to_gpio_map)
+)
+
+# Trains in flight, only journaled in the service (see open_journal)
+journal = None
+
+# Activation details kept in the in-flight journal, taken from the progress dictionary
+JOURNAL_FIELDS = ('intent_id', 'activation_key', 'callback_url', 'callback_token', 'machine_id', 'device_id')
+
+# Persistent wear counters, only written by the service (see open_counters)
+counters = None
+
+def open_journal() -> list:
+    """
+    Start journaling the trains in flight and return the ones a killed previous run left.
+    Called once by the service at start-up; other importers (test_script.py, test.sh) never
+    call it, and while the service holds the journal a second caller runs without one, so
+    the service's slots are never cleared or shared.
+
+    :return: The interrupted trains, as returned by InflightJournal.recover().
+    """
+    global journal
+    try:
+        journal = inflight_journal.InflightJournal()
+        return journal.recover()
+    except inflight_journal.JournalBusy:
+        logging.warning("relay_ops: In-flight journal held by another process, trains will not be journaled")
+    except Exception as e:
+        logging.error("relay_ops: In-flight journal unavailable - %s", e)
+    journal = None
+    return []
+
+
+def open_counters():
+    """
+    Start recording relay wear and account the on-intervals a previous run left open.
+    Called once by the service at start-up; other importers (test_script.py, test.sh,
+    diagnostics) only read the counters, so the service's open intervals stay intact.
+    A failure here must never prevent relay operation.
+    """
+    global counters
+    try:
+        counters = relay_counters.RelayCounters()
+        counters.close_open_intervals()
+    except Exception as e:
+        logging.error("relay_ops: Relay counters unavailable - %s", e)
+        counters = None
 
-GPIO.setmode(GPIO.BCM)  # Use BCM GPIO numbering
-GPIO.setup(used_gpio, GPIO.OUT, initial=GPIO.HIGH)
 
 # Load the relay mapping once at the start of the program
 relay_mapping_data = {}
@@ -70,6 +132,14 @@ def load_relay_mapping_v1_0(file_path='config.json'):
         return {}
 
 
+def _parse_ms(value):
+    """Relay time in ms. Whole numbers stay int; fractions are kept for trace_replay.py, which divides times by its speed."""
+    number = float(value)
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(f"invalid time in ms: {value}")
+    return int(number) if number.is_integer() else number
+
+
 def load_relay_mapping_v1_1(file_path='config.json'):
     """
     Loads relay mapping from a JSON configuration file with the new schema.
@@ -93,7 +163,7 @@ def load_relay_mapping_v1_1(file_path='config.json'):
                 relay_data = {
                     'machine_id': int(value['machine_id']),
                     'relay_number': int(value['relay_number']),
-                    'time_relay_ms': int(value['time_relay_ms'])
+                    'time_relay_ms': _parse_ms(value['time_relay_ms'])
                 }
                 relay_mapping[machine_id] = relay_data
             return relay_mapping
@@ -136,8 +206,8 @@ def load_relay_mapping_v1_2(file_path='config.json'):
                 relay_data = {
                     'machine_id': int(value['machine_id']),
                     'relay_number': int(value['relay_number']),
-                    'time_relay_ms': int(value['time_relay_ms']),
-                    'interval_between_impulses_ms': int(value['interval_between_impulses_ms']),
+                    'time_relay_ms': _parse_ms(value['time_relay_ms']),
+                    'interval_between_impulses_ms': _parse_ms(value['interval_between_impulses_ms']),
                     'number_of_impulses_activation': int(value['number_of_impulses_activation'])
                 }
                 relay_mapping[machine_id] = relay_data
@@ -158,42 +228,45 @@ def load_relay_mapping_v1_2(file_path='config.json'):
 
 
 def get_relay_number(
-    machine_id: int
+    machine_id: int,
+    config_file: str = 'config.json'
     ):
     """
     Retrieves the relay number for a given machine number using the relay mapping.
 
     :param machine_id: The machine ID for which to retrieve the relay number.
-    :param mapping: The preloaded relay mapping.
+    :param config_file: The configuration file of the device.
     :return: The relay number corresponding to the given machine ID, or None if not found.
     """
     # Load relay mapping at the beginning
     # Doing it here allows for real time changes without restart
-    relay_mapping_data = load_relay_mapping_v1_0()
+    relay_mapping_data = load_relay_mapping_v1_0(config_file)
     return relay_mapping_data.get(machine_id, None)
 
 
-def get_relay_info_v1_1(machine_id: int):
+def get_relay_info_v1_1(machine_id: int, config_file: str = 'config.json'):
     """
     Retrieves the relay information for a given machine ID using the relay mapping.
 
     :param machine_id: The machine ID for which to retrieve the relay information.
+    :param config_file: The configuration file of the device.
     :return: A dictionary containing relay_number and time_relay_ms, or None if not found.
     """
     # Load relay mapping to allow for real-time changes without restart
-    relay_mapping_data = load_relay_mapping_v1_1()
+    relay_mapping_data = load_relay_mapping_v1_1(config_file)
     return relay_mapping_data.get(machine_id, None)
 
 
-def get_relay_info_v1_2(machine_id: int):
+def get_relay_info_v1_2(machine_id: int, config_file: str = 'config.json'):
     """
     Retrieves the relay information for a given machine ID using the v1.2 relay mapping.
 
     :param machine_id: The machine ID for which to retrieve the relay information.
+    :param config_file: The configuration file of the device.
     :return: A dictionary containing relay details, or None if not found.
     """
     # Load relay mapping to allow for real-time changes without restart
-    relay_mapping_data = load_relay_mapping_v1_2()
+    relay_mapping_data = load_relay_mapping_v1_2(config_file)
     return relay_mapping_data.get(machine_id, None)
 
 
@@ -201,72 +274,234 @@ def get_relay_info_v1_2(machine_id: int):
 def control_relay(
     relay_number: int,
     state):
-    gpio = relay_to_gpio_map[relay_number]
-    
-    log_str = f"Relay number: {relay_number} - GPIO: {gpio} - State: {state}"
-    print(log_str)
-    
-    GPIO.output(gpio, state)
+    control_relays({relay_number: state})
+
+
+def control_relays(changes: dict):
+    """
+    Applies several relay transitions at once, so relays switching in the
+    same tick go out in a single write per board.
+
+    :param changes: Dictionary of relay_number -> LOW (energized) / HIGH.
+    :raises KeyError: If a relay is not wired in the board profile.
+    """
+    backend.apply(changes)
+
+    for relay_number, state in changes.items():
+        log_str = f"Relay number: {relay_number} - {backend.describe(relay_number)} - State: {state}"
+        print(log_str)
+
+        if counters is not None:
+            if state == LOW:
+                counters.record_on(relay_number)
+            else:
+                counters.record_off(relay_number)
 
-    # GPIO.cleanup()
+
+# Pulse-timing thread that executes every activation, see pulse_scheduler.py
+scheduler = pulse_scheduler.PulseScheduler(control_relays)
+
+
+def get_relay_counters() -> dict:
+    """
+    Returns the wear counters (actuations, on-time, last actuation) of every used relay.
+
+    :return: A dictionary keyed by relay number, empty if the counters are unavailable.
+    """
+    if counters is None:
+        # Outside the service: read what the service recorded
+        try:
+            return relay_counters.read_counters() or {}
+        except (OSError, ValueError):
+            return {}
+    return counters.snapshot()
+
+
+def run_pulse_train(
+    relay_number: int,
+    pulses: int,
+    on_s: float,
+    interval_s: float,
+    tail_s: float = 0.0,
+    progress: dict = None):
+    """
+    Runs a pulse train on the pulse-timing thread and waits for it to finish.
+    Edge deadlines are anchored to the start of the train, so a late wake-up
+    does not stretch the rest of the train.
+
+    :param relay_number: The relay to pulse.
+    :param pulses: Number of pulses.
+    :param on_s: Time the relay stays energized per pulse, in seconds.
+    :param interval_s: Time between pulses, in seconds.
+    :param tail_s: Extra wait after the last pulse, in seconds.
+    :param progress: Optional dictionary filled with impulses requested/delivered and edge timestamps.
+                     The activation details already in it (JOURNAL_FIELDS) are kept in the
+                     in-flight journal while the train runs.
+    :raises KeyError: If the relay is not wired in the board profile.
+    :raises pulse_scheduler.TrainAborted: If the train was aborted (service stopping).
+    """
+    if relay_number not in backend.relays:
+        raise KeyError(relay_number)
+
+    slot = None
+    on_pulse = None
+    if journal is not None:
+        details = {field: progress[field] for field in JOURNAL_FIELDS if progress and progress.get(field) is not None}
+        slot = journal.begin(relay_number, pulses, details)
+        on_pulse = lambda train: journal.update(slot, train.delivered)
+
+    try:
+        train = scheduler.submit(pulse_scheduler.PulseTrain(
+            relay_number, pulses, on_s, interval_s, tail_s=tail_s, progress=progress, on_pulse=on_pulse))
+        train.wait()
+    finally:
+        if journal is not None:
+            journal.end(slot)
+    if train.error is not None:
+        raise train.error
+    return train
+
+
+def get_machine_relays(config_file: str = 'config.json') -> dict:
+    """
+    Returns the relay number of every configured machine, for any configuration schema.
+
+    :param config_file: The configuration file of the device.
+    :return: A dictionary with machine_id as keys and relay numbers as values.
+    """
+    try:
+        with open(config_file, 'r') as file:
+            config = json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+    machine_relays = {}
+    for key, value in config.items():
+        try:
+            relay_number = value['relay_number'] if isinstance(value, dict) else value
+            machine_relays[int(key)] = int(relay_number)
+        except (KeyError, TypeError, ValueError):
+            continue
+    return machine_relays
+
+
+def get_machine_states(config_file: str = 'config.json', relays: set = None) -> dict:
+    """
+    Returns whether each machine is idle or pulsing, and how many activations wait behind it.
+
+    :param config_file: The configuration file of the device.
+    :param relays: Relays assigned to the device, None for all relays.
+    :return: A dictionary keyed by machine_id (string), {"state": "idle"/"pulsing", "queued": n}.
+    """
+    busy = scheduler.busy_relays()
+    states = {}
+    for machine_id, relay_number in get_machine_relays(config_file).items():
+        if relays is not None and relay_number not in relays:
+            continue
+        queued = busy.get(relay_number)
+        states[str(machine_id)] = {
+            "state": "idle" if queued is None else "pulsing",
+            "queued": queued or 0,
+        }
+    return states
+
+
+def check_relay_assigned(machine_id: int, relay_number: int, relays: set = None):
+    """
+    Refuses relays that belong to another device served by the same process.
+
+    :param relays: Relays assigned to the device, None for all relays.
+    :raises MachineNotConfiguredException: If the relay is not assigned to the device.
+    """
+    if relays is not None and relay_number not in relays:
+        raise MachineNotConfiguredException(
+            machine_id, message=f"Relay {relay_number} is not assigned to this device.")
+
+
+def get_pulse_jitter() -> dict:
+    """
+    Returns the edge timing error histogram of every relay used since start.
+
+    :return: A dictionary keyed by relay number.
+    """
+    return scheduler.jitter_snapshot()
 
 
 def activate_machine_v1_0(
     machine_id: int,
-    number_of_impulses: int = 1):
+    number_of_impulses: int = 1,
+    progress: dict = None,
+    config_file: str = 'config.json',
+    relays: set = None):
     """
     Activates a machine by controlling its relay.
 
     :param machine_id: The ID of the machine to activate.
     :param number_of_impulses: Number of times to activate the machine.
+    :param progress: Optional dictionary filled with impulses requested/delivered, the time the
+                     configuration was read and edge timestamps.
+    :param config_file: The configuration file of the device.
+    :param relays: Relays assigned to the device, None for all relays.
     :raises MachineNotConfiguredException: If the machine_id is not found in the relay mapping.
     """
-    relay_number = get_relay_number(machine_id)
+    relay_number = get_relay_number(machine_id, config_file)
+    if progress is not None:
+        progress['config_loaded'] = time.time()
     
     if relay_number is None:
         raise MachineNotConfiguredException(machine_id)
+    check_relay_assigned(machine_id, relay_number, relays)
     
-    for i in range(number_of_impulses):
-        # Activate the machine by setting the relay to the energized state (low)
-        control_relay(relay_number, GPIO.LOW)
-        # Deactivate after 2 seconds
-        time.sleep(ACTIVATION_TIME_DURATION)
-        control_relay(relay_number, GPIO.HIGH)
-        time.sleep(ACTIVATION_TIME_INTERVAL)
+    # Each impulse energizes the relay (low) for 2 seconds, followed by the interval
+    run_pulse_train(relay_number, number_of_impulses,
+                    on_s=ACTIVATION_TIME_DURATION,
+                    interval_s=ACTIVATION_TIME_INTERVAL,
+                    tail_s=ACTIVATION_TIME_INTERVAL,
+                    progress=progress)
 
 
-def activate_machine_v1_1(machine_id: int, number_of_impulses: int = 1):
+def activate_machine_v1_1(machine_id: int, number_of_impulses: int = 1, progress: dict = None,
+                          config_file: str = 'config.json', relays: set = None):
     """
     Activates a machine by controlling its relay for the duration specified in the config.
     If no duration is specified, defaults to 2000ms (2 seconds).
 
     :param machine_id: The ID of the machine to activate.
     :param number_of_impulses: Number of times to activate the machine.
+    :param progress: Optional dictionary filled with impulses requested/delivered, the time the
+                     configuration was read and edge timestamps.
+    :param config_file: The configuration file of the device.
+    :param relays: Relays assigned to the device, None for all relays.
     :raises MachineNotConfiguredException: If the machine_id is not found in the relay mapping.
     """
-    relay_info = get_relay_info_v1_1(machine_id)
+    relay_info = get_relay_info_v1_1(machine_id, config_file)
+    if progress is not None:
+        progress['config_loaded'] = time.time()
     
     if relay_info is None:
         raise MachineNotConfiguredException(machine_id)
     
     relay_number = relay_info['relay_number']
+    check_relay_assigned(machine_id, relay_number, relays)
     # Use time_relay_ms from config or default to 2000ms if not provided
     time_relay_ms = relay_info.get('time_relay_ms', 2000)
     # Convert milliseconds to seconds for the sleep function
     activation_duration = time_relay_ms / 1000.0
     
-    for i in range(number_of_impulses):
-        # Activate the machine by setting the relay to the energized state (low)
-        control_relay(relay_number, GPIO.LOW)
-        # Deactivate after the specified duration
-        time.sleep(activation_duration)
-        control_relay(relay_number, GPIO.HIGH)
-        time.sleep(ACTIVATION_TIME_INTERVAL)
+    # Each impulse energizes the relay (low) for the specified duration, followed by the interval
+    run_pulse_train(relay_number, number_of_impulses,
+                    on_s=activation_duration,
+                    interval_s=ACTIVATION_TIME_INTERVAL,
+                    tail_s=ACTIVATION_TIME_INTERVAL,
+                    progress=progress)
 
 
 def activate_machine_v1_2(
     machine_id: int,
-    number_of_impulses: int = 1
+    number_of_impulses: int = 1,
+    progress: dict = None,
+    config_file: str = 'config.json',
+    relays: set = None
     ):  
     """
     Activates a machine by controlling its relay with the specified parameters.
@@ -279,14 +514,21 @@ def activate_machine_v1_2(
     :param machine_id: The ID of the machine to activate.
     :param number_of_impulses: Total number of activations requested (multiplied by impulses_per_activation).
     :param interval_between_impulses_ms: Optional override (not used in standard implementation).
+    :param progress: Optional dictionary filled with impulses requested/delivered, the time the
+                     configuration was read and edge timestamps.
+    :param config_file: The configuration file of the device.
+    :param relays: Relays assigned to the device, None for all relays.
     :raises MachineNotConfiguredException: If the machine_id is not found in the relay mapping.
     """
-    relay_info = get_relay_info_v1_2(machine_id)
+    relay_info = get_relay_info_v1_2(machine_id, config_file)
+    if progress is not None:
+        progress['config_loaded'] = time.time()
     
     if relay_info is None:
         raise MachineNotConfiguredException(machine_id)
     
     relay_number = relay_info['relay_number']
+    check_relay_assigned(machine_id, relay_number, relays)
     # Get configuration values with defaults
     time_relay_ms = relay_info.get('time_relay_ms', 2000)
     impulses_per_activation = relay_info.get('number_of_impulses_activation', 1)
@@ -309,16 +551,11 @@ def activate_machine_v1_2(
           f"({number_of_impulses} activations × {impulses_per_activation} impulses/activation)")
     print(f"Relay: {relay_number}, Duration: {time_relay_ms}ms, Interval: {interval_between_impulses*1000}ms")
     
-    for i in range(total_impulses):
-        # Activate the machine by setting the relay to the energized state (low)
-        control_relay(relay_number, GPIO.LOW)
-        # Deactivate after the specified duration
-        time.sleep(activation_duration)
-        control_relay(relay_number, GPIO.HIGH)
-        
-        # Only sleep between impulses if there are more impulses to be sent
-        if i < total_impulses - 1:
-            time.sleep(interval_between_impulses)
+    # No interval after the last impulse
+    run_pulse_train(relay_number, total_impulses,
+                    on_s=activation_duration,
+                    interval_s=interval_between_impulses,
+                    progress=progress)
 
 
 #
@@ -326,14 +563,101 @@ def activate_machine_v1_2(
 #
 
 
+def self_test(
+    relays: list = None,
+    max_energized: int = SELF_TEST_MAX_ENERGIZED,
+    on_s: float = SELF_TEST_ON_S,
+    gap_s: float = SELF_TEST_GAP_S,
+    stagger_s: float = SELF_TEST_STAGGER_S) -> list:
+    """
+    Pulses relays concurrently in staggered groups, never energizing more than
+    max_energized relays at a time, and reads the outputs back where the board
+    supports it: energized in the middle of the pulse, released after it.
+
+    :param relays: Relays to test, all wired relays by default.
+    :return: One dictionary per relay with the read-back levels and the result
+             ("OK", "FALHA", "ERRO" or "SEM LEITURA" when the board cannot read back).
+    """
+    relays = list(relays) if relays is not None else backend.relays
+    max_energized = max(1, max_energized)
+    results = []
+
+    for first in range(0, len(relays), max_energized):
+        group = relays[first:first + max_energized]
+        # Every relay of the group must still be energized when the group is read back
+        stagger = min(stagger_s, on_s / (2 * len(group)))
+        started = time.monotonic()
+        trains = []
+        for index, relay_number in enumerate(group):
+            delay = started + index * stagger - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            trains.append(scheduler.submit(pulse_scheduler.PulseTrain(relay_number, 1, on_s, 0.0)))
+
+        # Middle of the window where all relays of the group are energized
+        last_start = (len(group) - 1) * stagger
+        delay = started + last_start + (on_s - last_start) / 2 - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        energized = {relay_number: backend.read(relay_number) for relay_number in group}
+
+        for train in trains:
+            train.wait()
+        released = {relay_number: backend.read(relay_number) for relay_number in group}
+
+        for relay_number, train in zip(group, trains):
+            if train.error is not None:
+                result = "ERRO"
+            elif energized[relay_number] is None or released[relay_number] is None:
+                result = "SEM LEITURA"
+            elif energized[relay_number] == LOW and released[relay_number] == HIGH:
+                result = "OK"
+            else:
+                result = "FALHA"
+            results.append({
+                "relay": relay_number,
+                "description": backend.describe(relay_number),
+                "energized": energized[relay_number],
+                "released": released[relay_number],
+                "error": str(train.error) if train.error is not None else None,
+                "result": result,
+            })
+        time.sleep(gap_s)
+
+    return results
+
+
+def print_self_test(results: list, elapsed_s: float = None) -> bool:
+    """
+    Prints the self-test results as a table.
+
+    :return: True if no relay failed.
+    """
+    print(f"{'Relé':>5}  {'Ligação':<28} {'Ligado':>6} {'Desligado':>9}  Resultado")
+    for entry in results:
+        energized = "-" if entry["energized"] is None else entry["energized"]
+        released = "-" if entry["released"] is None else entry["released"]
+        line = f"{entry['relay']:>5}  {entry['description']:<28} {energized:>6} {released:>9}  {entry['result']}"
+        if entry["error"]:
+            line += f" ({entry['error']})"
+        print(line)
+
+    failed = [entry["relay"] for entry in results if entry["result"] in ("FALHA", "ERRO")]
+    summary = f"{len(results)} relés testados"
+    if elapsed_s is not None:
+        summary += f" em {elapsed_s:.1f} s"
+    print(summary + (f", falharam: {failed}" if failed else ", sem falhas"))
+    return not failed
+
+
 def test_all(speed: int = 1):
-    for relay_label in relay_to_gpio_map:
+    for relay_label in backend.relays:
         print(f"Testing {relay_label}")
         # Turn on the relay
-        control_relay(relay_label, GPIO.LOW)
+        control_relay(relay_label, LOW)
         time.sleep(ACTIVATION_TIME_DURATION / speed)
         # Turn off the relay
-        control_relay(relay_label, GPIO.HIGH)
+        control_relay(relay_label, HIGH)
         time.sleep(ACTIVATION_TIME_INTERVAL / speed)
 
 
@@ -345,10 +669,10 @@ def test_module_1(speed: int=1):
     for relay_label in module_1_relays:
         print(f"Testing {relay_label} in Module 1")
         # Turn on the relay
-        control_relay(relay_label, GPIO.LOW)
+        control_relay(relay_label, LOW)
         time.sleep(ACTIVATION_TIME_DURATION / speed)
         # Turn off the relay
-        control_relay(relay_label, GPIO.HIGH)
+        control_relay(relay_label, HIGH)
         time.sleep(ACTIVATION_TIME_INTERVAL / speed)
 
 
@@ -359,9 +683,9 @@ def test_module_2(speed: int = 1):
     for relay_label in module_2_relays:
         print(f"Testing {relay_label} in Module 2")
         # Turn on the relay
-        control_relay(relay_label, GPIO.LOW)
+        control_relay(relay_label, LOW)
         time.sleep(ACTIVATION_TIME_DURATION / speed)
         # Turn off the relay
-        control_relay(relay_label, GPIO.HIGH)
+        control_relay(relay_label, HIGH)
         time.sleep(ACTIVATION_TIME_INTERVAL / speed)
 
@@ -0,0 +1,145 @@
+"""
+Filename: sampling_profiler.py
+
+Low-overhead sampling profiler for the live receiver.
+
+The profiling thread wakes up at a fixed interval and records the current stack
+of every Python thread (sys._current_frames), including the IoT Hub SDK's
+threads. Identical stacks are aggregated on the device, and the result is
+written in the collapsed-stack format used by flamegraph.pl / speedscope:
+
+    thread-name;module.py:function;module.py:function <samples>
+
+Nothing is instrumented, so the cost is one stack walk per thread per sample
+(about 1% of one core at the default 50 Hz with a dozen threads), and only
+while a profile is running.
+
+Saved profiles are pruned to the newest MAX_PROFILE_FILES, none older than
+MAX_PROFILE_AGE_S, and the upload copy is limited to MAX_UPLOAD_BYTES by
+keeping only the most frequent stacks.
+"""
+
+import collections
+import gzip
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+from paths import DIAGNOSTICS_DIR
+
+PROFILE_DIR = DIAGNOSTICS_DIR
+
+DEFAULT_INTERVAL_S = 0.02
+MAX_DURATION_S = 300
+MAX_DEPTH = 48
+MAX_PROFILE_FILES = 10
+MAX_PROFILE_AGE_S = 7 * 24 * 3600
+# Compressed size of the profile sent to callback_url (before base64)
+MAX_UPLOAD_BYTES = 256 * 1024
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """Aggregates the stacks of all threads sampled at a fixed interval."""
+
+    def __init__(self, interval_s: float = DEFAULT_INTERVAL_S, max_depth: int = MAX_DEPTH):
+        self.interval_s = interval_s
+        self.max_depth = max_depth
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.sampling_s = 0.0
+        self.duration_s = 0.0
+
+    def _sample(self, own_ident: int):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            labels = []
+            while frame is not None and len(labels) < self.max_depth:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, f"thread-{ident}"))
+            self.stacks[";".join(reversed(labels))] += 1
+        self.samples += 1
+
+    def run(self, duration_s: float):
+        """Sample for duration_s seconds (bounded by MAX_DURATION_S) on the calling thread."""
+        duration_s = max(0.0, min(duration_s, MAX_DURATION_S))
+        own_ident = threading.get_ident()
+        start = time.monotonic()
+        deadline = start + duration_s
+        next_sample = start
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            self._sample(own_ident)
+            self.sampling_s += time.monotonic() - now
+            next_sample += self.interval_s
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind, do not try to catch up with a burst of samples
+                next_sample = time.monotonic()
+        self.duration_s = time.monotonic() - start
+
+    def collapsed(self) -> str:
+        """The aggregated stacks in collapsed-stack format, most frequent first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self) -> dict:
+        return {
+            "samples": self.samples,
+            "duration_s": round(self.duration_s, 2),
+            "interval_s": self.interval_s,
+            "unique_stacks": len(self.stacks),
+            # Share of one core spent taking the samples
+            "overhead_pct": round(100.0 * self.sampling_s / self.duration_s, 2) if self.duration_s else 0.0,
+        }
+
+    def compressed(self, max_bytes: int = MAX_UPLOAD_BYTES):
+        """
+        The collapsed stacks gzip-compressed, keeping only the most frequent stacks that fit
+        in max_bytes. Returns (data, number of stacks left out).
+        """
+        stacks = self.stacks.most_common()
+        count = len(stacks)
+        while True:
+            data = gzip.compress("".join(f"{stack} {samples}\n" for stack, samples in stacks[:count])
+                                 .encode('utf-8'))
+            if len(data) <= max_bytes or count == 0:
+                return data, len(stacks) - count
+            # Shrink in proportion to the overshoot, at least by one stack
+            count = min(count - 1, int(count * max_bytes / len(data)))
+
+    def save(self, directory: str = PROFILE_DIR) -> str:
+        """Write the collapsed stacks, gzip-compressed, and prune old profiles. Returns the file path."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded.gz")
+        with gzip.open(path, 'wt', encoding='utf-8') as file:
+            file.write(self.collapsed())
+        prune(directory)
+        return path
+
+
+def prune(directory: str = PROFILE_DIR):
+    """Keep the newest MAX_PROFILE_FILES profiles and remove any older than MAX_PROFILE_AGE_S."""
+    now = time.time()
+    try:
+        profiles = sorted(name for name in os.listdir(directory)
+                          if name.startswith("profile_") and name.endswith(".folded.gz"))
+        for index, name in enumerate(profiles):
+            path = os.path.join(directory, name)
+            if index < len(profiles) - MAX_PROFILE_FILES or now - os.path.getmtime(path) > MAX_PROFILE_AGE_S:
+                os.remove(path)
+    except OSError:
+        pass
+
@@ -0,0 +1,50 @@
+"""
+Filename: sd_notify.py
+
+Minimal systemd notification protocol (sd_notify) without extra dependencies.
+Messages are sent as datagrams to the socket in $NOTIFY_SOCKET; outside of
+systemd every call is a no-op.
+"""
+
+import logging
+import os
+import socket
+
+
+def notify(state: str) -> bool:
+    """
+    Send a state string such as "READY=1", "WATCHDOG=1" or "STATUS=..." to systemd.
+
+    :return: True if the message was sent.
+    """
+    address = os.getenv("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        # Abstract namespace socket
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode('utf-8'))
+        return True
+    except OSError as e:
+        logging.warning("sd_notify: Failed to notify systemd - %s", e)
+        return False
+
+
+def watchdog_interval():
+    """
+    Watchdog timeout configured by WatchdogSec=, in seconds, or None if the
+    watchdog is not enabled for this process.
+    """
+    usec = os.getenv("WATCHDOG_USEC")
+    if not usec:
+        return None
+    pid = os.getenv("WATCHDOG_PID")
+    if pid and pid != str(os.getpid()):
+        return None
+    try:
+        return int(usec) / 1000000.0
+    except ValueError:
+        return None
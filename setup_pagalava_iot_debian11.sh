@@ -90,13 +90,27 @@ After=network-online.target
 Wants=network-online.target
 
 [Service]
+# READY=1 is sent once the IoT Hub connection is established, WATCHDOG=1 while
+# the receive path and the pulse scheduler make progress
+Type=notify
+NotifyAccess=main
+WatchdogSec=60
+TimeoutStartSec=infinity
+# Running activations get PULSE_DRAIN_TIMEOUT_S (20 s) to finish on stop
+TimeoutStopSec=45
 User=${USERNAME}
 Group=${GROUPNAME}
 WorkingDirectory=${WORKINGDIR}
 Environment="PATH=${VENVDIR}/bin"
 Environment="IOT_CONNECTION_STRING=${IOT_CONNECTION_STRING}"
+# Fewer glibc malloc arenas: much lower RSS for a process with several threads
+Environment="MALLOC_ARENA_MAX=2"
 ExecStart=${VENVDIR}/bin/python ${WORKINGDIR}/${SCRIPTNAME}
 
+# Allow the optional real-time pulse timing mode (PULSE_REALTIME=1)
+LimitRTPRIO=99
+LimitMEMLOCK=infinity
+
 # Restart settings
 Restart=on-failure
 RestartSec=5s
@@ -8,16 +8,17 @@ echo "Escolhe o modulo a testar:"
 echo "m1. Module 1"
 echo "m2. Module 2"
 echo "ma. Module 1 and 2"
+echo "st. Auto-teste rápido de todos os relés (em paralelo, com leitura do estado)"
 read -p "Introduz a escolha: " choice
 
 # Activate the virtual environment
 source "$VENVDIR/bin/activate"
 
-if [ "$choice" = "m1" ] || [ "$choice" = "m2" ] || [ "$choice" = "ma" ]; then
+if [ "$choice" = "m1" ] || [ "$choice" = "m2" ] || [ "$choice" = "ma" ] || [ "$choice" = "st" ]; then
     # Run the Python script using the Python executable from the virtual environment
     python "$PYTHONSCRIPT" "$choice"
 else
-    echo "Invalid choice. Please run the script again and choose either m1, m2, ma."
+    echo "Invalid choice. Please run the script again and choose either m1, m2, ma, st."
     # Deactivate the virtual environment before exiting
     deactivate
     exit 1
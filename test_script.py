@@ -1,9 +1,11 @@
 import sys
+import time
 import relay_ops
 
 def main():
-    if len(sys.argv) != 2:
+    if len(sys.argv) < 2 or (sys.argv[1] != 'st' and len(sys.argv) != 2):
         print("Usage: test.py <module_number>")
+        print("       test.py st [max_energized] [on_ms]")
         sys.exit(1)
 
     module_number = sys.argv[1]
@@ -14,8 +16,16 @@ def main():
         relay_ops.test_module_1()
     elif module_number == 'm2':
         relay_ops.test_module_2()
+    elif module_number == 'st':
+        # Fast self-test: all relays, concurrently in staggered groups, with read-back
+        max_energized = int(sys.argv[2]) if len(sys.argv) > 2 else relay_ops.SELF_TEST_MAX_ENERGIZED
+        on_s = int(sys.argv[3]) / 1000.0 if len(sys.argv) > 3 else relay_ops.SELF_TEST_ON_S
+        start = time.monotonic()
+        results = relay_ops.self_test(max_energized=max_energized, on_s=on_s)
+        if not relay_ops.print_self_test(results, time.monotonic() - start):
+            sys.exit(2)
     else:
-        print("Invalid module number. Please choose 1 or 2 or ma.")
+        print("Invalid module number. Please choose 1 or 2 or ma or st.")
         sys.exit(1)
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+"""
+Filename: tests/test_expander_board.py
+
+MCP23x17 expander boards against the in-memory register file (SimulatedBus):
+start-up sequence, the shadowed output latches written as one two-byte OLAT
+transaction per chip, and read-back through the port registers.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import relay_backends  # noqa: E402
+from relay_backends import LOW, HIGH, MCP_IOCON, MCP_IOCON_HAEN, MCP_IODIRA, MCP_OLATA  # noqa: E402
+
+RELAYS = {"17": 0, "18": 1, "19": 9, "20": 15}
+
+
+def _latches(bus, address=0):
+    olat = bus.registers[address][MCP_OLATA:MCP_OLATA + 2]
+    return olat[0] | (olat[1] << 8)
+
+
+def _writes(bus):
+    return [(address, register, data) for _, address, register, data in bus.transactions]
+
+
+@pytest.fixture
+def bus():
+    return relay_backends.SimulatedBus()
+
+
+@pytest.fixture
+def board(bus):
+    board = relay_backends.ExpanderBoard(bus, 0, RELAYS)
+    bus.transactions.clear()
+    return board
+
+
+def test_start_up_sequence(bus):
+    relay_backends.ExpanderBoard(bus, 3, RELAYS)
+    # Addressing enabled, latches de-energized before the pins become outputs
+    assert _writes(bus) == [
+        (3, MCP_IOCON, bytes([MCP_IOCON_HAEN])),
+        (3, MCP_OLATA, b"\xff\xff"),
+        (3, MCP_IODIRA, bytes([0xFC, 0x7D])),
+    ]
+
+
+def test_mcp23017_skips_iocon(bus):
+    relay_backends.ExpanderBoard(bus, 0, RELAYS, chip="mcp23017")
+    assert [register for _, register, _ in _writes(bus)] == [MCP_OLATA, MCP_IODIRA]
+
+
+def test_pin_out_of_range(bus):
+    with pytest.raises(ValueError):
+        relay_backends.ExpanderBoard(bus, 0, {"1": 16})
+
+
+def test_transitions_are_one_olat_write(bus, board):
+    board.apply({17: LOW, 19: LOW, 20: LOW})
+    assert _writes(bus) == [(0, MCP_OLATA, bytes([0xFE, 0x7D]))]
+    assert _latches(bus) == 0x7DFE
+
+
+def test_change_keeps_other_relays(bus, board):
+    board.apply({17: LOW, 20: LOW})
+    board.apply({18: LOW})
+    assert _latches(bus) == 0xFFFF & ~(1 << 0) & ~(1 << 1) & ~(1 << 15)
+    board.apply({17: HIGH})
+    assert _latches(bus) == 0xFFFF & ~(1 << 1) & ~(1 << 15)
+    assert len(bus.transactions) == 3
+
+
+def test_redundant_transition_is_not_written(bus, board):
+    board.apply({17: HIGH, 18: HIGH})
+    assert not bus.transactions
+    board.apply({17: LOW})
+    board.apply({17: LOW})
+    assert len(bus.transactions) == 1
+
+
+def test_read_back(board):
+    board.apply({19: LOW})
+    assert board.read(19) == LOW
+    assert board.read(17) == HIGH
+
+
+def test_close_releases_every_relay(bus, board):
+    board.apply({17: LOW, 18: LOW})
+    board.close()
+    assert _latches(bus) == 0xFFFF
+
+
+def test_backend_writes_once_per_chip():
+    backend = relay_backends.create_backend([
+        {"type": "mcp23s17", "bus": "simulated", "address": 0, "relays": {"1": 0, "2": 1}},
+        {"type": "mcp23s17", "bus": "simulated", "address": 1, "relays": {"3": 0, "4": 7}},
+    ])
+    bus = backend.boards[0]._bus
+    # Both chips share the SPI bus, each has its own hardware address
+    assert backend.boards[1]._bus is bus
+    bus.transactions.clear()
+    backend.apply({1: LOW, 2: LOW, 3: LOW, 4: LOW})
+    assert sorted(_writes(bus)) == [(0, MCP_OLATA, b"\xfc\xff"), (1, MCP_OLATA, b"\x7e\xff")]
+    assert [backend.read(relay) for relay in (1, 2, 3, 4)] == [LOW] * 4
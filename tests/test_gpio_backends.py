@@ -0,0 +1,240 @@
+"""
+Filename: tests/test_gpio_backends.py
+
+GPIO character device boards against stand-ins for the python3-libgpiod (v2
+and v1 API) and python3-lgpio modules: driver selection, one multi-line call
+per transition, skipped redundant writes, read-back and release on close.
+"""
+
+import enum
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import relay_backends  # noqa: E402
+from relay_backends import LOW, HIGH  # noqa: E402
+
+RELAYS = {"1": 22, "2": 5, "3": 27}
+OFFSETS = [5, 22, 27]
+
+
+def _gpiod_v2(calls):
+    """python3-libgpiod 2.x: gpiod.request_lines() and gpiod.line.Value."""
+    gpiod = types.ModuleType("gpiod")
+    line = types.ModuleType("gpiod.line")
+
+    class Direction(enum.Enum):
+        OUTPUT = "output"
+
+    class Value(enum.Enum):
+        INACTIVE = 0
+        ACTIVE = 1
+
+    class LineSettings:
+        def __init__(self, direction, output_value):
+            self.direction = direction
+            self.output_value = output_value
+
+    class LineRequest:
+        def __init__(self, offsets, value):
+            self.values = dict.fromkeys(offsets, value)
+
+        def set_values(self, values):
+            calls.append(("set_values", dict(values)))
+            self.values.update(values)
+
+        def get_value(self, offset):
+            return self.values[offset]
+
+        def release(self):
+            calls.append(("release",))
+
+    def request_lines(path, consumer, config):
+        (offsets, settings), = config.items()
+        calls.append(("request_lines", path, consumer, offsets, settings.direction, settings.output_value))
+        return LineRequest(offsets, settings.output_value)
+
+    line.Direction, line.Value = Direction, Value
+    gpiod.line = line
+    gpiod.LineSettings = LineSettings
+    gpiod.request_lines = request_lines
+    return gpiod, line
+
+
+def _gpiod_v1(calls):
+    """python3-libgpiod 1.x: gpiod.Chip().get_lines() with bulk get/set of every line."""
+    gpiod = types.ModuleType("gpiod")
+    gpiod.LINE_REQ_DIR_OUT = 3
+
+    class LineBulk:
+        def __init__(self, offsets):
+            self.offsets = offsets
+            self.levels = [0] * len(offsets)
+
+        def request(self, consumer, type, default_vals):
+            calls.append(("request", consumer, type, list(default_vals)))
+            self.levels = list(default_vals)
+
+        def set_values(self, values):
+            calls.append(("set_values", list(values)))
+            self.levels = list(values)
+
+        def get_values(self):
+            return list(self.levels)
+
+        def release(self):
+            calls.append(("release",))
+
+    class Chip:
+        def __init__(self, path):
+            calls.append(("chip", path))
+
+        def get_lines(self, offsets):
+            return LineBulk(list(offsets))
+
+    gpiod.Chip = Chip
+    return gpiod
+
+
+def _lgpio(calls):
+    lgpio = types.ModuleType("lgpio")
+    levels = {}
+
+    def gpiochip_open(chip):
+        calls.append(("gpiochip_open", chip))
+        return 7
+
+    def group_claim_output(handle, pins, values):
+        calls.append(("group_claim_output", list(pins), list(values)))
+        lgpio.pins = list(pins)
+        levels.update(zip(pins, values))
+
+    def group_write(handle, gpio, bits, mask=None):
+        calls.append(("group_write", gpio, bits, mask))
+        for index, pin in enumerate(lgpio.pins):
+            if mask is None or mask & (1 << index):
+                levels[pin] = (bits >> index) & 1
+
+    lgpio.gpiochip_open = gpiochip_open
+    lgpio.group_claim_output = group_claim_output
+    lgpio.group_write = group_write
+    lgpio.gpio_read = lambda handle, pin: levels[pin]
+    lgpio.group_free = lambda handle, gpio: calls.append(("group_free", gpio))
+    lgpio.gpiochip_close = lambda handle: calls.append(("gpiochip_close", handle))
+    return lgpio
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def no_rpi_gpio(monkeypatch):
+    monkeypatch.setitem(sys.modules, "RPi", None)
+    monkeypatch.setitem(sys.modules, "RPi.GPIO", None)
+    monkeypatch.setattr(relay_backends, "is_raspberry_pi_5", lambda: False)
+
+
+@pytest.fixture
+def gpiod_v2(monkeypatch, calls):
+    gpiod, line = _gpiod_v2(calls)
+    monkeypatch.setitem(sys.modules, "gpiod", gpiod)
+    monkeypatch.setitem(sys.modules, "gpiod.line", line)
+    return gpiod
+
+
+@pytest.fixture
+def gpiod_v1(monkeypatch, calls):
+    gpiod = _gpiod_v1(calls)
+    monkeypatch.setitem(sys.modules, "gpiod", gpiod)
+    monkeypatch.setitem(sys.modules, "gpiod.line", None)
+    return gpiod
+
+
+@pytest.fixture
+def lgpio(monkeypatch, calls):
+    lgpio = _lgpio(calls)
+    monkeypatch.setitem(sys.modules, "lgpio", lgpio)
+    return lgpio
+
+
+@pytest.mark.parametrize("driver, board_class", [
+    ("gpiod", relay_backends.GpiodBoard),
+    ("lgpio", relay_backends.LgpioBoard),
+    ("auto", relay_backends.GpiodBoard),
+])
+def test_driver_selection(no_rpi_gpio, gpiod_v2, lgpio, driver, board_class):
+    board = relay_backends._create_gpio_board({"relays": RELAYS, "driver": driver, "chip": "/dev/gpiochip9"})
+    assert type(board) is board_class
+
+
+def test_auto_falls_back_to_lgpio(monkeypatch, no_rpi_gpio, lgpio):
+    monkeypatch.setitem(sys.modules, "gpiod", None)
+    board = relay_backends._create_gpio_board({"relays": RELAYS})
+    assert type(board) is relay_backends.LgpioBoard
+
+
+def test_unknown_driver():
+    with pytest.raises(ValueError):
+        relay_backends._create_gpio_board({"relays": RELAYS, "driver": "sysfs"})
+
+
+def test_gpiod_v2(gpiod_v2, calls):
+    Value = gpiod_v2.line.Value
+    board = relay_backends.GpiodBoard(RELAYS, "/dev/gpiochip9")
+    assert calls == [("request_lines", "/dev/gpiochip9", relay_backends.GPIO_CONSUMER, tuple(OFFSETS),
+                      gpiod_v2.line.Direction.OUTPUT, Value.ACTIVE)]
+    del calls[:]
+
+    board.apply({1: LOW, 3: LOW, 2: HIGH})
+    assert calls == [("set_values", {22: Value.INACTIVE, 27: Value.INACTIVE})]
+    board.apply({1: LOW})
+    assert len(calls) == 1
+    assert [board.read(relay) for relay in (1, 2, 3)] == [LOW, HIGH, LOW]
+
+    board.close()
+    assert calls[-2:] == [("set_values", dict.fromkeys(OFFSETS, Value.ACTIVE)), ("release",)]
+
+
+def test_gpiod_v1(gpiod_v1, calls):
+    board = relay_backends.GpiodBoard(RELAYS, "/dev/gpiochip9")
+    assert calls == [("chip", "/dev/gpiochip9"), ("request", relay_backends.GPIO_CONSUMER,
+                                                  gpiod_v1.LINE_REQ_DIR_OUT, [HIGH] * 3)]
+    del calls[:]
+
+    # The v1 bulk call carries the level of every requested line, in offset order
+    board.apply({1: LOW, 2: HIGH})
+    board.apply({3: LOW})
+    board.apply({3: LOW})
+    assert calls == [("set_values", [HIGH, LOW, HIGH]), ("set_values", [HIGH, LOW, LOW])]
+    assert [board.read(relay) for relay in (1, 2, 3)] == [LOW, HIGH, LOW]
+
+    board.close()
+    assert calls[-2:] == [("set_values", [HIGH] * 3), ("release",)]
+
+
+def test_lgpio_chip_path(lgpio, calls):
+    relay_backends.LgpioBoard(RELAYS, "/dev/gpiochip4")
+    assert calls[0] == ("gpiochip_open", 4)
+
+
+def test_lgpio_group_write(lgpio, calls):
+    board = relay_backends.LgpioBoard(RELAYS, 0)
+    assert calls == [("gpiochip_open", 0), ("group_claim_output", OFFSETS, [HIGH] * 3)]
+    del calls[:]
+
+    # Bits follow the sorted pins: 5 -> bit 0, 22 -> bit 1, 27 -> bit 2
+    board.apply({1: LOW, 3: LOW, 2: HIGH})
+    assert calls == [("group_write", 5, 0b000, 0b110)]
+    board.apply({3: HIGH})
+    board.apply({3: HIGH})
+    assert calls[1:] == [("group_write", 5, 0b100, 0b100)]
+    assert [board.read(relay) for relay in (1, 2, 3)] == [LOW, HIGH, HIGH]
+
+    board.close()
+    assert calls[-3:] == [("group_write", 5, 0b111, None), ("group_free", 5), ("gpiochip_close", 7)]
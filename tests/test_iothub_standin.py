@@ -0,0 +1,87 @@
+"""
+Filename: tests/test_iothub_standin.py
+
+The IoT Hub stand-in against the real device SDK: connection, C2D delivery and
+acknowledgement, telemetry, reported properties, and C2D delivery after a
+dropped connection (the SDK resumes its session without subscribing again).
+
+Skipped when azure-iot-device or openssl is missing, or port 8883 is taken
+(the SDK always connects to that port).
+"""
+
+import os
+import queue
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+azure_device = pytest.importorskip("azure.iot.device")
+
+import iothub_standin  # noqa: E402
+
+DEVICE_ID = "pytest-device"
+
+
+@pytest.fixture
+def hub(tmp_path):
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl not installed")
+    certfile, keyfile = iothub_standin.make_certificate(str(tmp_path))
+    standin = iothub_standin.IoTHubStandIn(certfile, keyfile)
+    try:
+        standin.start()
+    except OSError as e:
+        pytest.skip(f"port {standin.port} unavailable: {e}")
+    standin.certfile = certfile
+    yield standin
+    standin.stop()
+
+
+@pytest.fixture
+def client(hub):
+    with open(hub.certfile, 'r') as file:
+        certificate = file.read()
+    device_client = azure_device.IoTHubDeviceClient.create_from_connection_string(
+        f"HostName=localhost;DeviceId={DEVICE_ID};SharedAccessKey=c3RhbmRpbg==",
+        server_verification_cert=certificate, keep_alive=5)
+    received = queue.Queue()
+    device_client.on_message_received = received.put
+    device_client.connect()
+    device_client.received = received
+    yield device_client
+    device_client.shutdown()
+
+
+def test_c2d_delivery_and_ack(hub, client):
+    assert hub.wait_for_subscription(DEVICE_ID, 0.0, 10) is not None
+    hub.send_c2d(DEVICE_ID, {"msg_type": "wake_up"}, {"type": "test"})
+    message = client.received.get(timeout=10)
+    assert message.data == b'{"msg_type": "wake_up"}'
+    assert message.custom_properties["type"] == "test"
+    assert "iothub-enqueuedtime" in message.custom_properties
+    assert hub.wait_for_acks(DEVICE_ID, 1, 10)
+
+
+def test_telemetry_and_reported_properties(hub, client):
+    message = azure_device.Message('{"seq":1}', content_encoding="utf-8", content_type="application/json")
+    message.custom_properties["type"] = "heartbeat"
+    client.send_message(message)
+    client.patch_twin_reported_properties({"machines": {"1": {"state": "idle"}}})
+    device = hub.device(DEVICE_ID)
+    assert hub.wait_for(lambda: device.telemetry and device.reported, 10)
+    _, properties, payload = device.telemetry[0]
+    assert properties["type"] == "heartbeat" and payload == b'{"seq":1}'
+    assert device.reported["machines"] == {"1": {"state": "idle"}}
+
+
+def test_delivery_resumes_after_drop(hub, client):
+    subscribed = hub.wait_for_subscription(DEVICE_ID, 0.0, 10)
+    assert subscribed is not None
+    hub.drop(DEVICE_ID)
+    assert hub.wait_for_subscription(DEVICE_ID, subscribed, 30) is not None
+    hub.send_c2d(DEVICE_ID, {"msg_type": "wake_up"})
+    assert client.received.get(timeout=10).data == b'{"msg_type": "wake_up"}'
+    assert len(hub.device(DEVICE_ID).connects) == 2
@@ -0,0 +1,52 @@
+"""
+Filename: tests/test_pulse_scheduler.py
+
+The pulse-timing thread against a recording stand-in for the relays: a train
+with an invalid number of pulses is refused without holding its relay, and the
+next train on that relay still runs.
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pulse_scheduler  # noqa: E402
+from relay_backends import LOW, HIGH  # noqa: E402
+
+
+@pytest.fixture
+def scheduler():
+    applied = []
+    lock = threading.Lock()
+
+    def apply_changes(changes):
+        with lock:
+            applied.append(dict(changes))
+
+    scheduler = pulse_scheduler.PulseScheduler(apply_changes, realtime=False)
+    scheduler.applied = applied
+    yield scheduler
+    scheduler.abort_all("test finished")
+
+
+@pytest.mark.parametrize("pulses", ["2", "22", 2.0, -1, True, None])
+def test_invalid_train_does_not_hold_relay(scheduler, pulses):
+    with pytest.raises(ValueError):
+        scheduler.submit(pulse_scheduler.PulseTrain(1, pulses, 0.001, 0.001))
+    assert scheduler.busy_relays() == {}
+
+    train = scheduler.submit(pulse_scheduler.PulseTrain(1, 2, 0.001, 0.001))
+    assert train.wait(5)
+    assert train.error is None and train.delivered == 2
+    assert scheduler.applied == [{1: LOW}, {1: HIGH}, {1: LOW}, {1: HIGH}]
+    assert scheduler.busy_relays() == {}
+
+
+def test_zero_pulses_finishes_without_edges(scheduler):
+    train = scheduler.submit(pulse_scheduler.PulseTrain(1, 0, 0.001, 0.001))
+    assert train.wait(5)
+    assert train.delivered == 0 and scheduler.applied == []
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Filename: trace_replay.py
+
+Extracts the C2D messages logged by message_handler ("Message received:" followed
+by the "    data: b'...'" line) from a journal export into a compact trace file,
+and replays a trace against the receiver with simulated relays, time-warped
+between 1x and 1000x.
+
+Usage:
+    journalctl -u receive_messages.service -o json --since "2026-03-07" > journal.json
+    python trace_replay.py extract journal.json -o sabado.trace.gz
+    python trace_replay.py replay sabado.trace.gz --config config.json --speed 100
+
+The trace is gzip-compressed JSON lines: a header, then one [offset_s, payload]
+entry per message. Callback tokens are redacted unless --keep-secrets is given.
+
+Replay runs in a temporary directory (config, ledger and counters are never the
+device's own), with RELAY_SIMULATED=1 and every outbound HTTP request recorded
+instead of sent. Relay on-times, intervals and message gaps are all divided by
+the speed factor. At the end, relay edges and activation callbacks are checked
+against the configuration; the exit code is 1 if any assertion fails.
+"""
+
+import argparse
+import ast
+import contextlib
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+TRACE_FORMAT = "pagalava-trace"
+TRACE_VERSION = 1
+
+# Message types that must never run during a replay
+SKIPPED_TYPES = {"reboot", "upgrade", "request_upgrade"}
+SECRET_FIELDS = {"callback_token", "token"}
+
+_ASCTIME = re.compile(r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3}) - \w+ - ")
+_DATA_LINE = re.compile(r" - INFO -     data: (b(['\"]).*\2)\s*$")
+_PROPERTIES_LINE = re.compile(r" - INFO -     custom_properties: (\{.*\})\s*$")
+
+
+#
+# Extraction
+#
+
+
+def _journal_lines(path: str):
+    """Yield (timestamp, text) for each line of a `journalctl -o json` export or a plain text log."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as file:
+        for line in file:
+            line = line.rstrip("\n")
+            timestamp = None
+            if line.startswith("{"):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                text = entry.get("MESSAGE")
+                if isinstance(text, list):
+                    # journald exports non-UTF-8 messages as byte arrays
+                    text = bytes(text).decode('utf-8', errors='replace')
+                if not isinstance(text, str):
+                    continue
+                if entry.get("__REALTIME_TIMESTAMP"):
+                    timestamp = int(entry["__REALTIME_TIMESTAMP"]) / 1000000.0
+            else:
+                text = line
+            if timestamp is None:
+                match = _ASCTIME.search(text)
+                if not match:
+                    continue
+                timestamp = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S").timestamp() \
+                    + int(match.group(2)) / 1000.0
+            yield timestamp, text
+
+
+def _redact(payload: dict) -> dict:
+    for field in SECRET_FIELDS:
+        if field in payload:
+            payload[field] = "REDACTED"
+    return payload
+
+
+def extract(journal_path: str, output_path: str, keep_secrets: bool = False) -> int:
+    """Convert a journal export into a trace file. Returns the number of messages."""
+    messages = []
+    for timestamp, text in _journal_lines(journal_path):
+        match = _DATA_LINE.search(text)
+        if not match:
+            continue
+        try:
+            payload = json.loads(ast.literal_eval(match.group(1)).decode('utf-8'))
+        except (ValueError, SyntaxError, UnicodeDecodeError):
+            continue
+        if not isinstance(payload, dict):
+            continue
+        messages.append((timestamp, payload if keep_secrets else _redact(payload)))
+
+    messages.sort(key=lambda item: item[0])
+    start = messages[0][0] if messages else 0.0
+    with gzip.open(output_path, 'wt', encoding='utf-8') as file:
+        file.write(json.dumps({"format": TRACE_FORMAT, "version": TRACE_VERSION,
+                               "start": start, "messages": len(messages)}) + "\n")
+        for timestamp, payload in messages:
+            file.write(json.dumps([round(timestamp - start, 3), payload], separators=(',', ':')) + "\n")
+    return len(messages)
+
+
+def load_trace(path: str):
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        header = json.loads(file.readline())
+        if header.get("format") != TRACE_FORMAT:
+            raise ValueError(f"{path} is not a trace file")
+        entries = [json.loads(line) for line in file if line.strip()]
+    return header, entries
+
+
+#
+# Replay
+#
+
+
+class RecordingSession:
+    """Stands in for the receiver's HTTP session: records requests instead of sending them."""
+
+    class _Response:
+        status_code = 200
+        text = "replay"
+
+    def __init__(self):
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def post(self, url, json=None, **kwargs):
+        with self._lock:
+            self.requests.append((time.monotonic(), url, json))
+        return self._Response()
+
+    def get(self, url, **kwargs):
+        return self.post(url, **kwargs)
+
+
+class ReplayMessage:
+    """Minimal stand-in for azure.iot.device.Message."""
+
+    def __init__(self, payload: dict, index: int):
+        self.data = json.dumps(payload).encode('utf-8')
+        self.message_id = f"replay-{index}"
+        self.custom_properties = {}
+        self.content_type = "application/json"
+        self.content_encoding = "utf-8"
+
+
+def _warp_config(config: dict, speed: float) -> dict:
+    """Divide every relay time of a v1.1/v1.2 configuration by the speed factor, keeping fractional ms."""
+    warped = {}
+    for key, value in config.items():
+        if isinstance(value, dict):
+            value = dict(value)
+            for field in ('time_relay_ms', 'interval_between_impulses_ms'):
+                if field in value:
+                    value[field] = str(round(float(value[field]) / speed, 3))
+        warped[key] = value
+    return warped
+
+
+def _expected_trains(config: dict, machine_id, number_of_impulses):
+    """Relay number, pulse count, on-time and interval (ms) for an activation, from a warped v1.2 config."""
+    machine = config.get(str(machine_id))
+    if not isinstance(machine, dict):
+        return None
+    pulses = int(number_of_impulses) * int(machine.get('number_of_impulses_activation', 1))
+    return (int(machine['relay_number']), pulses,
+            float(machine.get('time_relay_ms', 2000)),
+            float(machine.get('interval_between_impulses_ms', 2000)))
+
+
+def _percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def replay(trace_path: str, config_path: str, speed: float, tolerance_ms: float,
+           callback_slack_s: float, verbose: bool = False) -> int:
+    header, entries = load_trace(trace_path)
+    with open(config_path, 'r') as file:
+        config = _warp_config(json.load(file), speed)
+
+    workdir = tempfile.mkdtemp(prefix="pagalava-replay-")
+    os.environ["RELAY_SIMULATED"] = "1"
+    os.environ["PAGALAVA_DATA_DIR"] = os.path.join(workdir, "data")
+    os.environ.setdefault("IOT_CONNECTION_STRING", "HostName=replay.local;DeviceId=replay;SharedAccessKey=replay")
+    with open(os.path.join(workdir, "config.json"), 'w') as file:
+        json.dump(config, file)
+    os.chdir(workdir)
+
+    output = None if verbose else open(os.devnull, 'w')
+    with contextlib.redirect_stdout(output or sys.stdout):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import logging
+        import ReceiveMessages
+        import relay_ops
+
+        if not verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        relay_ops.ACTIVATION_TIME_DURATION /= speed
+        relay_ops.ACTIVATION_TIME_INTERVAL /= speed
+        session = RecordingSession()
+        ReceiveMessages.HTTP_SESSION = session
+        ReceiveMessages.CALLBACK_OUTBOX.session = session
+
+        dispatched = {}  # activation_key -> (dispatch time, expected train)
+        skipped = 0
+        start = time.monotonic()
+        for index, (offset, payload) in enumerate(entries):
+            delay = start + offset / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            msg_type = payload.get('msg_type')
+            if msg_type in SKIPPED_TYPES:
+                skipped += 1
+                continue
+            if msg_type == 'configure':
+                config = _warp_config(payload.get('data', {}), speed)
+                payload = dict(payload, data=config)
+            if msg_type == 'activate' and payload.get('activation_key'):
+                dispatched[payload['activation_key']] = (
+                    time.monotonic(),
+                    _expected_trains(config, payload.get('machine_id'), payload.get('number_of_impulses', 0))
+                )
+            # Messages are handled one at a time, as the SDK does
+            ReceiveMessages.message_handler(ReplayMessage(payload, index))
+        elapsed = time.monotonic() - start
+        # Activation callbacks are sent by the outbox thread
+        ReceiveMessages.CALLBACK_OUTBOX.flush(callback_slack_s + 5)
+        history = list(relay_ops.backend.history)
+
+    if output:
+        output.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    # Relay on-times and intervals, per relay, from the simulated edges
+    failures = []
+    on_errors_ms = []
+    energized_at = {}
+    on_times = {}
+    for when, changes in history:
+        for relay, state in changes.items():
+            if state == 0:
+                energized_at[relay] = when
+            elif relay in energized_at:
+                on_times.setdefault(relay, []).append((when - energized_at.pop(relay)) * 1000.0)
+
+    expected_on = {}
+    for machine in config.values():
+        if isinstance(machine, dict) and 'relay_number' in machine:
+            expected_on[int(machine['relay_number'])] = float(machine.get('time_relay_ms', 2000))
+    for relay, durations in on_times.items():
+        if relay not in expected_on:
+            continue
+        for duration in durations:
+            # In real-time ms: 0.2 ms late at 100x is a relay held 20 ms too long on site
+            error = abs(duration - expected_on[relay]) * speed
+            on_errors_ms.append(error)
+            if error > tolerance_ms:
+                failures.append(f"relay {relay}: on-time {duration * speed:.1f} ms, "
+                                f"expected {expected_on[relay] * speed:.0f} ms (real time)")
+
+    # Activation callbacks: one per activation key, within the train duration plus slack
+    callback_latencies = []
+    callbacks = {}
+    for when, url, body in session.requests:
+        if isinstance(body, dict) and body.get('activation_key'):
+            callbacks.setdefault(body['activation_key'], when)
+    for activation_key, (dispatched_at, expected) in dispatched.items():
+        if activation_key not in callbacks:
+            failures.append(f"activation {activation_key}: no callback sent")
+            continue
+        latency = callbacks[activation_key] - dispatched_at
+        callback_latencies.append(latency)
+        if expected:
+            _, pulses, on_ms, interval_ms = expected
+            budget = (pulses * on_ms + max(0, pulses - 1) * interval_ms) / 1000.0 + callback_slack_s
+            if latency > budget:
+                failures.append(f"activation {activation_key}: callback after {latency:.3f} s, budget {budget:.3f} s")
+
+    print(f"Trace: {trace_path} ({len(entries)} messages, {skipped} skipped)")
+    print(f"Replay: {speed:g}x in {elapsed:.1f} s (original span {entries[-1][0] if entries else 0:.0f} s)")
+    print(f"Relay edges: {sum(len(changes) for _, changes in history)} in {len(history)} transactions")
+    if on_errors_ms:
+        print(f"On-time error (ms, real time): p50 {_percentile(on_errors_ms, 0.5):.2f}, "
+              f"p95 {_percentile(on_errors_ms, 0.95):.2f}, max {max(on_errors_ms):.2f}")
+    if callback_latencies:
+        print(f"Callback latency (s): p50 {_percentile(callback_latencies, 0.5):.3f}, "
+              f"p95 {_percentile(callback_latencies, 0.95):.3f}, max {max(callback_latencies):.3f}")
+    print(f"HTTP requests recorded: {len(session.requests)}")
+
+    if failures:
+        print(f"FAILED: {len(failures)} timing assertions")
+        for failure in failures[:50]:
+            print(f"  {failure}")
+        return 1
+    print("OK: all timing assertions passed")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract and replay production C2D traffic")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extract_parser = subparsers.add_parser("extract", help="Convert a journal export into a trace file")
+    extract_parser.add_argument("journal", help="journalctl -o json export (or plain text log)")
+    extract_parser.add_argument("-o", "--output", required=True, help="Trace file to write (.gz)")
+    extract_parser.add_argument("--keep-secrets", action="store_true", help="Do not redact callback tokens")
+
+    replay_parser = subparsers.add_parser("replay", help="Replay a trace with simulated relays")
+    replay_parser.add_argument("trace", help="Trace file")
+    replay_parser.add_argument("--config", required=True, help="config.json of the shop (v1.2 schema)")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="Time warp factor, 1 to 1000")
+    replay_parser.add_argument("--tolerance-ms", type=float, default=20.0,
+                               help="Maximum relay on-time error, in ms of real (unwarped) time")
+    replay_parser.add_argument("--callback-slack-s", type=float, default=2.0,
+                               help="Time allowed for a callback beyond the pulse train duration")
+    replay_parser.add_argument("--verbose", "-v", action="store_true", help="Show receiver logs")
+
+    args = parser.parse_args()
+    if args.command == "extract":
+        count = extract(args.journal, args.output, args.keep_secrets)
+        print(f"{count} messages written to {args.output}")
+        return 0
+
+    if not 1.0 <= args.speed <= 1000.0:
+        parser.error("--speed must be between 1 and 1000")
+    return replay(args.trace, os.path.abspath(args.config), args.speed, args.tolerance_ms,
+                  args.callback_slack_s, args.verbose)
+
+
+if __name__ == "__main__":
+    sys.exit(main())